@@ -0,0 +1,379 @@
+from __future__ import print_function
+
+# =====================================================================
+# bench_hotpath
+# -------------
+# Per-message cost of the CRRMonitor hot path, and per-statistic cost of
+# Housekeeping publishing statistics, run against the in-process AWS fakes
+# (see fakes.py) with synthetic CloudTrail events delivered through SNS
+# and SQS.
+#
+# Each scenario processes its messages the way the queue handlers do
+# (process_message, then flush_statistics) and reports, per message:
+#   cpu_us      CPU time, best and median of the repeats
+#   calls       AWS calls, by service and operation
+#   alloc       memory allocated: peak bytes and blocks with tracemalloc
+#               where the interpreter has it, otherwise the growth in
+#               objects tracked by the garbage collector
+#
+# Scenarios:
+#   source_first     source event, then its replica
+#   replica_first    replica event, then its source
+#   failed           source events with replication status FAILED
+#   non_replicated   keys no replication rule covers (dropped by crr_rules)
+#   no_status        keys a rule covers but with no replication status
+#   duplicate        events delivered again after they were processed
+#   parse_envelope   json.loads of the SQS body and unwrap_event only
+#   timebucket       crr_time.timebucket only
+#   housekeeping     Housekeeping lambda_handler over the Statistics table
+#
+# Run it with the interpreter the lambdas use (python2.7) from anywhere:
+#   python benchmarks/bench_hotpath.py -o results.json
+#   python benchmarks/bench_hotpath.py --compare old.json new.json
+# =====================================================================
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+sys.path.insert(0, os.path.join(here, '..', 'source'))
+
+import fakes
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+if hasattr(time, 'process_time'):
+    cpu_time = time.process_time
+else:
+    cpu_time = time.clock # CPU time on Unix
+
+src_bucket = 'bench-source'
+dst_bucket = 'bench-replica'
+src_region = 'us-east-1'
+dst_region = 'us-west-2'
+rule_prefix = 'data/'
+start_secs = 1500000000 # 2017-07-14T02:40:00Z, a time bucket boundary
+
+# Printed lines are part of the cost but not worth reading
+class NullWriter(object):
+    def write(self, s):
+        pass
+
+    def flush(self):
+        pass
+
+class quiet(object):
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = NullWriter()
+
+    def __exit__(self, *args):
+        sys.stdout = self.stdout
+
+# =====================================================================
+# setup
+# -----
+# Install the fakes and import the lambdas. CRRMonitor runs single
+# threaded so the CPU time is all on the path being measured.
+# =====================================================================
+def setup():
+    os.environ.setdefault('workers', '1')
+    os.environ.setdefault('stream_to_kinesis', 'No')
+    aws = fakes.install(fakes.FakeAWS())
+    aws.add_table('CRRMonitor', 'ETag', { 'end_bucket-index': ('end_bucket', None), 'pending-index': ('pending', 'start_datetime') })
+    aws.add_table('CRRMonitorStatistics', 'OriginReplicaBucket', { 'timebucket-index': ('statday', 'timebucket') })
+    aws.add_queue('CRRMonitorQueue')
+    aws.s3.add_bucket(src_bucket, src_region, [ {
+        'ID': 'bench',
+        'Status': 'Enabled',
+        'Prefix': rule_prefix,
+        'Destination': { 'Bucket': 'arn:aws:s3:::' + dst_bucket }
+    } ])
+    aws.s3.add_bucket(dst_bucket, dst_region)
+    with quiet():
+        import CRRMonitor
+        import CRRMonitorHousekeeping
+        CRRMonitor.pool = None
+        # Build the rules index now rather than in the first scenario
+        CRRMonitor.crr_rules.get_index()
+    return aws, CRRMonitor, CRRMonitorHousekeeping
+
+def reset(aws, monitor):
+    for table in aws.tables.values():
+        table.items.clear()
+    aws.s3.objects.clear()
+    monitor.seen.clear()
+    monitor.statistics.clear()
+    monitor.initfail.clear()
+
+def event_time(secs):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(secs))
+
+# =====================================================================
+# Messages
+# --------
+# Each object is written to the source bucket at start_secs + i and
+# replicated 2 + i % 30 seconds later. Returns the SQS messages for the
+# events of objects 0..n-1 in the order they are delivered.
+# =====================================================================
+def put_pair(aws, i, status, key=None):
+    key = key or rule_prefix + 'object-%06d' % i
+    etag = '%032x' % i
+    version = 'v%08d' % i
+    aws.s3.put_object(src_bucket, key, 1024 * (1 + i % 1000), etag, version, status)
+    aws.s3.put_object(dst_bucket, key, 1024 * (1 + i % 1000), etag, version, 'REPLICA')
+    return key
+
+def source_message(i, key, compact):
+    ev = fakes.object_event(src_region, src_bucket, key, event_time(start_secs + i), 'src-%08d' % i, compact)
+    return fakes.sqs_message(ev, 'msg-src-%08d' % i)
+
+def replica_message(i, key, compact):
+    ev = fakes.object_event(dst_region, dst_bucket, key, event_time(start_secs + i + 2 + i % 30), 'dst-%08d' % i, compact)
+    return fakes.sqs_message(ev, 'msg-dst-%08d' % i)
+
+def pairs(aws, n, compact, replica_first=False):
+    messages = []
+    for i in range(n):
+        key = put_pair(aws, i, 'COMPLETED')
+        pair = [ source_message(i, key, compact), replica_message(i, key, compact) ]
+        if replica_first:
+            pair.reverse()
+        messages += pair
+    return messages
+
+def failed(aws, n, compact):
+    messages = []
+    for i in range(n):
+        key = rule_prefix + 'object-%06d' % i
+        aws.s3.put_object(src_bucket, key, 1024, '%032x' % i, 'v%08d' % i, 'FAILED')
+        messages.append(source_message(i, key, compact))
+    return messages
+
+def non_replicated(aws, n, compact):
+    messages = []
+    for i in range(n):
+        key = 'scratch/object-%06d' % i
+        aws.s3.put_object(src_bucket, key, 1024, '%032x' % i, 'v%08d' % i, None)
+        messages.append(source_message(i, key, compact))
+    return messages
+
+def no_status(aws, n, compact):
+    messages = []
+    for i in range(n):
+        key = rule_prefix + 'object-%06d' % i
+        aws.s3.put_object(src_bucket, key, 1024, '%032x' % i, 'v%08d' % i, None)
+        messages.append(source_message(i, key, compact))
+    return messages
+
+# =====================================================================
+# measure
+# -------
+# Run fn (prepared by prepare, which is not measured) repeat times and
+# return the cost per unit. prepare returns (argument for fn, units).
+# =====================================================================
+def measure(aws, prepare, fn, repeat):
+    cpu = []
+    calls = {}
+    alloc = None
+    units = 0
+    for r in range(repeat):
+        with quiet():
+            arg, units = prepare()
+        gc.collect()
+        aws.reset_counts()
+        first = r == 0
+        if first:
+            objects = len(gc.get_objects())
+            if tracemalloc:
+                tracemalloc.start()
+                before = tracemalloc.take_snapshot()
+        with quiet():
+            begin = cpu_time()
+            fn(arg)
+            cpu.append(cpu_time() - begin)
+        if first:
+            if tracemalloc:
+                peak = tracemalloc.get_traced_memory()[1]
+                after = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+                blocks = sum([ s.count_diff for s in after.compare_to(before, 'filename') if s.count_diff > 0 ])
+                alloc = {
+                    'method': 'tracemalloc',
+                    'peak_bytes': round(float(peak) / units, 1),
+                    'blocks': round(float(blocks) / units, 2)
+                }
+            else:
+                gc.collect()
+                alloc = {
+                    'method': 'gc',
+                    'objects': round(float(len(gc.get_objects()) - objects) / units, 2)
+                }
+            calls = dict(aws.calls)
+    cpu.sort()
+    return {
+        'units': units,
+        'repeat': repeat,
+        'cpu_us': {
+            'best': round(cpu[0] * 1e6 / units, 2),
+            'median': round(cpu[len(cpu) // 2] * 1e6 / units, 2)
+        },
+        'calls': round(float(sum(calls.values())) / units, 3),
+        'calls_by_operation': dict([ (op, round(float(n) / units, 3)) for op, n in sorted(calls.items()) ]),
+        'alloc': alloc
+    }
+
+# =====================================================================
+# Scenarios
+# ---------
+# name -> function(aws, monitor, housekeeping, n, compact) returning
+# (prepare, fn) for measure.
+# =====================================================================
+def handle(monitor):
+    def fn(messages):
+        for m in messages:
+            monitor.process_message(m)
+        monitor.flush_statistics()
+    return fn
+
+def message_scenario(build):
+    def scenario(aws, monitor, housekeeping, n, compact):
+        def prepare():
+            reset(aws, monitor)
+            messages = build(aws, n, compact)
+            return messages, len(messages)
+        return prepare, handle(monitor)
+    return scenario
+
+def duplicate(aws, monitor, housekeeping, n, compact):
+    def prepare():
+        reset(aws, monitor)
+        messages = pairs(aws, n, compact)
+        handle(monitor)(messages)
+        return messages, len(messages)
+    return prepare, handle(monitor)
+
+def parse_envelope(aws, monitor, housekeeping, n, compact):
+    def prepare():
+        messages = [ source_message(i, rule_prefix + 'object-%06d' % i, compact) for i in range(n) ]
+        return messages, n
+    def fn(messages):
+        for m in messages:
+            monitor.unwrap_event(json.loads(m['Body']))
+    return prepare, fn
+
+def timebucket(aws, monitor, housekeeping, n, compact):
+    def prepare():
+        return [ event_time(start_secs + i) for i in range(n) ], n
+    def fn(stamps):
+        for s in stamps:
+            monitor.crr_time.timebucket(s, 300)
+    return prepare, fn
+
+# n statistics, as CRRMonitor writes them, for one bucket pair in
+# consecutive time buckets
+def housekeeping(aws, monitor, housekeeping, n, compact):
+    def prepare():
+        reset(aws, monitor)
+        for i in range(n):
+            stamp = event_time(start_secs + 300 * i)
+            monitor.log_statistics(src_bucket, dst_bucket, stamp, str(1024 * (1 + i % 1000)), str(2 + i % 30), 300)
+        monitor.flush_statistics()
+        items = len(aws.tables['CRRMonitorStatistics'].items)
+        return None, items
+    def fn(arg):
+        housekeeping.lambda_handler({}, None)
+    return prepare, fn
+
+scenarios = [
+    ('source_first', message_scenario(lambda aws, n, compact: pairs(aws, n, compact))),
+    ('replica_first', message_scenario(lambda aws, n, compact: pairs(aws, n, compact, replica_first=True))),
+    ('failed', message_scenario(failed)),
+    ('non_replicated', message_scenario(non_replicated)),
+    ('no_status', message_scenario(no_status)),
+    ('duplicate', duplicate),
+    ('parse_envelope', parse_envelope),
+    ('timebucket', timebucket),
+    ('housekeeping', housekeeping)
+]
+
+def git_revision():
+    try:
+        return subprocess.check_output([ 'git', 'rev-parse', '--short', 'HEAD' ], cwd=here).decode().strip()
+    except Exception:
+        return None
+
+def run(args):
+    aws, monitor, housekeeping = setup()
+    results = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'time': event_time(time.time()),
+        'messages': args.messages,
+        'envelope': 'compact' if not args.full_events else 'cloudtrail',
+        'scenarios': {}
+    }
+    for name, scenario in scenarios:
+        if args.only and name not in args.only:
+            continue
+        prepare, fn = scenario(aws, monitor, housekeeping, args.messages, not args.full_events)
+        results['scenarios'][name] = measure(aws, prepare, fn, args.repeat)
+        r = results['scenarios'][name]
+        print('%-16s %10.1f us/msg %8.2f calls/msg' % (name, r['cpu_us']['median'], r['calls']), file=sys.stderr)
+    return results
+
+# =====================================================================
+# compare
+# -------
+# Print the change in median CPU time and calls per message between two
+# result files.
+# =====================================================================
+def compare(old_file, new_file):
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+    print('%-16s %12s %12s %8s %10s %10s' % ('scenario', 'old us/msg', 'new us/msg', 'change', 'old calls', 'new calls'))
+    for name in sorted(set(old['scenarios']) | set(new['scenarios'])):
+        a = old['scenarios'].get(name)
+        b = new['scenarios'].get(name)
+        if not a or not b:
+            print('%-16s %s' % (name, 'only in ' + (old_file if a else new_file)))
+            continue
+        before = a['cpu_us']['median']
+        after = b['cpu_us']['median']
+        change = (after - before) * 100.0 / before if before else 0
+        print('%-16s %12.1f %12.1f %+7.1f%% %10.3f %10.3f' % (name, before, after, change, a['calls'], b['calls']))
+
+def main():
+    parser = argparse.ArgumentParser(description='CRRMonitor hot path benchmarks')
+    parser.add_argument('-n', '--messages', type=int, default=500, help='objects per scenario')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='runs of each scenario')
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('--full-events', action='store_true', help='deliver whole CloudTrail records instead of the compact event')
+    parser.add_argument('--only', nargs='+', help='scenarios to run')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    results = run(args)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
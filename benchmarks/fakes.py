@@ -0,0 +1,592 @@
+from __future__ import print_function
+
+import json
+import re
+import threading
+import time
+import boto3
+from botocore.exceptions import ClientError
+
+# =====================================================================
+# fakes
+# -----
+# In-process stand-ins for the AWS services the CRR Monitor lambdas use,
+# for the benchmarks and the load test. They implement just the calls and
+# expressions the lambdas make, count every call, and can add latency or
+# throttle calls to imitate the real services.
+#
+# install() makes boto3.client return fakes, so it must be called before
+# the lambda modules are imported (they connect their clients on import).
+# =====================================================================
+
+# =====================================================================
+# FakeAWS
+# -------
+# One fake "account": the clients handed out, the S3 objects and buckets,
+# the DynamoDB tables and the SQS queues, and a count of every call made.
+#
+# latency: function(service, operation) returning seconds to sleep before
+# each call, or None.
+# throttle: function(service, operation) returning True if the call
+# should fail with a ThrottlingException, or None.
+# attempts: how many times a throttled call is tried, with exponential
+# backoff, before the exception reaches the caller (botocore retries
+# throttling the same way). Every attempt is counted as a call.
+# observers: functions(service, operation, kwargs) called after each
+# successful call.
+# =====================================================================
+class FakeAWS(object):
+    def __init__(self, latency=None, throttle=None, attempts=1):
+        self.latency = latency
+        self.throttle = throttle
+        self.attempts = attempts
+        self.observers = []
+        self.calls = {}
+        self.throttled = 0
+        self.lock = threading.Lock()
+        self.s3 = FakeS3()
+        self.tables = {}
+        self.queues = {}
+        self.handlers = {} # (service, operation) -> function, overrides the fakes
+
+    def client(self, service, region_name=None, config=None):
+        return FakeClient(self, service, region_name or 'us-east-1')
+
+    def count(self, service, operation):
+        with self.lock:
+            key = service + '.' + operation
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def reset_counts(self):
+        with self.lock:
+            self.calls = {}
+            self.throttled = 0
+
+    def total_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+    def add_table(self, name, key, indexes=None):
+        self.tables[name] = FakeTable(name, key, indexes)
+        return self.tables[name]
+
+    def add_queue(self, name):
+        self.queues[name] = FakeQueue(name)
+        return self.queues[name]
+
+# Make boto3.client hand out clients of a FakeAWS
+def install(aws):
+    boto3.client = aws.client
+    return aws
+
+def client_error(code, operation):
+    return ClientError({ 'Error': { 'Code': code, 'Message': code } }, operation)
+
+# =====================================================================
+# FakeClient
+# ----------
+# Dispatches each call to the handler registered on the FakeAWS, or to
+# the fake service, after counting it and applying latency/throttling.
+# Operations no fake implements return {}.
+# =====================================================================
+class FakeClient(object):
+    def __init__(self, aws, service, region):
+        self.aws = aws
+        self.service = service
+        self.region = region
+
+    def __getattr__(self, operation):
+        if operation.startswith('__'):
+            raise AttributeError(operation)
+        aws = self.aws
+        service = self.service
+        region = self.region
+
+        def call(**kwargs):
+            for attempt in range(aws.attempts):
+                aws.count(service, operation)
+                if aws.latency:
+                    delay = aws.latency(service, operation)
+                    if delay:
+                        time.sleep(delay)
+                if not (aws.throttle and aws.throttle(service, operation)):
+                    break
+                with aws.lock:
+                    aws.throttled += 1
+                if attempt == aws.attempts - 1:
+                    raise client_error('ThrottlingException', operation)
+                time.sleep(0.05 * 2 ** attempt)
+            handler = aws.handlers.get((service, operation))
+            if handler:
+                response = handler(**kwargs)
+            else:
+                fake = self.fake_service()
+                if fake is not None and hasattr(fake, operation):
+                    response = getattr(fake, operation)(region=region, **kwargs)
+                else:
+                    response = {}
+            for observer in aws.observers:
+                observer(service, operation, kwargs)
+            return response
+        return call
+
+    def fake_service(self):
+        if self.service == 's3':
+            return self.aws.s3
+        if self.service == 'dynamodb':
+            return FakeDynamoDB(self.aws)
+        if self.service == 'sqs':
+            return FakeSQS(self.aws)
+        return None
+
+# =====================================================================
+# FakeS3
+# ------
+# Buckets (with their region and replication rules) and the headers
+# head_object returns for each object.
+# =====================================================================
+class FakeS3(object):
+    def __init__(self):
+        self.buckets = {} # name -> { 'region':, 'rules': }
+        self.objects = {} # (bucket, key) -> headers
+        self.lock = threading.Lock()
+
+    def add_bucket(self, name, region='us-east-1', rules=None):
+        self.buckets[name] = { 'region': region, 'rules': rules }
+
+    # status is the x-amz-replication-status, or None for an object that
+    # is not replicated
+    def put_object(self, bucket, key, size, etag, version, status):
+        headers = {
+            'content-length': str(size),
+            'etag': '"' + etag + '"',
+            'x-amz-version-id': '"' + version + '"'
+        }
+        if status:
+            headers['x-amz-replication-status'] = status
+        with self.lock:
+            self.objects[(bucket, key)] = headers
+
+    def head_object(self, region, Bucket, Key):
+        headers = self.objects.get((Bucket, Key))
+        if headers is None:
+            raise client_error('404', 'HeadObject')
+        return { 'ResponseMetadata': { 'HTTPStatusCode': 200, 'HTTPHeaders': dict(headers) } }
+
+    def list_buckets(self, region):
+        return { 'Buckets': [ { 'Name': name } for name in sorted(self.buckets) ] }
+
+    def get_bucket_location(self, region, Bucket):
+        location = self.buckets[Bucket]['region']
+        return { 'LocationConstraint': None if location == 'us-east-1' else location }
+
+    def get_bucket_replication(self, region, Bucket):
+        rules = self.buckets.get(Bucket, {}).get('rules')
+        if not rules:
+            raise client_error('ReplicationConfigurationNotFoundError', 'GetBucketReplication')
+        return { 'ReplicationConfiguration': { 'Role': 'arn:aws:iam::123456789012:role/crr', 'Rules': rules } }
+
+# =====================================================================
+# FakeTable
+# ---------
+# A DynamoDB table with a single hash key. Items are stored in wire format
+# ({ 'attr': { 'S': 'value' } }). Supports the update, condition and
+# filter expressions the lambdas use. indexes maps an index name to
+# (hash key, range key or None): query on an index returns the items that
+# have its keys.
+# =====================================================================
+class FakeTable(object):
+    def __init__(self, name, key, indexes=None):
+        self.name = name
+        self.key = key
+        self.indexes = indexes or {}
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def get(self, Key):
+        with self.lock:
+            item = self.items.get(Key[self.key]['S'])
+            return dict(item) if item else None
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues=None, ConditionExpression=None,
+            ReturnValues=None, ExpressionAttributeNames=None):
+        values = ExpressionAttributeValues or {}
+        k = Key[self.key]['S']
+        with self.lock:
+            old = self.items.get(k)
+            if ConditionExpression and not evaluate(ConditionExpression, old or {}, values, ExpressionAttributeNames):
+                raise client_error('ConditionalCheckFailedException', 'UpdateItem')
+            item = dict(old) if old else dict(Key)
+            apply_update(UpdateExpression, item, values, ExpressionAttributeNames)
+            self.items[k] = item
+        if ReturnValues == 'ALL_NEW':
+            return { 'Attributes': dict(item) }
+        return {}
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeValues=None, ExpressionAttributeNames=None):
+        k = Item[self.key]['S']
+        with self.lock:
+            old = self.items.get(k)
+            if ConditionExpression and not evaluate(ConditionExpression, old or {}, ExpressionAttributeValues or {}, ExpressionAttributeNames):
+                raise client_error('ConditionalCheckFailedException', 'PutItem')
+            self.items[k] = dict(Item)
+        return {}
+
+    def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeValues=None, ExpressionAttributeNames=None):
+        k = Key[self.key]['S']
+        with self.lock:
+            if ConditionExpression and not evaluate(ConditionExpression, self.items.get(k) or {}, ExpressionAttributeValues or {}, ExpressionAttributeNames):
+                raise client_error('ConditionalCheckFailedException', 'DeleteItem')
+            self.items.pop(k, None)
+        return {}
+
+    # Filtered scan, in pages of Limit items (default 100)
+    def scan(self, FilterExpression=None, ExpressionAttributeValues=None, ExclusiveStartKey=None, Limit=100,
+            Segment=0, TotalSegments=1, ExpressionAttributeNames=None, **kwargs):
+        with self.lock:
+            keys = sorted(self.items)
+            keys = [ k for i, k in enumerate(keys) if i % TotalSegments == Segment ]
+            if ExclusiveStartKey:
+                start = ExclusiveStartKey[self.key]['S']
+                keys = [ k for k in keys if k > start ]
+            page = keys[:Limit]
+            items = [ dict(self.items[k]) for k in page ]
+        response = {
+            'Items': [ i for i in items if not FilterExpression or evaluate(FilterExpression, i, ExpressionAttributeValues or {}, ExpressionAttributeNames) ],
+            'ScannedCount': len(page)
+        }
+        response['Count'] = len(response['Items'])
+        if len(keys) > Limit:
+            response['LastEvaluatedKey'] = { self.key: { 'S': page[-1] } }
+        return response
+
+    # Query an index: KeyConditionExpression is evaluated like a filter on
+    # the items that have the index's keys. Results are in range key order.
+    def query(self, IndexName, KeyConditionExpression, ExpressionAttributeValues=None, FilterExpression=None,
+            ExclusiveStartKey=None, Limit=100, ExpressionAttributeNames=None, ScanIndexForward=True, **kwargs):
+        hash_key, range_key = self.indexes[IndexName]
+        values = ExpressionAttributeValues or {}
+        with self.lock:
+            items = [ dict(i) for i in self.items.values()
+                if hash_key in i and (range_key is None or range_key in i)
+                and evaluate(KeyConditionExpression, i, values, ExpressionAttributeNames) ]
+        order = lambda i: (scalar(i[range_key]) if range_key else None, i[self.key]['S'])
+        items.sort(key=order, reverse=not ScanIndexForward)
+        if ExclusiveStartKey:
+            start = order(ExclusiveStartKey)
+            items = [ i for i in items if (order(i) > start if ScanIndexForward else order(i) < start) ]
+        page = items[:Limit]
+        response = {
+            'Items': [ i for i in page if not FilterExpression or evaluate(FilterExpression, i, values, ExpressionAttributeNames) ],
+            'ScannedCount': len(page)
+        }
+        response['Count'] = len(response['Items'])
+        if len(items) > Limit:
+            last = page[-1]
+            response['LastEvaluatedKey'] = dict([ (a, last[a]) for a in [ self.key, hash_key, range_key ] if a ])
+        return response
+
+# Routes calls to the FakeTable named in TableName
+class FakeDynamoDB(object):
+    def __init__(self, aws):
+        self.aws = aws
+
+    def table(self, TableName):
+        if TableName not in self.aws.tables:
+            raise client_error('ResourceNotFoundException', 'DescribeTable')
+        return self.aws.tables[TableName]
+
+    def describe_table(self, region, TableName):
+        table = self.table(TableName)
+        return { 'Table': {
+            'TableName': TableName,
+            'TableStatus': 'ACTIVE',
+            'GlobalSecondaryIndexes': [ { 'IndexName': name, 'IndexStatus': 'ACTIVE' } for name in table.indexes ]
+        } }
+
+    def update_item(self, region, TableName, **kwargs):
+        return self.table(TableName).update_item(**kwargs)
+
+    def put_item(self, region, TableName, **kwargs):
+        return self.table(TableName).put_item(**kwargs)
+
+    def delete_item(self, region, TableName, **kwargs):
+        return self.table(TableName).delete_item(**kwargs)
+
+    def get_item(self, region, TableName, Key, **kwargs):
+        item = self.table(TableName).get(Key)
+        return { 'Item': item } if item else {}
+
+    def scan(self, region, TableName, **kwargs):
+        return self.table(TableName).scan(**kwargs)
+
+    def query(self, region, TableName, **kwargs):
+        return self.table(TableName).query(**kwargs)
+
+    def batch_get_item(self, region, RequestItems):
+        responses = {}
+        for name, request in RequestItems.items():
+            table = self.table(name)
+            responses[name] = [ i for i in [ table.get(k) for k in request['Keys'] ] if i ]
+        return { 'Responses': responses, 'UnprocessedKeys': {} }
+
+    def batch_write_item(self, region, RequestItems):
+        for name, requests in RequestItems.items():
+            table = self.table(name)
+            for r in requests:
+                if 'DeleteRequest' in r:
+                    table.delete_item(Key=r['DeleteRequest']['Key'])
+                else:
+                    table.put_item(Item=r['PutRequest']['Item'])
+        return { 'UnprocessedItems': {} }
+
+# =====================================================================
+# Expressions
+# -----------
+# Just enough of the DynamoDB expression language for the lambdas:
+#   update:    SET a = :v, b = if_not_exists(b, :v) ADD n :v REMOVE c
+#   condition: attribute_exists(a), attribute_not_exists(a) and
+#              comparisons (=, <>, <, <=, >, >=, BETWEEN) of an
+#              attribute with a value, joined by 'and' / 'or' (no
+#              parentheses around clauses)
+# =====================================================================
+def scalar(value):
+    if 'N' in value:
+        return float(value['N'])
+    return value.values()[0]
+
+def name_of(token, names):
+    if names and token in names:
+        return names[token]
+    return token
+
+def apply_update(expression, item, values, names=None):
+    for action, clauses in re.findall(r'(SET|ADD|REMOVE)\s+(.*?)(?=\s+(?:SET|ADD|REMOVE)\s|$)', expression, re.I):
+        action = action.upper()
+        for clause in re.split(r',(?![^(]*\))', clauses):
+            clause = clause.strip()
+            if action == 'SET':
+                attr, expr = [ x.strip() for x in clause.split('=', 1) ]
+                attr = name_of(attr, names)
+                m = re.match(r'if_not_exists\(\s*(\S+)\s*,\s*(:\w+)\s*\)', expr)
+                if m:
+                    if attr not in item:
+                        item[attr] = values[m.group(2)]
+                else:
+                    item[attr] = values[expr]
+            elif action == 'ADD':
+                attr, value = clause.split()
+                attr = name_of(attr, names)
+                total = float(item[attr]['N']) if attr in item else 0
+                total += float(values[value]['N'])
+                item[attr] = { 'N': str(int(total)) if total == int(total) else str(total) }
+            else:
+                item.pop(name_of(clause, names), None)
+
+def evaluate(expression, item, values, names=None):
+    for alternative in re.split(r'\s+or\s+', expression, flags=re.I):
+        if all(evaluate_clause(c.strip(), item, values, names) for c in split_and(alternative)):
+            return True
+    return False
+
+# 'and' also appears inside BETWEEN x AND y
+def split_and(expression):
+    parts = re.split(r'\s+and\s+', expression, flags=re.I)
+    clauses = []
+    for part in parts:
+        if clauses and re.search(r'\sbetween\s+\S+$', clauses[-1], re.I):
+            clauses[-1] += ' and ' + part
+        else:
+            clauses.append(part)
+    return clauses
+
+def evaluate_clause(clause, item, values, names):
+    m = re.match(r'attribute_(not_)?exists\(\s*(\S+?)\s*\)$', clause)
+    if m:
+        exists = name_of(m.group(2), names) in item
+        return not exists if m.group(1) else exists
+    m = re.match(r'(\S+)\s+between\s+(:\w+)\s+and\s+(:\w+)$', clause, re.I)
+    if m:
+        attr = name_of(m.group(1), names)
+        return attr in item and scalar(values[m.group(2)]) <= scalar(item[attr]) <= scalar(values[m.group(3)])
+    m = re.match(r'(\S+)\s*(<>|<=|>=|=|<|>)\s*(:\w+)$', clause)
+    if not m:
+        raise ValueError('Unsupported expression: ' + clause)
+    attr = name_of(m.group(1), names)
+    if attr not in item:
+        return m.group(2) == '<>'
+    a, b = scalar(item[attr]), scalar(values[m.group(3)])
+    return { '=': a == b, '<>': a != b, '<': a < b, '<=': a <= b, '>': a > b, '>=': a >= b }[m.group(2)]
+
+# =====================================================================
+# FakeQueue / FakeSQS
+# -------------------
+# A standard SQS queue: messages are hidden for the visibility timeout
+# once received and come back if they are not deleted in time.
+# =====================================================================
+class FakeQueue(object):
+    def __init__(self, name):
+        self.name = name
+        self.url = 'https://sqs.us-east-1.amazonaws.com/123456789012/' + name
+        self.messages = {} # MessageId -> message
+        self.hidden = {} # MessageId -> time it becomes visible again
+        self.handles = {} # ReceiptHandle -> MessageId
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def send(self, body):
+        with self.lock:
+            self.counter += 1
+            mid = 'm-' + str(self.counter)
+            self.messages[mid] = { 'MessageId': mid, 'Body': body, 'sent': time.time(), 'receives': 0 }
+        return mid
+
+    def visible(self, now):
+        return [ mid for mid in self.messages if self.hidden.get(mid, 0) <= now ]
+
+    def receive(self, count, visibility):
+        now = time.time()
+        with self.lock:
+            ready = sorted(self.visible(now), key=lambda m: self.messages[m]['sent'])[:count]
+            received = []
+            for mid in ready:
+                msg = self.messages[mid]
+                msg['receives'] += 1
+                handle = mid + '#' + str(msg['receives'])
+                self.handles[handle] = mid
+                self.hidden[mid] = now + visibility
+                received.append({ 'MessageId': mid, 'ReceiptHandle': handle, 'Body': msg['Body'] })
+        return received
+
+    def delete(self, handle):
+        with self.lock:
+            mid = self.handles.pop(handle, None)
+            if mid is None or mid not in self.messages:
+                return False
+            del self.messages[mid]
+            self.hidden.pop(mid, None)
+        return True
+
+    def change_visibility(self, handle, timeout):
+        with self.lock:
+            mid = self.handles.get(handle)
+            if mid is None or mid not in self.messages:
+                return False
+            self.hidden[mid] = time.time() + timeout
+        return True
+
+    def depth(self):
+        now = time.time()
+        with self.lock:
+            visible = len(self.visible(now))
+            return visible, len(self.messages) - visible
+
+class FakeSQS(object):
+    def __init__(self, aws):
+        self.aws = aws
+
+    def queue(self, QueueUrl):
+        for q in self.aws.queues.values():
+            if q.url == QueueUrl:
+                return q
+        raise client_error('AWS.SimpleQueueService.NonExistentQueue', 'ReceiveMessage')
+
+    def get_queue_url(self, region, QueueName):
+        if QueueName not in self.aws.queues:
+            self.aws.add_queue(QueueName)
+        return { 'QueueUrl': self.aws.queues[QueueName].url }
+
+    def get_queue_attributes(self, region, QueueUrl, AttributeNames):
+        visible, inflight = self.queue(QueueUrl).depth()
+        return {
+            'Attributes': {
+                'ApproximateNumberOfMessages': str(visible),
+                'ApproximateNumberOfMessagesNotVisible': str(inflight)
+            },
+            'ResponseMetadata': { 'HTTPStatusCode': 200 }
+        }
+
+    def receive_message(self, region, QueueUrl, MaxNumberOfMessages=1, VisibilityTimeout=30, WaitTimeSeconds=0, **kwargs):
+        q = self.queue(QueueUrl)
+        deadline = time.time() + WaitTimeSeconds
+        while True:
+            messages = q.receive(MaxNumberOfMessages, VisibilityTimeout)
+            if messages or time.time() >= deadline:
+                break
+            time.sleep(0.01)
+        return { 'Messages': messages } if messages else {}
+
+    def delete_message_batch(self, region, QueueUrl, Entries):
+        q = self.queue(QueueUrl)
+        ok = [ e for e in Entries if q.delete(e['ReceiptHandle']) ]
+        return { 'Successful': [ { 'Id': e['Id'] } for e in ok ], 'Failed': [] }
+
+    def delete_message(self, region, QueueUrl, ReceiptHandle):
+        self.queue(QueueUrl).delete(ReceiptHandle)
+        return {}
+
+    def change_message_visibility_batch(self, region, QueueUrl, Entries):
+        q = self.queue(QueueUrl)
+        ok = [ e for e in Entries if q.change_visibility(e['ReceiptHandle'], e['VisibilityTimeout']) ]
+        return { 'Successful': [ { 'Id': e['Id'] } for e in ok ], 'Failed': [] }
+
+# =====================================================================
+# Payloads
+# --------
+# The events CloudTrail -> EventBridge -> SNS -> SQS delivers for an
+# object write, in the compact form the CRRAgent rules forward, or as the
+# whole CloudTrail record (older rules).
+# =====================================================================
+def object_event(region, bucket, key, event_time, event_id, compact=True, version=None):
+    if compact:
+        return { 'region': region, 'bucket': bucket, 'key': key, 'eventTime': event_time, 'eventID': event_id, 'version': version }
+    return {
+        'version': '0',
+        'id': event_id,
+        'detail-type': 'AWS API Call via CloudTrail',
+        'source': 'aws.s3',
+        'account': '123456789012',
+        'time': event_time,
+        'region': region,
+        'resources': [],
+        'detail': {
+            'eventVersion': '1.05',
+            'userIdentity': { 'type': 'AssumedRole', 'principalId': 'AROAEXAMPLE:replication', 'accountId': '123456789012' },
+            'eventTime': event_time,
+            'eventSource': 's3.amazonaws.com',
+            'eventName': 'PutObject',
+            'awsRegion': region,
+            'sourceIPAddress': 's3.amazonaws.com',
+            'userAgent': 's3.amazonaws.com',
+            'requestParameters': { 'bucketName': bucket, 'key': key, 'Host': bucket + '.s3.amazonaws.com' },
+            'responseElements': { 'x-amz-version-id': version } if version else None,
+            'additionalEventData': { 'SignatureVersion': 'SigV4', 'bytesTransferredIn': 1024.0 },
+            'requestID': 'EXAMPLE0123456789',
+            'eventID': event_id,
+            'readOnly': False,
+            'resources': [
+                { 'type': 'AWS::S3::Object', 'ARN': 'arn:aws:s3:::' + bucket + '/' + key },
+                { 'accountId': '123456789012', 'type': 'AWS::S3::Bucket', 'ARN': 'arn:aws:s3:::' + bucket }
+            ],
+            'eventType': 'AwsApiCall',
+            'recipientAccountId': '123456789012'
+        }
+    }
+
+# The SQS message body SNS delivers for an event
+def sns_body(event, message_id):
+    return json.dumps({
+        'Type': 'Notification',
+        'MessageId': message_id,
+        'TopicArn': 'arn:aws:sns:us-east-1:123456789012:CRRMonitor-us-east-1',
+        'Message': json.dumps(event),
+        'Timestamp': event.get('eventTime') or event.get('time'),
+        'SignatureVersion': '1',
+        'Signature': 'EXAMPLE' * 40,
+        'SigningCertURL': 'https://sns.us-east-1.amazonaws.com/SimpleNotificationService-EXAMPLE.pem',
+        'UnsubscribeURL': 'https://sns.us-east-1.amazonaws.com/?Action=Unsubscribe&SubscriptionArn=EXAMPLE'
+    })
+
+# A message as receive_message returns it
+def sqs_message(event, message_id):
+    return { 'MessageId': message_id, 'ReceiptHandle': 'rh-' + message_id, 'Body': sns_body(event, message_id) }
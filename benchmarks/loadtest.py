@@ -0,0 +1,653 @@
+from __future__ import print_function
+
+# =====================================================================
+# loadtest
+# --------
+# Runs the whole pipeline locally against the in-process AWS fakes (see
+# fakes.py) to size maxtask/maxspawn/workers and check throughput changes
+# without touching a real account:
+#
+#   traffic generator -> object writes in S3 and their events, delivered
+#       to the SQS queue the way the CRRAgent rules and SNS deliver them
+#   CRRMonitor -> queue_handler started on a schedule and spawning
+#       children through lambda invoke, or sqs_handler fed by a simulated
+#       event source mapping (--consumer esm)
+#   CRRMonitorHousekeeping -> on its schedule, posting CloudWatch metrics
+#   CRRHourlyMaint -> once, at the end
+#
+# Every lambda container is a separate copy of its module, so it has its
+# own statistics, duplicate cache, worker pool and measured rate, and is
+# reused between invocations like a warm container.
+#
+# AWS calls get a latency (--latency, milliseconds, with +-50% jitter) and
+# can be throttled (--throttle, probability per call). Throttled calls are
+# retried with backoff up to crr_clients' max_attempts, like botocore.
+#
+# The report (JSON) has the sustained messages/sec, queue drain time after
+# the traffic stops, peak queue depth and lambda concurrency, latency from
+# object write to the pair being recorded and to its metric being posted,
+# and AWS calls per object by operation.
+#
+# Time buckets are 5 minutes, so metrics are only posted once the bucket
+# of the last object has closed: a run waits for that unless
+# --no-wait-metrics is given. Use a short --housekeeping-every to see them
+# sooner than the real 5 minute schedule.
+#
+# Example, 100 objects/sec for 2 minutes with at most 5 children:
+#   python benchmarks/loadtest.py --rate 100 --duration 120 --maxspawn 5 -o run.json
+# =====================================================================
+import argparse
+import heapq
+import imp
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+source = os.path.join(here, '..', 'source')
+sys.path.insert(0, here)
+sys.path.insert(0, source)
+
+import fakes
+
+src_region = 'us-east-1'
+dst_region = 'us-west-2'
+rule_prefix = 'data/'
+round_to = 300 # statistics time buckets, as CRRMonitor logs them
+
+# Default milliseconds per call, by service
+default_latency = {
+    's3': 20,
+    'dynamodb': 8,
+    'sqs': 15,
+    'cloudwatch': 20,
+    'lambda': 30,
+    'firehose': 20
+}
+
+# =====================================================================
+# Output
+# ------
+# The lambdas' print output is dropped, but errors and warnings are
+# counted and EMF lines (metrics_backend emf or both) are read as posted
+# metrics.
+# =====================================================================
+class LambdaOutput(object):
+    def __init__(self, run):
+        self.run = run
+        self.errors = 0
+        self.warnings = 0
+        self.lock = threading.Lock()
+
+    def write(self, s):
+        if s.startswith('ERROR'):
+            with self.lock:
+                self.errors += 1
+        elif s.startswith('WARNING'):
+            with self.lock:
+                self.warnings += 1
+        elif s.startswith('{"_aws"') or (s.startswith('{') and '"_aws"' in s):
+            doc = json.loads(s)
+            if 'DestBucket' in doc:
+                timestamp = doc['_aws']['Timestamp'] / 1000
+                self.run.metric_posted(doc['SourceBucket'], doc['DestBucket'], timestamp)
+
+    def flush(self):
+        pass
+
+def log(message):
+    sys.stderr.write(time.strftime('%H:%M:%S ') + message + '\n')
+
+def event_time(secs):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(secs))
+
+# =====================================================================
+# distribution
+# ------------
+# A function returning random values from a distribution given as
+#   fixed:value, uniform:low:high, lognormal:mu:sigma or pareto:alpha:min
+# =====================================================================
+def distribution(spec):
+    parts = spec.split(':')
+    kind = parts[0]
+    a = [ float(p) for p in parts[1:] ]
+    if kind == 'fixed':
+        return lambda: a[0]
+    if kind == 'uniform':
+        return lambda: random.uniform(a[0], a[1])
+    if kind == 'lognormal':
+        return lambda: random.lognormvariate(a[0], a[1])
+    if kind == 'pareto':
+        return lambda: a[1] * random.paretovariate(a[0])
+    raise ValueError('Unknown distribution ' + spec)
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda q: round(values[min(len(values) - 1, int(q * len(values)))], 3)
+    return { 'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99), 'max': round(values[-1], 3), 'count': len(values) }
+
+class FakeContext(object):
+    def __init__(self, function_name, timeout):
+        self.function_name = function_name
+        self.deadline = time.time() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return int(max(self.deadline - time.time(), 0) * 1000)
+
+# =====================================================================
+# Fleet
+# -----
+# The containers of one lambda function. An invocation takes an idle
+# container, or loads a new copy of the module (a cold start).
+# =====================================================================
+class Fleet(object):
+    def __init__(self, module, timeout):
+        self.module = module
+        self.timeout = timeout
+        self.idle = []
+        self.containers = []
+        self.loaded = 0
+        self.running = 0
+        self.peak = 0
+        self.invocations = 0
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            self.invocations += 1
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+            if self.idle:
+                return self.idle.pop()
+            self.loaded += 1
+            n = self.loaded
+        container = imp.load_source(self.module + '_' + str(n), os.path.join(source, self.module + '.py'))
+        with self.lock:
+            self.containers.append(container)
+        return container
+
+    def release(self, container):
+        with self.lock:
+            self.running -= 1
+            self.idle.append(container)
+
+    def context(self):
+        return FakeContext(self.module, self.timeout)
+
+    # Run handler(container, context) on a new thread, as an asynchronous
+    # invocation
+    def invoke(self, handler):
+        def run():
+            container = self.acquire()
+            try:
+                handler(container, self.context())
+            except Exception as e:
+                log('ERROR: ' + self.module + ' invocation failed: ' + repr(e))
+            finally:
+                self.release(container)
+        t = threading.Thread(target=run)
+        t.daemon = True
+        with self.lock:
+            self.threads = [ x for x in self.threads if x.is_alive() ] + [ t ]
+        t.start()
+
+    def wait(self, timeout):
+        deadline = time.time() + timeout
+        with self.lock:
+            threads = list(self.threads)
+        for t in threads:
+            t.join(max(deadline - time.time(), 0))
+
+    # Stop the threads a container leaves behind: its worker pool and the
+    # pre-warm thread. Daemon threads still running at interpreter
+    # shutdown fail once the modules they use are torn down.
+    def close(self, timeout):
+        self.wait(timeout)
+        with self.lock:
+            containers = list(self.containers)
+        for container in containers:
+            pool = getattr(container, 'pool', None)
+            if pool is not None:
+                pool.close()
+                pool.join()
+            t = getattr(container, 'prewarm_thread', None)
+            if t is not None:
+                t.join(timeout)
+
+# =====================================================================
+# LoadTest
+# --------
+# One run: sets up the fakes, the traffic and the consumers, and
+# collects what is needed for the report.
+# =====================================================================
+class LoadTest(object):
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.objects = {} # (source bucket, key) -> object record
+        self.by_etag = {} # CRRMonitor table key -> (source bucket, key)
+        self.heads = {} # (bucket, key) -> time of the last head_object
+        self.completed = {} # (source bucket, key) -> time the pair was recorded
+        self.posted = {} # (source bucket, dest bucket, timebucket secs) -> time the metric was posted
+        self.sent = 0
+        self.deleted = 0
+        self.deletes = [] # times of deletes, for the peak rate
+        self.depth_max = 0
+        self.traffic_start = None
+        self.traffic_end = None
+        self.drained = None
+        self.stopping = threading.Event()
+
+        latency = dict(default_latency)
+        overrides = dict([ (op, float(ms)) for op, ms in [ l.split('=') for l in args.latency ] ])
+        throttle = dict([ (op, float(p)) for op, p in [ t.split('=') for t in args.throttle ] ])
+        def call_latency(service, operation):
+            ms = overrides.get(service + '.' + operation, overrides.get(service, latency.get(service, 0)))
+            return ms * random.uniform(0.5, 1.5) / 1000.0
+        def call_throttled(service, operation):
+            p = throttle.get(service + '.' + operation, throttle.get(service, 0))
+            return p > 0 and random.random() < p
+        self.aws = fakes.install(fakes.FakeAWS(call_latency, call_throttled if throttle else None))
+        self.aws.observers.append(self.observe)
+
+    # -----------------------------------------------------------------
+    # setup: buckets, tables and queue, the lambdas' configuration, and
+    # the lambda modules. Must run before anything imports a lambda.
+    #
+    def setup(self):
+        args = self.args
+        aws = self.aws
+        aws.add_table('CRRMonitor', 'ETag', { 'end_bucket-index': ('end_bucket', None), 'pending-index': ('pending', 'start_datetime') })
+        aws.add_table('CRRMonitorStatistics', 'OriginReplicaBucket', { 'timebucket-index': ('statday', 'timebucket') })
+        self.queue = aws.add_queue('CRRMonitorQueue')
+        self.pairs = []
+        for i in range(args.buckets):
+            src = 'load-source-%02d' % i
+            dst = 'load-replica-%02d' % i
+            aws.s3.add_bucket(src, src_region, [ {
+                'ID': 'load',
+                'Status': 'Enabled',
+                'Prefix': rule_prefix,
+                'Destination': { 'Bucket': 'arn:aws:s3:::' + dst }
+            } ])
+            aws.s3.add_bucket(dst, dst_region)
+            self.pairs.append((src, dst))
+
+        env = {
+            'maxtask': args.maxtask,
+            'maxspawn': args.maxspawn,
+            'workers': args.workers,
+            'stream_to_kinesis': 'No'
+        }
+        for e in args.env:
+            k, v = e.split('=', 1)
+            env[k] = v
+        for k, v in env.items():
+            os.environ[k] = str(v)
+
+        import crr_clients
+        aws.attempts = crr_clients.settings['max_attempts']
+
+        sys.stdout = self.output = LambdaOutput(self)
+        self.monitor = Fleet('CRRMonitor', args.timeout)
+        self.housekeeping = Fleet('CRRMonitorHousekeeping', 300)
+        self.maint = Fleet('CRRHourlyMaint', 300)
+        aws.handlers[('lambda', 'invoke')] = self.invoke
+
+    # Asynchronous invocations of CRRMonitor by itself (spawned children)
+    def invoke(self, FunctionName, InvocationType, Payload):
+        event = json.loads(Payload)
+        self.monitor.invoke(lambda m, context: m.queue_handler(event, context))
+        return { 'StatusCode': 202 }
+
+    # -----------------------------------------------------------------
+    # observe: called after every successful AWS call
+    #
+    def observe(self, service, operation, kwargs):
+        now = time.time()
+        if service == 's3' and operation == 'head_object':
+            with self.lock:
+                self.heads[(kwargs['Bucket'], kwargs['Key'])] = now
+        elif service == 'dynamodb' and operation == 'update_item' and kwargs.get('ConditionExpression') == 'attribute_not_exists(crr_rate)':
+            self.pair_recorded(kwargs['Key']['ETag']['S'], now)
+        elif service == 'sqs' and operation in ('delete_message_batch', 'delete_message'):
+            n = len(kwargs.get('Entries', [ 1 ]))
+            with self.lock:
+                self.deleted += n
+                self.deletes.append((now, n))
+        elif service == 'cloudwatch' and operation == 'put_metric_data':
+            for datum in kwargs['MetricData']:
+                dims = dict([ (d['Name'], d['Value']) for d in datum['Dimensions'] ])
+                if datum['MetricName'] == 'ReplicationObjects':
+                    self.metric_posted(dims['SourceBucket'], dims['DestBucket'], self.crr_time.parse_time(datum['Timestamp']))
+
+    # complete_pair set the elapsed time of a pair
+    def pair_recorded(self, etag, now):
+        with self.lock:
+            k = self.by_etag.get(etag)
+            if k is None or k in self.completed:
+                return
+            obj = self.objects[k]
+            self.completed[k] = now
+            # Statistics go in the time bucket of the event processed
+            # first
+            src = self.heads.get(k, now)
+            dst = self.heads.get((obj['dst'], k[1]), now)
+            first = obj['src_time'] if src <= dst else obj['dst_time']
+            obj['timebucket'] = self.crr_time.round_up(first, round_to)
+
+    def metric_posted(self, src, dst, timebucket):
+        with self.lock:
+            self.posted.setdefault((src, dst, int(timebucket)), time.time())
+
+    # -----------------------------------------------------------------
+    # Traffic
+    # -------
+    # Writes objects at the configured rate and delivers their events
+    # when they are due. Source-first delivers the source event at write
+    # time and the replica event when replication finishes; replica-first
+    # delivers the source event reorder seconds after the replica's.
+    #
+    def traffic(self):
+        args = self.args
+        size = distribution(args.size)
+        delay = distribution(args.delay)
+        lag = distribution(args.lag)
+        due = []
+        n = int(args.rate * args.duration)
+        start = self.traffic_start = time.time()
+        i = 0
+        while i < n or due:
+            now = time.time()
+            if i < n and start + i / float(args.rate) <= now:
+                for when, body in self.write_object(i, now, size, delay, lag):
+                    heapq.heappush(due, (when, i, body))
+                i += 1
+                if i == n:
+                    self.traffic_end = time.time()
+                continue
+            if due and due[0][0] <= now:
+                when, j, body = heapq.heappop(due)
+                self.queue.send(body)
+                with self.lock:
+                    self.sent += 1
+                continue
+            nxt = min([ t for t in [ start + i / float(args.rate) if i < n else None, due[0][0] if due else None ] if t ])
+            time.sleep(max(min(nxt - time.time(), 0.05), 0))
+        if self.traffic_end is None:
+            self.traffic_end = time.time()
+
+    # Returns [ (delivery time, SQS body) ] for one object
+    def write_object(self, i, now, size, delay, lag):
+        args = self.args
+        src, dst = self.pairs[i % len(self.pairs)]
+        etag = '%032x' % i
+        version = 'v%08d' % i
+        nbytes = int(size())
+        roll = random.random()
+        if roll < args.non_replicated:
+            kind, key = None, 'scratch/object-%08d' % i
+        elif roll < args.non_replicated + args.failed:
+            kind, key = 'FAILED', rule_prefix + 'object-%08d' % i
+        else:
+            kind, key = 'COMPLETED', rule_prefix + 'object-%08d' % i
+        self.aws.s3.put_object(src, key, nbytes, etag, version, kind)
+        src_time = int(now)
+        src_event = fakes.object_event(src_region, src, key, event_time(src_time), 'src-%08d' % i, not args.full_events)
+        deliveries = []
+        obj = { 'write': now, 'dst': dst, 'status': kind, 'src_time': src_time }
+        if kind != 'COMPLETED':
+            deliveries.append((now + lag(), fakes.sns_body(src_event, 'sns-src-%08d' % i)))
+        else:
+            self.aws.s3.put_object(dst, key, nbytes, etag, version, 'REPLICA')
+            done = now + delay()
+            obj['dst_time'] = int(done)
+            dst_event = fakes.object_event(dst_region, dst, key, event_time(obj['dst_time']), 'dst-%08d' % i, not args.full_events)
+            order = args.order
+            if order == 'mixed':
+                order = random.choice([ 'source-first', 'replica-first' ])
+            if order == 'source-first':
+                deliveries.append((now + lag(), fakes.sns_body(src_event, 'sns-src-%08d' % i)))
+                deliveries.append((done + lag(), fakes.sns_body(dst_event, 'sns-dst-%08d' % i)))
+            else:
+                deliveries.append((done + lag(), fakes.sns_body(dst_event, 'sns-dst-%08d' % i)))
+                deliveries.append((done + lag() + args.reorder, fakes.sns_body(src_event, 'sns-src-%08d' % i)))
+        with self.lock:
+            self.objects[(src, key)] = obj
+            self.by_etag[etag + ':' + version] = (src, key)
+        return deliveries
+
+    # -----------------------------------------------------------------
+    # Consumers
+    #
+    # Scheduled: invoke queue_handler every schedule seconds, like the
+    # MonitorTimer rule
+    def scheduler(self):
+        while not self.stopping.is_set():
+            event = {
+                'detail-type': 'Scheduled Event',
+                'source': 'aws.events',
+                'time': event_time(time.time()),
+                'detail': {}
+            }
+            self.monitor.invoke(lambda m, context: m.queue_handler(event, context))
+            self.stopping.wait(self.args.schedule)
+
+    # Event source mapping: concurrency pollers, each receiving a batch
+    # and invoking sqs_handler with it, then deleting what succeeded
+    def poller(self):
+        args = self.args
+        visibility = int(os.environ.get('visibility', 1800))
+        while not self.stopping.is_set():
+            messages = self.queue.receive(args.batch_size, visibility)
+            if not messages:
+                time.sleep(0.1)
+                continue
+            event = { 'Records': [ {
+                'messageId': m['MessageId'],
+                'receiptHandle': m['ReceiptHandle'],
+                'body': m['Body'],
+                'eventSource': 'aws:sqs'
+            } for m in messages ] }
+            result = {}
+            container = self.monitor.acquire()
+            try:
+                result = container.sqs_handler(event, self.monitor.context())
+            except Exception as e:
+                log('ERROR: sqs_handler failed: ' + repr(e))
+                result = { 'batchItemFailures': [ { 'itemIdentifier': m['MessageId'] } for m in messages ] }
+            finally:
+                self.monitor.release(container)
+            failed = set([ f['itemIdentifier'] for f in result.get('batchItemFailures', []) ])
+            ok = [ m for m in messages if m['MessageId'] not in failed ]
+            now = time.time()
+            for m in ok:
+                self.queue.delete(m['ReceiptHandle'])
+            with self.lock:
+                self.deleted += len(ok)
+                self.deletes.append((now, len(ok)))
+
+    def run_housekeeping(self):
+        self.housekeeping.invoke(lambda m, context: m.lambda_handler({}, context))
+
+    def housekeeper(self):
+        while not self.stopping.wait(self.args.housekeeping_every):
+            self.run_housekeeping()
+
+    # Sample the queue depth until the traffic is over and the queue is
+    # empty
+    def watch_queue(self):
+        last = 0
+        while True:
+            visible, inflight = self.queue.depth()
+            with self.lock:
+                self.depth_max = max(self.depth_max, visible + inflight)
+            if self.traffic_end and visible + inflight == 0 and self.sent >= self.expected_messages():
+                self.drained = time.time()
+                return
+            if time.time() - last >= 10:
+                log('queue ' + str(visible) + ' visible, ' + str(inflight) + ' in flight, ' + str(self.deleted) + ' processed, ' + str(self.monitor.running) + ' lambdas running')
+                last = time.time()
+            time.sleep(0.2)
+
+    def expected_messages(self):
+        with self.lock:
+            return sum([ 2 if o['status'] == 'COMPLETED' else 1 for o in self.objects.values() ])
+
+    # Wait for the metrics of every recorded pair to be posted, or until a
+    # whole housekeeping period after the last time bucket closed
+    def wait_metrics(self):
+        with self.lock:
+            buckets = set([ (k[0], o['dst'], o['timebucket']) for k, o in self.objects.items() if 'timebucket' in o ])
+        if not buckets:
+            return
+        # Housekeeping reads a bucket once it is half a bucket old
+        deadline = max([ b[2] for b in buckets ]) + round_to // 2 + 2 * self.args.housekeeping_every + 30
+        log('waiting up to ' + str(int(max(deadline - time.time(), 0))) + 's for metrics to be posted')
+        while time.time() < deadline:
+            with self.lock:
+                if buckets <= set(self.posted):
+                    return
+            time.sleep(1)
+
+    # -----------------------------------------------------------------
+    # run: the whole test, returning the report
+    #
+    def run(self):
+        args = self.args
+        self.setup()
+        import crr_time
+        self.crr_time = crr_time
+
+        threads = [ threading.Thread(target=self.traffic), threading.Thread(target=self.housekeeper) ]
+        if args.consumer == 'esm':
+            threads += [ threading.Thread(target=self.poller) for i in range(args.concurrency) ]
+        else:
+            threads.append(threading.Thread(target=self.scheduler))
+        for t in threads:
+            t.daemon = True
+            t.start()
+        log('sending ' + str(int(args.rate * args.duration)) + ' objects over ' + str(args.duration) + 's')
+        self.watch_queue()
+        log('queue drained ' + str(round(self.drained - self.traffic_end, 1)) + 's after the traffic stopped')
+        self.stopping.set()
+        self.monitor.wait(args.timeout)
+        if args.wait_metrics:
+            self.stopping.clear()
+            hk = threading.Thread(target=self.housekeeper)
+            hk.daemon = True
+            hk.start()
+            self.wait_metrics()
+            self.stopping.set()
+        self.run_housekeeping()
+        self.maint.invoke(lambda m, context: m.lambda_handler({}, context))
+        self.housekeeping.wait(300)
+        self.maint.wait(300)
+        self.shutdown(threads)
+        sys.stdout = sys.__stdout__
+        return self.report()
+
+    # Join every thread the run started before the interpreter exits,
+    # including those the lambdas start for themselves (receivers,
+    # extenders and the pools they only close).
+    def shutdown(self, threads):
+        self.stopping.set()
+        deadline = time.time() + 60
+        for t in threads:
+            t.join(max(deadline - time.time(), 0))
+        for fleet in (self.monitor, self.housekeeping, self.maint):
+            fleet.close(max(deadline - time.time(), 0))
+        for t in threading.enumerate():
+            if t is not threading.current_thread():
+                t.join(max(deadline - time.time(), 0))
+        for t in threading.enumerate():
+            if t is not threading.current_thread():
+                log('WARNING: thread ' + t.name + ' still running')
+
+    def report(self):
+        args = self.args
+        objects = self.objects.values()
+        complete = [ self.completed[k] - o['write'] for k, o in self.objects.items() if k in self.completed ]
+        metric = [ self.posted[(k[0], o['dst'], o['timebucket'])] - o['write'] for k, o in self.objects.items()
+            if 'timebucket' in o and (k[0], o['dst'], o['timebucket']) in self.posted ]
+        elapsed = self.drained - self.traffic_start
+        peak = 0
+        if self.deletes:
+            windows = {}
+            for t, n in self.deletes:
+                windows[int(t // 10)] = windows.get(int(t // 10), 0) + n
+            peak = max(windows.values()) / 10.0
+        calls = dict(self.aws.calls)
+        return {
+            'python': platform.python_version(),
+            'config': dict([ (k, v) for k, v in vars(args).items() if k not in ('output',) ]),
+            'objects': len(objects),
+            'messages': self.sent,
+            'processed': self.deleted,
+            'msgs_per_sec': round(self.deleted / elapsed, 1) if elapsed else None,
+            'peak_msgs_per_sec': peak,
+            'drain_seconds': round(self.drained - self.traffic_end, 1),
+            'queue_depth_max': self.depth_max,
+            'lambdas': {
+                'invocations': self.monitor.invocations,
+                'containers': self.monitor.loaded,
+                'peak_concurrency': self.monitor.peak
+            },
+            'complete_latency': percentiles(complete),
+            'metric_latency': percentiles(metric),
+            'pairs_without_metrics': len([ o for o in objects if o['status'] == 'COMPLETED' ]) - len(metric),
+            'calls_per_object': round(float(sum(calls.values())) / max(len(objects), 1), 3),
+            'calls_by_operation': dict([ (op, round(float(n) / max(len(objects), 1), 3)) for op, n in sorted(calls.items()) ]),
+            'throttled': self.aws.throttled,
+            'errors': self.output.errors,
+            'warnings': self.output.warnings
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description='CRR Monitor end-to-end load test')
+    parser.add_argument('--rate', type=float, default=50, help='objects written per second')
+    parser.add_argument('--duration', type=float, default=60, help='seconds of traffic')
+    parser.add_argument('--buckets', type=int, default=1, help='replicated bucket pairs')
+    parser.add_argument('--size', default='lognormal:11:2', help='object size distribution, bytes')
+    parser.add_argument('--delay', default='uniform:2:30', help='replication time distribution, seconds')
+    parser.add_argument('--lag', default='uniform:0.5:3', help='event delivery delay distribution, seconds')
+    parser.add_argument('--order', default='source-first', choices=[ 'source-first', 'replica-first', 'mixed' ])
+    parser.add_argument('--reorder', type=float, default=1, help='seconds the source event trails the replica for replica-first')
+    parser.add_argument('--failed', type=float, default=0, help='fraction of objects that fail replication')
+    parser.add_argument('--non-replicated', type=float, default=0, help='fraction of objects no rule replicates')
+    parser.add_argument('--full-events', action='store_true', help='deliver whole CloudTrail records instead of the compact event')
+    parser.add_argument('--consumer', default='scheduled', choices=[ 'scheduled', 'esm' ])
+    parser.add_argument('--schedule', type=float, default=60, help='seconds between scheduled queue_handler runs')
+    parser.add_argument('--timeout', type=float, default=300, help='CRRMonitor lambda timeout, seconds')
+    parser.add_argument('--concurrency', type=int, default=5, help='event source mapping concurrency')
+    parser.add_argument('--batch-size', type=int, default=10, help='event source mapping batch size')
+    parser.add_argument('--maxtask', type=int, default=1800)
+    parser.add_argument('--maxspawn', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE', help='other lambda environment settings')
+    parser.add_argument('--housekeeping-every', type=float, default=300, help='seconds between Housekeeping runs')
+    parser.add_argument('--no-wait-metrics', dest='wait_metrics', action='store_false', help='do not wait for the last metrics to be posted')
+    parser.add_argument('--latency', action='append', default=[], metavar='SERVICE[.OPERATION]=MS', help='call latency')
+    parser.add_argument('--throttle', action='append', default=[], metavar='SERVICE[.OPERATION]=P', help='probability a call is throttled')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-o', '--output', help='write the report to this JSON file')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    report = LoadTest(args).run()
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
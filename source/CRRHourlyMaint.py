@@ -1,8 +1,14 @@
 from __future__ import print_function
 
-import boto3
 import os
-from datetime import datetime, timedelta
+import time
+from datetime import datetime
+# Unable to import module? You need to zip CRRHourlyMaint.py with
+# crr_time.py, crr_clients.py, crr_instrument.py and crr_scan.py!!
+import crr_time
+import crr_clients
+import crr_instrument
+import crr_scan
 
 def getparm (parmname, defaultval):
     try:
@@ -32,10 +38,30 @@ stattable = ddbtable + 'Statistics'
 timefmt = '%Y-%m-%dT%H:%M:%SZ'
 roundTo = getparm('roundTo', 300) # 5 minute buckets for CW metrics
 purge_thresh = getparm('purge_thresh', 24) # threshold in hours
+stat_parts = getparm('stat_parts', 10) # must match CRRMonitor's
+#
+# The incomplete transfers are found with a parallel scan (see crr_scan):
+# scan_segments threads each scan a segment of the table and queue the
+# items for scan_workers threads, which check them with head_object. At
+# most scan_queue items wait to be checked.
+#
+scan_segments = getparm('scan_segments', 4)
+scan_workers = getparm('scan_workers', 16)
+scan_queue = getparm('scan_queue', 1000)
+#
+# CRRMonitor marks a transfer pending (with a shard number, 0 to
+# pending_shards - 1) from its source event until its replica event.
+# When pending_index, on pending and start_datetime, is active only the
+# pending items are read: each shard is queried, oldest first, instead of
+# scanning the table. pending_shards must match CRRMonitor's.
+#
+pending_index = getparm('pending_index', 'pending-index')
+pending_shards = getparm('pending_shards', 10)
 client={
     's3': { 'service': 's3' },
     'ddb': { 'service': 'dynamodb'}
 }
+bucket_region={} # region of each source bucket seen, for its s3 client
 
 # =====================================================================
 # connect_clients
@@ -46,21 +72,40 @@ client={
 def connect_clients(clients_to_connect):
     for c in clients_to_connect:
         try:
-            if 'region' in clients_to_connect[c]:
-                clients_to_connect[c]['handle']=boto3.client(clients_to_connect[c]['service'], region_name=clients_to_connect[c]['region'])
-            else:
-                clients_to_connect[c]['handle']=boto3.client(clients_to_connect[c]['service'])
+            clients_to_connect[c]['handle']=crr_clients.get_client(clients_to_connect[c]['service'], clients_to_connect[c].get('region'))
         except Exception as e:
             print(e)
             print('Error connecting to ' + clients_to_connect[c]['service'])
             raise e
     return clients_to_connect
 
+# =====================================================================
+# get_s3client
+# ------------
+# Return the s3 client for the region a bucket is in, so head_object goes
+# straight to the bucket's region instead of being redirected there. The
+# bucket's region is looked up once per container. If it can't be we fall
+# back to the default client.
+# =====================================================================
+def get_s3client(bucket):
+    if not bucket in bucket_region:
+        try:
+            location = crr_clients.bucket_region(bucket)
+        except Exception as e:
+            print(e)
+            print('WARNING: Could not get the region of ' + bucket)
+            location = None
+        bucket_region[bucket] = location
+    if bucket_region[bucket]:
+        return crr_clients.get_client('s3', bucket_region[bucket])
+    return client['s3']['handle']
+
 # =====================================================================
 # lambda_handler
 # --------------
 # Look for failed replication and other anomalies.
 # =====================================================================
+@crr_instrument.invocation('CRRHourlyMaint')
 def lambda_handler(event, context):
     # -----------------------------------------------------------------
     # purge_item - removes old items
@@ -83,29 +128,25 @@ def lambda_handler(event, context):
     # -----------------------------------------------------------------
     # log_statistics
     #
-    def log_statistics(Src,Dst,Tstamp,Size,ET,roundTo):
+    def log_statistics(Src,Dst,timebucket,Size,ET):
         # -------------------------------------------------------------
         # Derive the statistic bucket from source/dest and time bucket
         # (5 minute rolling window)
         #
-        statbucket=Src + ':' + Dst
-        ts = datetime.strptime(Tstamp, timefmt)
-        secs = (ts.replace(tzinfo=None) - ts.min).seconds
-        rounding = (secs+roundTo/2) // roundTo * roundTo
-        ts = ts + timedelta(0,rounding-secs,-ts.microsecond)
-        statbucket += ':' + datetime.strftime(ts, timefmt)
+        statbucket=Src + ':' + Dst + ':' + timebucket
         # -------------------------------------------------------------
         # Init a dict to use to hold our attrs for DDB
         stat_exp_attrs = {}
         # -------------------------------------------------------------
         # Build the DDB UpdateExpression
-        stat_update_exp = 'SET timebucket = :t, source_bucket = :o, dest_bucket = :r ADD objects :a, size :c, elapsed :d'
+        stat_update_exp = 'SET timebucket = :t, statday = :y, source_bucket = :o, dest_bucket = :r ADD objects :a, size :c, elapsed :d'
         # -------------------------------------------------------------
         # push the first attr: s3Object
         stat_exp_attrs[':a'] = { 'N': '1' }
         stat_exp_attrs[':c'] = { 'N': Size }
         stat_exp_attrs[':d'] = { 'N': ET }
-        stat_exp_attrs[':t'] = { 'S': datetime.strftime(ts, timefmt) }
+        stat_exp_attrs[':t'] = { 'S': timebucket }
+        stat_exp_attrs[':y'] = { 'S': crr_time.statday(timebucket, statbucket, stat_parts) }
         stat_exp_attrs[':o'] = { 'S': Src }
         stat_exp_attrs[':r'] = { 'S': Dst }
         #print('s3Object: ' + key)
@@ -121,93 +162,124 @@ def lambda_handler(event, context):
             raise e
 
     # -----------------------------------------------------------------
-    # process_items - check each item returned by the scan
+    # process_item - check an item returned by the scan. Called by the
+    # scan's worker threads
     #
-    def process_items(items):
-        for i in items:
-
-            # Call head-object to check replication status
-            try:
-                response = client['s3']['handle'].head_object(
-                    Bucket=i['s3Origin']['S'],
-                    Key=i['s3Object']['S'])
-            except Exception as e:
-                print('Item no longer exists - purging: ' + i['ETag']['S'])
-                purge_item(i['ETag']['S'])
-                continue
-            # Init a dict to use to hold our attrs for DDB
-            ddb_exp_attrs = {}
-            # Build th e DDB UpdateExpression
-            ddb_update_exp = 'set s3Object = :a'
-            # push the first attr: s3Object
-            ddb_exp_attrs[':a'] = { 'S': i['s3Object']['S'] }
-
-            # Object still exists
-            headers = response['ResponseMetadata']['HTTPHeaders']
-
-            lastmod = datetime.strftime(response['LastModified'], timefmt)
-
-            if headers['x-amz-replication-status'] == 'COMPLETED':
-                print('Completed transfer found: ' + i['ETag']['S'])
-                ddb_update_exp += ', replication_status = :b'
-                ddb_exp_attrs[':b'] = { 'S': 'COMPLETED' }
-                #print(response)
-            elif headers['x-amz-replication-status'] == 'FAILED':
-                ddb_update_exp += ', replication_status = :b'
-                ddb_exp_attrs[':b'] = { 'S': 'FAILED' }
-                log_statistics(i['s3Origin']['S'],'FAILED',i['start_datetime']['S'],'0','1',300)
-
-            # Update the record in the DDB table
-            try:
-                client['ddb']['handle'].update_item(
-                    TableName = ddbtable,
-                    Key = { 'ETag': i['ETag'] },
-                    UpdateExpression = ddb_update_exp,
-                    ExpressionAttributeValues = ddb_exp_attrs)
-            except Exception as e:
-                print(e)
-                print('Table ' + ddbtable + ' update failed')
-                raise e
+    def process_item(i):
+        # Call head-object to check replication status
+        try:
+            response = get_s3client(i['s3Origin']['S']).head_object(
+                Bucket=i['s3Origin']['S'],
+                Key=i['s3Object']['S'])
+        except Exception as e:
+            print('Item no longer exists - purging: ' + i['ETag']['S'])
+            purge_item(i['ETag']['S'])
+            return
+        # Init a dict to use to hold our attrs for DDB
+        ddb_exp_attrs = {}
+        # Build th e DDB UpdateExpression
+        ddb_update_exp = 'set s3Object = :a'
+        # push the first attr: s3Object
+        ddb_exp_attrs[':a'] = { 'S': i['s3Object']['S'] }
+
+        # Object still exists
+        headers = response['ResponseMetadata']['HTTPHeaders']
+
+        lastmod = datetime.strftime(response['LastModified'], timefmt)
+
+        if headers['x-amz-replication-status'] == 'COMPLETED':
+            print('Completed transfer found: ' + i['ETag']['S'])
+            ddb_update_exp += ', replication_status = :b'
+            ddb_exp_attrs[':b'] = { 'S': 'COMPLETED' }
+            ddb_update_exp += ' remove pending'
+            #print(response)
+        elif headers['x-amz-replication-status'] == 'FAILED':
+            # Counted once: the item is not checked again
+            ddb_update_exp += ', replication_status = :b'
+            ddb_exp_attrs[':b'] = { 'S': 'FAILED' }
+            ddb_update_exp += ' remove pending'
+            log_statistics(i['s3Origin']['S'],'FAILED',crr_time.timebucket(i['start_datetime']['S'], 300),'0','1')
+
+        # Update the record in the DDB table
+        try:
+            client['ddb']['handle'].update_item(
+                TableName = ddbtable,
+                Key = { 'ETag': i['ETag'] },
+                UpdateExpression = ddb_update_exp,
+                ExpressionAttributeValues = ddb_exp_attrs)
+        except Exception as e:
+            print(e)
+            print('Table ' + ddbtable + ' update failed')
+            raise e
 
     # -----------------------------------------------------------------
     # check_incompletes
     #
     print('Checking for incomplete transfers')
-    check = datetime.utcnow() - timedelta(hours=1) # datetime object
-    checkstr= check.strftime(timefmt) # string object
+    checkstr= crr_time.format_time(time.time() - 3600) # an hour ago
     # Set scan filter attrs
     eav = {
         ":check": { "S": checkstr },
-        ":completed": { "S": "COMPLETED" }
+        ":completed": { "S": "COMPLETED" },
+        ":failed": { "S": "FAILED" }
     }
 
-    print('Reading from ' + ddbtable)
+    if index_active(ddbtable, pending_index):
+        print('Checking for pending items from ' + ddbtable + ' index ' + pending_index)
+        count = crr_scan.query(
+            client['ddb']['handle'],
+            [ {
+                'TableName': ddbtable,
+                'IndexName': pending_index,
+                'KeyConditionExpression': 'pending = :p and start_datetime < :check',
+                'ExpressionAttributeValues': {
+                    ':p': { 'S': str(shard) },
+                    ':check': eav[':check']
+                },
+                'Limit': 1000
+            } for shard in range(pending_shards) ],
+            process_item,
+            workers=scan_workers,
+            depth=scan_queue)
+        print('Checked ' + str(count) + ' pending items')
+        return
+
+    print('Checking for incomplete items from ' + ddbtable)
+    count = crr_scan.scan(
+        client['ddb']['handle'],
+        {
+            'TableName': ddbtable,
+            'FilterExpression': 'replication_status <> :completed and replication_status <> :failed and start_datetime < :check',
+            'ExpressionAttributeValues': eav,
+            'Limit': 1000
+        },
+        process_item,
+        segments=scan_segments,
+        workers=scan_workers,
+        depth=scan_queue)
+    print('Checked ' + str(count) + ' incomplete items')
+
+# =====================================================================
+# index_active
+# ------------
+# Whether a global secondary index of a table exists and is active. The
+# table is scanned instead until it is, for example while DynamoDB
+# backfills a newly added index.
+# =====================================================================
+def index_active(table, index):
     try:
-        response = client['ddb']['handle'].scan(
-            TableName=ddbtable,
-            ExpressionAttributeValues=eav,
-            FilterExpression="replication_status <> :completed and start_datetime < :check",
-            Limit=1000
-            )
+        response = client['ddb']['handle'].describe_table(TableName=table)
     except Exception as e:
         print(e)
-        print('Table ' + ddbtable + ' scan failed')
+        print('Table ' + table + ' describe failed')
         raise e
-
-    print('Checking for incomplete items from ' + ddbtable)
-    process_items(response['Items'])
-
-
-    while 'LastEvaluatedKey' in response:
-        response = client['ddb']['handle'].scan(
-            TableName=ddbtable,
-            FilterExpression="replication_status <> :completed and start_datetime < :check",
-            ExpressionAttributeValues=eav,
-            ExclusiveStartKey=response['LastEvaluatedKey'],
-            Limit=1000
-            )
-
-        process_items(response['Items'])
+    for i in response['Table'].get('GlobalSecondaryIndexes', []):
+        if i['IndexName'] == index and i['IndexStatus'] == 'ACTIVE':
+            return True
+    print('Index ' + index + ' of ' + table + ' is not active. Scanning')
+    return False
 
 ###### M A I N ######
+# Every scan worker can be using a client at the same time
+crr_clients.configure(max_pool_connections=scan_workers + scan_segments)
 client = connect_clients(client)
@@ -1,9 +1,24 @@
 from __future__ import print_function
 
 import json
-import boto3
+import math
 import os
-from datetime import datetime, timedelta
+import random
+import threading
+import time
+import Queue
+import zlib
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+# Unable to import module? You need to zip CRRMonitor.py with
+# crr_time.py, crr_clients.py, crr_instrument.py, crr_rules.py,
+# crr_metrics.py and crr_sketch.py!!
+import crr_time
+import crr_clients
+import crr_instrument
+import crr_rules
+import crr_metrics
+import crr_sketch
 
 def getparm (parmname, defaultval):
     try:
@@ -23,12 +38,13 @@ def getparm (parmname, defaultval):
 # recommended that you change this from the default 'CRRMonitor'
 appname = getparm('appname', 'CRRMonitor')
 
-# maxtask: Tune this parameter to get the most effective use of a single
-# instance of your lambda. It should be roughly 300,000 divided by the average
-# time required to process a single SQS record (160ms). Example: if it takes an
-# average of 500ms to process a single SQS record you would set this to
-# 300 / 0.5 = 600. This parameter tells the lambda when to ask for help:
-# If the queue depth is > maxtask it will spawn a copy of itself.
+# maxtask: the number of SQS records a single instance of your lambda can
+# be expected to process in a 300 second run. It should be roughly 300,000
+# divided by the average time required to process a single SQS record
+# (160ms). Example: if it takes an average of 500ms to process a single SQS
+# record you would set this to 300 / 0.5 = 600. This is only a starting
+# point: once the lambda has processed some messages it sizes itself from
+# the rate it actually measured.
 maxtask = getparm('maxtask',1800)
 
 # maxspawn: This parameter limits how many copies of itself the lambda
@@ -41,8 +57,112 @@ maxtask = getparm('maxtask',1800)
 # request limits accordingly.
 maxspawn = getparm('maxspawn',20)
 
+# workers: how many SQS messages a single instance of the lambda works on
+# at the same time. Almost all of the time spent on a message is waiting
+# for head_object and DynamoDB round trips, so keeping several messages in
+# flight multiplies throughput without spawning more lambdas. Set this
+# to 1 to process messages one at a time.
+workers = getparm('workers',8)
+
+# stat_flush: how often (seconds) the statistics collected from processed
+# messages are written to the Statistics table. Writes for the same bucket
+# pair and time bucket are combined into one until then, and processed
+# messages are not deleted from the queue until their statistics have been
+# written. Keep this well under the 60 second visibility timeout.
+stat_flush = getparm('stat_flush',20)
+
+# metrics_backend: where the replication statistics go.
+# 'ddb' - the Statistics table, from which Housekeeping posts them to
+# CloudWatch every 5 minutes.
+# 'emf' - straight to CloudWatch as Embedded Metric Format log lines, with
+# the same metrics, namespace and dimensions. The Statistics table is not
+# used.
+# 'both' - both of the above (to compare them).
+metrics_backend = getparm('metrics_backend','ddb')
+
+# stat_shards: spread the statistics for each bucket pair and time bucket
+# over this many items in the Statistics table, so that a busy pair does
+# not make a single item a hot key. Housekeeping adds the shards back up.
+# stat_shard_by: 'worker' - each lambda container writes to its own shard,
+# picked at random when it starts, so a flush is still one write per pair.
+# 'etag' - each object goes to the shard picked by its ETag, which spreads
+# the writes of a single lambda too.
+stat_shards = getparm('stat_shards',1)
+stat_shard_by = getparm('stat_shard_by','worker')
+# stat_parts: the statistics of a day are spread over this many keys of
+# the index Housekeeping reads them through (see crr_time.statday).
+# HourlyMaint and Housekeeping must use the same number.
+stat_parts = getparm('stat_parts',10)
+
+# prefetch: how many received batches of messages can be waiting while
+# the current batch is processed.
+# wait_time: seconds each receive long polls the queue (at most 20).
+# max_empty: the lambda stops reading after this many receives in a row
+# return nothing, so short gaps in traffic do not end the run.
+prefetch = getparm('prefetch',2)
+wait_time = getparm('wait_time',10)
+max_empty = getparm('max_empty',3)
+
+# visibility: seconds a received message stays hidden from other readers.
+# It is extended while the message is still being worked on.
+# deadline_margin: stop taking new messages when the lambda has less than
+# this many seconds left, so statistics can be written and processed
+# messages deleted before it times out. The receiver does not start a
+# poll that could end inside the margin, so it must be more than
+# wait_time plus the time the final flush and delete take.
+visibility = getparm('visibility',60)
+deadline_margin = getparm('deadline_margin',30)
+# sqs_slice: with an event source mapping (sqs_handler) the batch is
+# processed this many messages per worker at a time, checking
+# deadline_margin between slices.
+sqs_slice = getparm('sqs_slice',10)
+
+# table_ttl: how long (seconds) to trust that the DynamoDB tables exist
+# before checking again. A missing table is also detected straight away
+# from the errors returned by reads and writes.
+table_ttl = getparm('table_ttl',3600)
+
 # How long to keep records for completed transfers
 purge_thresh = getparm('purge_thresh',24)
+
+# pending_shards: while a transfer has its source event and not its
+# replica event its item has a pending attribute, the shard (0 to
+# pending_shards - 1) picked by its ETag. HourlyMaint reads the stuck
+# transfers from the sparse index on pending and start_datetime instead of
+# scanning the table. The shards spread the index writes. HourlyMaint must
+# use the same number.
+pending_shards = getparm('pending_shards',10)
+
+# stream_to_kinesis: Yes if Housekeeping archives completed transfers to
+# Firehose (ArchiveToS3 in the template). Only then is end_bucket written.
+# archive_parts: end_bucket is the 5 minute window a transfer completed
+# in and a part (0 to archive_parts - 1) picked by its ETag, to spread the
+# writes to the index Housekeeping archives from. Housekeeping must use
+# the same number.
+stream_to_kinesis = getparm('stream_to_kinesis','No')
+archive_parts = getparm('archive_parts',10)
+
+# dedup_size: how many recently processed events each container remembers.
+# SNS, SQS and CloudTrail all deliver at least once, and a replica can log
+# more than one event for the same object version. A repeat is deleted from
+# the queue without any S3 or DynamoDB work. 0 turns this off.
+# dedup_ttl: also record each event in the DynamoDB table for this many
+# seconds, so repeats delivered to other lambdas are caught too. This
+# costs a write per event. 0 turns this off.
+dedup_size = getparm('dedup_size',10000)
+dedup_ttl = getparm('dedup_ttl',0)
+
+# rules_ttl: seconds between reloads of the replication rules of the
+# buckets in the account. Events for objects that no rule replicates are
+# deleted from the queue without calling head_object. 0 turns this off.
+rules_ttl = getparm('rules_ttl',600)
+
+# agent_regions: comma separated list of the regions that have source or
+# replica buckets. S3 clients for these regions are created when the
+# container starts instead of on the first message from each region. If
+# it is not set, and rules_ttl is not 0, the regions of the buckets in the
+# replication rules are used.
+agent_regions = getparm('agent_regions','')
 #
 # ddbtable and stattable: name of the DynamoDB tables. The tables are
 # created in the CloudFormation stack and defaults to the value of appname.
@@ -53,16 +173,28 @@ stattable = ddbtable + 'Statistics'
 # is created in the CloudFormation template. Do not change this without
 # changing the template
 queue = appname + 'Queue'
-# timefmt: used to format timestamps. Do not change.
-timefmt = '%Y-%m-%dT%H:%M:%SZ'
 # client: defines the api client connections to create
 client={
     'ddb': { 'service': 'dynamodb' },
     'sqs': { 'service': 'sqs' },
     'lbd': { 'service': 'lambda' }
 }
-s3client={} # will hold client handle for s3 per region
+worker_shard=random.randrange(max(stat_shards, 1)) # this container's statistics shard
 initfail={} # hash of source buckets to handle FAILED counter initialization
+statistics={} # statistic totals not yet written, keyed by statbucket
+logged=[] # ETags of the pairs counted in statistics
+claimed=[] # events whose dedup_ttl claims are extended once statistics are written
+tables_verified={} # time each DynamoDB table was last found to exist
+inflight={} # messages received but not yet deleted or released, by ReceiptHandle
+seen=OrderedDict() # events recently processed, oldest first
+dedup_counts={ 'hits': 0, 'misses': 0, 'table_hits': 0 }
+msg_rate=None # messages/sec one lambda managed in earlier runs of this container
+# Messages are processed on a thread pool. Updating the dicts above is not
+# thread safe, so they are guarded by these locks. (crr_clients creates
+# the boto3 clients safely.)
+statlock=threading.Lock() # guards initfail, statistics, logged and claimed
+inflightlock=threading.Lock()
+seenlock=threading.Lock() # guards seen and dedup_counts
 
 # =====================================================================
 # connect_clients
@@ -73,88 +205,266 @@ initfail={} # hash of source buckets to handle FAILED counter initialization
 def connect_clients(clients_to_connect):
     for c in clients_to_connect:
         try:
-            if 'region' in clients_to_connect[c]:
-                clients_to_connect[c]['handle']=boto3.client(clients_to_connect[c]['service'], region_name=clients_to_connect[c]['region'])
-            else:
-                clients_to_connect[c]['handle']=boto3.client(clients_to_connect[c]['service'])
+            clients_to_connect[c]['handle']=crr_clients.get_client(clients_to_connect[c]['service'], clients_to_connect[c].get('region'))
         except Exception as e:
             print(e)
             print('Error connecting to ' + clients_to_connect[c]['service'])
             raise e
     return clients_to_connect
 
-def message_handler(event):
-    def log_statistics(Src,Dst,Tstamp,Size,ET,roundTo):
-        # -------------------------------------------------------------
-        # Derive the statistic bucket from source/dest and time bucket
-        # (5 minute rolling window)
-        #
-        statbucket=Src + ':' + Dst
-        ts = datetime.strptime(Tstamp, timefmt)
-        secs = (ts.replace(tzinfo=None) - ts.min).seconds
-        rounding = (secs+roundTo/2) // roundTo * roundTo
-        ts = ts + timedelta(0,rounding-secs,-ts.microsecond)
-        timebucket = datetime.strftime(ts, timefmt)
-        statbucket += ':' + timebucket
-        # -------------------------------------------------------------
-        # Init a dict to use to hold our attrs for DDB
-        stat_exp_attrs = {}
-        # -------------------------------------------------------------
-        # Build the DDB UpdateExpression
-        stat_update_exp = 'SET timebucket = :t, source_bucket = :o, dest_bucket = :r ADD objects :a, size :c, elapsed :d'
-        # -------------------------------------------------------------
-        # push the first attr: s3Object
-        stat_exp_attrs[':a'] = { 'N': '1' }
-        stat_exp_attrs[':c'] = { 'N': Size }
-        stat_exp_attrs[':d'] = { 'N': ET }
-        stat_exp_attrs[':t'] = { 'S': timebucket }
-        stat_exp_attrs[':o'] = { 'S': Src }
-        stat_exp_attrs[':r'] = { 'S': Dst }
-        #print('s3Object: ' + key)
-        try:
-            response = client['ddb']['handle'].update_item(
-                TableName = stattable,
-                Key = { 'OriginReplicaBucket': { 'S': statbucket } },
-                UpdateExpression = stat_update_exp,
-                ExpressionAttributeValues = stat_exp_attrs)
-        except Exception as e:
-            print(e)
-            print('Table ' + stattable + ' update failed')
-            raise e
+# =====================================================================
+# verify_table
+# ------------
+# Check that a DynamoDB table exists. describe_table is a slow, rate
+# limited control plane call so a successful check is trusted for
+# table_ttl seconds. Raises if the table does not exist.
+# =====================================================================
+def verify_table(table):
+    if tables_verified.get(table, 0) + table_ttl > time.time():
+        return
+    try:
+        client['ddb']['handle'].describe_table(
+            TableName = table
+        )
+    except Exception as e:
+        print(e)
+        print('Table ' + table + ' does not exist - need to create it')
+        raise e
+    tables_verified[table] = time.time()
+
+# =====================================================================
+# check_missing_table
+# -------------------
+# Called with the exception from a get_item/update_item. If the table was
+# not found forget that it was verified and check it again now.
+# =====================================================================
+def check_missing_table(e, table):
+    if error_code(e) == 'ResourceNotFoundException':
+        tables_verified.pop(table, None)
+        verify_table(table)
+
+# The AWS error code from a failed call, if there is one
+def error_code(e):
+    if not hasattr(e, 'response'):
+        return None
+    return e.response.get('Error', {}).get('Code')
+
+# =====================================================================
+# log_statistics
+# --------------
+# Add a completed (or FAILED) replication to the totals for its
+# Src:Dst:timebucket statistic, and count its elapsed time and throughput
+# in the statistic's latency sketches (see crr_sketch). Nothing is written
+# here: the totals for every message handled by this invocation are summed
+# in memory and written with one ADD per statistic by flush_statistics.
+# etag picks the shard when stat_shard_by is 'etag'.
+# =====================================================================
+def log_statistics(Src,Dst,Tstamp,Size,ET,roundTo,etag=None):
+    # -------------------------------------------------------------
+    # Derive the statistic bucket from source/dest and time bucket
+    # (5 minute rolling window)
+    #
+    timebucket = crr_time.timebucket(Tstamp, roundTo)
+    shard = stat_shard(etag)
+    statbucket = Src + ':' + Dst + ':' + timebucket + shard
+
+    bins = {}
+    if Dst != 'FAILED':
+        for attr in crr_sketch.replication_bins(int(Size), int(ET)):
+            bins[attr] = 1
+
+    with statlock:
+        add_statistic(statbucket, Src, Dst, timebucket, 1, int(Size), int(ET), bins)
 
         # Initialize a counter for failed replications for the source bucket
-        if not Src in initfail:
-            initfail[Src]='foo'
-        if Dst != 'FAILED' and initfail[Src] != timebucket:
+        if Dst != 'FAILED' and initfail.get(Src) != timebucket:
             print('Initializing FAILED bucket for ' + Src + ':' + timebucket)
-            statbucket=Src + ':FAILED:' + timebucket
-            stat_exp_attrs = {}
-            # -------------------------------------------------------------
-            # Build the DDB UpdateExpression
-            stat_update_exp = 'SET timebucket = :t, source_bucket = :o, dest_bucket = :r ADD objects :a, size :c, elapsed :d'
-            # -------------------------------------------------------------
-            # push the first attr: s3Object
-            stat_exp_attrs[':a'] = { 'N': '0' }
-            stat_exp_attrs[':c'] = { 'N': '1' }
-            stat_exp_attrs[':d'] = { 'N': '1' }
-            stat_exp_attrs[':t'] = { 'S': timebucket }
-            stat_exp_attrs[':o'] = { 'S': Src }
-            stat_exp_attrs[':r'] = { 'S': 'FAILED' }
-            #print('s3Object: ' + key)
-            try:
-                response = client['ddb']['handle'].update_item(
-                    TableName = stattable,
-                    Key = { 'OriginReplicaBucket': { 'S': statbucket } },
-                    UpdateExpression = stat_update_exp,
-                    ExpressionAttributeValues = stat_exp_attrs)
-                initfail[Src] = timebucket
-            except Exception as e:
-                print(e)
-                print('Table ' + stattable + ' update failed')
-                raise e
-
-        #print('Stats written to ' + statbucket)
+            initfail[Src] = timebucket
+            add_statistic(Src + ':FAILED:' + timebucket + shard, Src, 'FAILED', timebucket, 0, 1, 1)
+
+# Suffix for the key of a statistic: '' when not sharding, otherwise
+# '#' and the shard number
+def stat_shard(etag):
+    if stat_shards <= 1:
+        return ''
+    if stat_shard_by == 'etag' and etag:
+        return '#' + str((zlib.crc32(etag) & 0xffffffff) % stat_shards)
+    return '#' + str(worker_shard)
+
+# Call with statlock held
+def add_statistic(statbucket, Src, Dst, timebucket, objects, size, elapsed, bins=None):
+    if not statbucket in statistics:
+        statistics[statbucket] = {
+            'source_bucket': Src,
+            'dest_bucket': Dst,
+            'timebucket': timebucket,
+            'objects': 0,
+            'size': 0,
+            'elapsed': 0,
+            'bins': {}
+        }
+    stat = statistics[statbucket]
+    stat['objects'] += objects
+    stat['size'] += size
+    stat['elapsed'] += elapsed
+    if bins:
+        add_bins(stat['bins'], bins)
+
+def add_bins(total, bins):
+    for attr, n in bins.items():
+        total[attr] = total.get(attr, 0) + n
+
+# =====================================================================
+# flush_statistics
+# ----------------
+# Write the totals collected by log_statistics to the Statistics table,
+# one update_item per statistic, and/or log them as EMF metrics (see
+# metrics_backend). This must complete before the messages that produced
+# the totals are deleted from the queue. If any write fails the totals
+# that were not written are kept for the next flush and the exception is
+# raised so the caller leaves the messages on the queue.
+#
+# Once every total is written the pairs they count are marked
+# stats_logged (see complete_pair) and the dedup_ttl claims of the events
+# are extended. Until then a redelivered message is processed again and
+# logs its pair again.
+# =====================================================================
+def flush_statistics():
+    with statlock:
+        pending = statistics.items()
+        statistics.clear()
+        etags = logged[:]
+        del logged[:]
+        idents = claimed[:]
+        del claimed[:]
+
+    if pending and metrics_backend == 'emf':
+        emit_metrics(pending)
+    elif pending:
+        failed = map_pool(write_statistic, pending)
+        failed = [ stat for stat in failed if stat ]
+
+        # Totals that are kept for the next flush are logged then
+        if metrics_backend == 'both':
+            emit_metrics([ stat for stat in pending if stat not in failed ])
+
+        if failed:
+            with statlock:
+                for statbucket, stat in failed:
+                    add_statistic(statbucket, stat['source_bucket'], stat['dest_bucket'], stat['timebucket'],
+                        stat['objects'], stat['size'], stat['elapsed'], stat['bins'])
+                logged.extend(etags)
+                claimed.extend(idents)
+            raise Exception(str(len(failed)) + ' of ' + str(len(pending)) + ' statistics could not be written')
+
+    map_pool(mark_logged, etags)
+    map_pool(extend_claim, idents)
+
+# Mark a pair's statistics as written. If this fails a redelivery of one
+# of its messages would count it twice, which is better than not at all.
+def mark_logged(etag):
+    try:
+        client['ddb']['handle'].update_item(
+            TableName = ddbtable,
+            Key = { 'ETag': { 'S': etag } },
+            UpdateExpression = 'set stats_logged = :l remove stats_due',
+            ConditionExpression = 'attribute_exists(ETag)',
+            ExpressionAttributeValues = { ':l': { 'BOOL': True } })
+    except Exception as e:
+        if error_code(e) == 'ConditionalCheckFailedException':
+            # Purged already
+            return
+        print(e)
+        print('WARNING: could not mark ' + etag + ' in ' + ddbtable)
+
+# Returns the (statbucket, stat) pair if it could not be written
+def write_statistic(pair):
+    statbucket, stat = pair
+    # -------------------------------------------------------------
+    # Init a dict to use to hold our attrs for DDB
+    stat_exp_attrs = {}
+    # -------------------------------------------------------------
+    # Build the DDB UpdateExpression
+    stat_update_exp = 'SET timebucket = :t, statday = :y, source_bucket = :o, dest_bucket = :r ADD objects :a, size :c, elapsed :d'
+    # -------------------------------------------------------------
+    # push the totals
+    stat_exp_attrs[':a'] = { 'N': str(stat['objects']) }
+    stat_exp_attrs[':c'] = { 'N': str(stat['size']) }
+    stat_exp_attrs[':d'] = { 'N': str(stat['elapsed']) }
+    stat_exp_attrs[':t'] = { 'S': stat['timebucket'] }
+    # Housekeeping finds due statistics by day and time bucket
+    stat_exp_attrs[':y'] = { 'S': crr_time.statday(stat['timebucket'], statbucket, stat_parts) }
+    stat_exp_attrs[':o'] = { 'S': stat['source_bucket'] }
+    stat_exp_attrs[':r'] = { 'S': stat['dest_bucket'] }
+    # and the sketch bins
+    for n, attr in enumerate(sorted(stat['bins'])):
+        stat_update_exp += ', ' + attr + ' :k' + str(n)
+        stat_exp_attrs[':k' + str(n)] = { 'N': str(stat['bins'][attr]) }
+    try:
+        client['ddb']['handle'].update_item(
+            TableName = stattable,
+            Key = { 'OriginReplicaBucket': { 'S': statbucket } },
+            UpdateExpression = stat_update_exp,
+            ExpressionAttributeValues = stat_exp_attrs)
+    except Exception as e:
+        print(e)
+        print('Table ' + stattable + ' update failed')
+        try:
+            check_missing_table(e, stattable)
+        except Exception:
+            pass
+        return pair
+    return None
+
+# =====================================================================
+# emit_metrics
+# ------------
+# Print the metrics for the statistics as EMF log lines, for each bucket
+# pair and time bucket (shards are added together).
+# =====================================================================
+def emit_metrics(pending):
+    totals = {}
+    for statbucket, stat in pending:
+        pair = (stat['source_bucket'], stat['dest_bucket'], stat['timebucket'])
+        if pair not in totals:
+            totals[pair] = [ 0, 0, 0, {} ]
+        totals[pair][0] += stat['objects']
+        totals[pair][1] += stat['size']
+        totals[pair][2] += stat['elapsed']
+        add_bins(totals[pair][3], stat['bins'])
+    for (Src, Dst, timebucket), (objects, size, elapsed, bins) in totals.items():
+        for doc in crr_metrics.emf_documents(Src, Dst, crr_time.parse_time(timebucket), objects, size, elapsed, bins):
+            print(doc)
+
+# =====================================================================
+# message_handler
+# ---------------
+# Process a single event: check the object and record it in the DDB table.
+# An event that has already been processed is skipped.
+# =====================================================================
+def message_handler(event):
+    ev = unwrap_event(event)
+    if not may_replicate(ev):
+        return
+    ident = event_identity(ev)
+    if is_duplicate(ident):
+        return
+    try:
+        msg = prepare_message(ev)
+        if msg:
+            record_message(msg)
+    except Exception as e:
+        release_event(ident)
+        raise e
+    remember_event(ident)
 
+# =====================================================================
+# unwrap_event
+# ------------
+# Find the event in whatever it was delivered in, and return the fields of
+# it we use (see compact_event).
+# =====================================================================
+def unwrap_event(event):
     # So this will work with CloudWatch Events directly or via SNS, let's look
     #   at the structure of the incoming JSON. Note that this has not been
     #   tested with CloudWatch events directly, but should be a simple matter.
@@ -189,35 +499,184 @@ def message_handler(event):
         evdata = json.loads(event['Message'])
     else:
         evdata = event
+    return compact_event(evdata)
+
+# =====================================================================
+# compact_event
+# -------------
+# The CRRAgent rules forward just the fields of the CloudTrail record we
+# use (see CRRdeployagent):
+# {
+#   "region": "us-east-2",
+#   "bucket": "mybucket",
+#   "key": "path/to/object",
+#   "eventTime": "2017-02-09T13:56:03Z",
+#   "eventID": "8d2b6c34-9a4b-4c59-a1b6-4f0cb37a0e1f",
+#   "version": "3HL4kqtJlcpXroDTDmJ.rmSpXd3dIbrHY"
+# }
+# version is the object version, null (or missing, from rules set up
+# before it was forwarded) if the bucket has none. Whole CloudWatch event
+# records, from rules set up by older versions of the deploy agent, are
+# cut down to the same.
+# =====================================================================
+def compact_event(evdata):
+    if 'detail' not in evdata:
+        return evdata
+    detail = evdata['detail']
+    ev = {
+        'region': evdata['region'],
+        'bucket': detail['requestParameters']['bucketName'],
+        'key': detail['requestParameters']['key'],
+        'eventTime': detail['eventTime'],
+        'eventID': detail.get('eventID')
+    }
+    version = (detail.get('responseElements') or {}).get('x-amz-version-id')
+    if version:
+        ev['version'] = version
+    return ev
+
+# Can any replication rule apply to the object in this event?
+def may_replicate(ev):
+    if not rules_ttl:
+        return True
+    return crr_rules.may_replicate(ev['bucket'], ev['key'])
+
+# Create the S3 clients for the regions of the replicated buckets. This
+# only saves time on the first events, so failing is not an error.
+def prewarm_regions():
+    try:
+        crr_clients.prewarm('s3', crr_rules.regions())
+    except Exception as e:
+        print(e)
+        print('WARNING: could not create the S3 clients of the replicated regions')
+
+# =====================================================================
+# event_identity
+# --------------
+# What makes two events the same: the object, and its version if the
+# event has one. Otherwise the CloudTrail event ID, which is the same on
+# every delivery of one event.
+# =====================================================================
+def event_identity(ev):
+    version = ev.get('version') or ev.get('eventID')
+    if not version:
+        return None
+    return (ev['bucket'], ev['key'], version)
+
+# =====================================================================
+# is_duplicate / remember_event / release_event
+# ---------------------------------------------
+# Recently processed events are kept in seen, least recently used first,
+# and are only added once they have been processed, so a retry after a
+# failure is not mistaken for a repeat.
+#
+# With dedup_ttl an event is also claimed in the DynamoDB table before it
+# is processed, with a conditional put that fails if another lambda holds
+# it. A claim lasts visibility seconds, until processing finishes and it
+# is extended to dedup_ttl seconds once its statistics are written (see
+# flush_statistics), and is removed if processing fails.
+# Expired claims may not have been deleted by DynamoDB TTL yet so the
+# condition checks itemttl too. If the table cannot be reached the event is
+# processed anyway.
+# =====================================================================
+def is_duplicate(ident):
+    if not ident:
+        return False
+    with seenlock:
+        if ident in seen:
+            seen[ident] = seen.pop(ident)
+            dedup_counts['hits'] += 1
+            return True
+        dedup_counts['misses'] += 1
+    if not dedup_ttl:
+        return False
+
+    now = int(time.time())
+    try:
+        client['ddb']['handle'].put_item(
+            TableName = ddbtable,
+            Item = { 'ETag': dedup_key(ident), 'itemttl': { 'N': str(now + visibility) } },
+            ConditionExpression = 'attribute_not_exists(ETag) or itemttl < :n',
+            ExpressionAttributeValues = { ':n': { 'N': str(now) } })
+    except Exception as e:
+        if error_code(e) == 'ConditionalCheckFailedException':
+            with seenlock:
+                dedup_counts['table_hits'] += 1
+            return True
+        print(e)
+        print('WARNING: could not check ' + ddbtable + ' for duplicate events')
+    return False
+
+def remember_event(ident):
+    if not ident:
+        return
+    if dedup_size > 0:
+        with seenlock:
+            seen[ident] = True
+            while len(seen) > dedup_size:
+                seen.popitem(last=False)
+    if dedup_ttl:
+        # Until the statistics are written the claim only lasts visibility
+        # seconds, so a redelivery after this lambda failed is processed
+        with statlock:
+            claimed.append(ident)
 
+def extend_claim(ident):
+    try:
+        client['ddb']['handle'].update_item(
+            TableName = ddbtable,
+            Key = { 'ETag': dedup_key(ident) },
+            UpdateExpression = 'SET itemttl = :t',
+            ExpressionAttributeValues = { ':t': { 'N': str(int(time.time()) + dedup_ttl) } })
+    except Exception as e:
+        print(e)
+        print('WARNING: could not record event in ' + ddbtable)
+
+def release_event(ident):
+    if not ident or not dedup_ttl:
+        return
+    try:
+        client['ddb']['handle'].delete_item(
+            TableName = ddbtable,
+            Key = { 'ETag': dedup_key(ident) })
+    except Exception as e:
+        print(e)
+        print('WARNING: could not release event in ' + ddbtable)
+
+# Event records share the table with transfers. Their keys cannot clash:
+# transfers are keyed by etag:version.
+def dedup_key(ident):
+    return { 'S': 'event:' + '/'.join(ident) }
+
+# Hit/miss counts since the container started
+def dedup_summary():
+    with seenlock:
+        return 'Duplicates: ' + str(dedup_counts['hits']) + ' cached, ' + str(dedup_counts['table_hits']) + ' from ' + ddbtable + ', ' + str(dedup_counts['misses']) + ' misses'
+
+# =====================================================================
+# prepare_message
+# ---------------
+# Everything we need to know about the event before touching DynamoDB.
+# Returns None when there is nothing to record: the object is gone or is
+# not replicated.
+# =====================================================================
+def prepare_message(ev):
     #-----------------------------------------------------------------
     #
     # Collect the data we want for the DynamoDB table
     #
-    region = evdata['region']
-    bucket = evdata['detail']['requestParameters']['bucketName']
-    key = evdata['detail']['requestParameters']['key']
+    region = ev['region']
+    bucket = ev['bucket']
+    key = ev['key']
 
     # This timestamp is from the CW Event record and is most accurate
-    now = evdata['detail']['eventTime']
-
-    # Init a dict to use to hold our attrs for DDB
-    ddb_exp_attrs = {}
-    # Build th e DDB UpdateExpression
-    ddb_update_exp = 'set s3Object = :a'
-    # push the first attr: s3Object
-    ddb_exp_attrs[':a'] = { 'S': key }
-
-
-    # establish s3 client per region, but only once.
-    if not region in s3client:
-        s3client[region]= boto3.client('s3',region)
+    now = ev['eventTime']
 
     # -----------------------------------------------------------------
     # Do a head_object. If the object no longer exists just return.
     #
     try:
-        response = s3client[region].head_object(
+        response = crr_clients.get_client('s3', region).head_object(
             Bucket=bucket,
             Key=key
             )
@@ -225,7 +684,7 @@ def message_handler(event):
         # Need to improve this to recognize specifically a 404
         print('Error ' + str(e))
         if e == 404:
-            print('WARNING: Object no longer exists - ' + evdata['detail']['requestParameters']['bucketName'] + '/' + evdata['detail']['requestParameters']['key'])
+            print('WARNING: Object no longer exists - ' + bucket + '/' + key)
 
         print('Removing from queue / ignoring')
         return
@@ -265,6 +724,9 @@ def message_handler(event):
 
     # repstatus is a pointer to the headers (for code clarity)
     repstatus = headers['x-amz-replication-status']
+    if repstatus not in ('REPLICA', 'COMPLETED', 'FAILED', 'PENDING'):
+        print('Unknown Replication Status: ' + repstatus)
+        raise Exception('Unknown Replication Status')
 
     # -----------------------------------------------------------------
     # Verify that the DynamoDB table exists. Note: we could create it
@@ -272,79 +734,83 @@ def message_handler(event):
     #  Better to create it in the CFn template and handle this as a
     #  failure condition
     #
-    try:
-        response = client['ddb']['handle'].describe_table(
-            TableName = ddbtable
-        )
-    except Exception as e:
-        print(e)
-        print('Table ' + ddbtable + ' does not exist - need to create it')
-        raise e
+    verify_table(ddbtable)
 
-    # Update object size
-    objsize = headers['content-length']
-    ddb_update_exp += ', ObjectSize = :s'
-    ddb_exp_attrs[':s'] = { 'N': objsize }
+    return {
+        'bucket': bucket,
+        'key': key,
+        'now': now,
+        'now_secs': crr_time.parse_time(now),
+        'repstatus': repstatus,
+        'objsize': headers['content-length'],
+        'ETag': { 'S': headers['etag'][1:-1] + ':' + headers['x-amz-version-id'][1:-1] }
+    }
 
-    ETag = { 'S': headers['etag'][1:-1] + ':' + headers['x-amz-version-id'][1:-1] }
+# =====================================================================
+# record_message
+# --------------
+# Write a prepared event to the DDB table with a single update_item. The
+# record is not read first: the write sets this event's side of the pair
+# and returns the whole record, which tells us whether both sides are now
+# known. If so, complete_pair works out the elapsed time.
+#
+# Note that the source and replica each only set their own fields, using
+# if_not_exists for the timestamps so a repeated event does not move them.
+# Events for the same object can be processed in any order, or at the same
+# time by different lambdas.
+# =====================================================================
+def record_message(msg):
+    bucket = msg['bucket']
+    now = msg['now']
+    repstatus = msg['repstatus']
+    objsize = msg['objsize']
+    ETag = msg['ETag']
 
-    # -----------------------------------------------------------------
-    # If the object already has a DDB record get it
-    #
-    ddbdata = client['ddb']['handle'].get_item(
-        TableName = ddbtable,
-        Key = { 'ETag': ETag },
-        ConsistentRead = True
-        )
+    # Init a dict to use to hold our attrs for DDB
+    ddb_exp_attrs = {}
+    # Build th e DDB UpdateExpression
+    ddb_update_exp = 'set s3Object = :a'
+    # push the first attr: s3Object
+    ddb_exp_attrs[':a'] = { 'S': msg['key'] }
 
-    # Debug
-    ddbitem = {}
-    if 'Item' in ddbdata:
-        ddbitem = ddbdata['Item']
-        #print("DDB record: " + json.dumps(ddbitem, indent=2))
+    # Update object size
+    ddb_update_exp += ', ObjectSize = :s'
+    ddb_exp_attrs[':s'] = { 'N': objsize }
 
     #
     # Is this a REPLICA? Use timestamp as completion time
     #
     # Note: replica only updates s3Replica, replication_status, and end_datetime.
     #
-    # We do this so we don't have to handle conditional update of fields that might get
-    # stepped on of the events are processed out of order.
-    #
     if repstatus == 'REPLICA':
         # print('Processing a REPLICA object: ' + ETag['S'])
         ddb_update_exp += ', s3Replica = :d'
         ddb_exp_attrs[':d'] = { 'S': bucket }
         #print('s3Replica: ' + bucket)
 
-        ddb_update_exp += ', end_datetime = :e'
+        ddb_update_exp += ', end_datetime = if_not_exists(end_datetime, :e)'
         ddb_exp_attrs[':e'] = { 'S': now } # 'now' is from the event data
         #print('end_datetime: ' + now)
 
+        # The 5 minute window end_datetime is in, and a part. Housekeeping
+        # archives completed transfers a window at a time through an
+        # index on it.
+        if stream_to_kinesis == 'Yes':
+            ddb_update_exp += ', end_bucket = if_not_exists(end_bucket, :w)'
+            ddb_exp_attrs[':w'] = { 'S': crr_time.format_time(crr_time.window_start(msg['now_secs'], 300)) + '#' + archive_part(ETag['S']) }
+
         # Set the ttl
-        purge = datetime.strptime(now, timefmt) - timedelta(hours=purge_thresh) # datetime object
-        ttl = purge.strftime('%s')
+        ttl = msg['now_secs'] - purge_thresh * 3600
         ddb_update_exp += ', itemttl = :p'
-        ddb_exp_attrs[':p'] = { 'N': ttl }
+        ddb_exp_attrs[':p'] = { 'N': str(ttl) }
 
         # If this is a replica then status is COMPLETE
         ddb_update_exp += ', replication_status = :b'
         ddb_exp_attrs[':b'] = { 'S': 'COMPLETED' }
         #print('replication_status: COMPLETED (implied)')
 
-        if 'start_datetime' in ddbitem and 'crr_rate' not in ddbitem:
-            etime = datetime.strptime(now, timefmt) - datetime.strptime(ddbitem['start_datetime']['S'], timefmt)
-            etimesecs = ( etime.days * 24 * 60 * 60 ) + etime.seconds
-            #print("Calculate elapsed time in seconds")
-            crr_rate = int(objsize) * 8 / (etimesecs + 1) # Add 1 to prevent /0 errors
-            ddb_update_exp += ', crr_rate = :r'
-            ddb_exp_attrs[':r'] = { 'N': str(crr_rate) }
-            #print('crr_rate: ', crr_rate)
-
-            ddb_update_exp += ', elapsed = :t'
-            ddb_exp_attrs[':t'] = { 'N': str(etimesecs) }
-            #print('elapsed: ', etimesecs)
-            log_statistics(ddbitem['s3Origin']['S'],bucket,ddbitem['start_datetime']['S'],objsize,str(etimesecs),300)
+        # No longer pending
+        ddb_update_exp += ' remove pending'
     # -----------------------------------------------------------------
     # Or is this a SOURCE? Use timestamp as replication start time
     #
@@ -357,64 +823,297 @@ def message_handler(event):
         # If this is not a replica then do not report status. It's not important and
         # makes the DynamoDB update much more complicated. Just get the start time
         #
-        # We also do not care what the status is. If it has a FAILED status we could
-        # write code to send a notification, but that's outside our scope.
-        if repstatus == 'COMPLETED' or repstatus == 'FAILED' or repstatus == 'PENDING':
-            # print('Processing a ORIGINAL object: ' + ETag['S'] + ' status: ' + repstatus)
-            ddb_update_exp += ', start_datetime = :g'
-            ddb_exp_attrs[':g'] = { 'S': now }
-            # ---------------------------------------------------------
-            # If we already got the replica event...
-            #
-            if 'end_datetime' in ddbitem and 'crr_rate' not in ddbitem:
-                etime = datetime.strptime(ddbitem['end_datetime']['S'], timefmt) - datetime.strptime(now, timefmt)
-                etimesecs = ( etime.days * 24 * 60 * 60 ) + etime.seconds
-                #print("Calculate elapsed time in seconds")
-                crr_rate = int(objsize) * 8 / (etimesecs + 1) # Add 1 to prevent /0 errors
-                ddb_update_exp += ', crr_rate = :r'
-                ddb_exp_attrs[':r'] = { 'N': str(crr_rate) }
-                #print('crr_rate: ', crr_rate)
-
-                # Set the ttl
-                purge = datetime.strptime(ddbitem['end_datetime']['S'], timefmt) - timedelta(hours=purge_thresh) # datetime object
-                ttl = purge.strftime('%s')
-                ddb_update_exp += ', itemttl = :p'
-                ddb_exp_attrs[':p'] = { 'N': ttl }
-
-                ddb_update_exp += ', elapsed = :t'
-                ddb_exp_attrs[':t'] = { 'N': str(etimesecs) }
-                #print('elapsed: ', etimesecs)
-                log_statistics(bucket,ddbitem['s3Replica']['S'],ddbitem['end_datetime']['S'],objsize,str(etimesecs),300)
-            # ---------------------------------------------------------
-            # We did not yet get the replica event
-            #
-            else:
-                if repstatus == 'FAILED':
-                    # If replication failed this is the only time we will see this object.
-                    # Update the status to FAILED
-                    ddb_update_exp += ', replication_status = :b'
-                    ddb_exp_attrs[':b'] = { 'S': 'FAILED' }
-                    log_statistics(bucket,'FAILED',now,'0','1',300)
-                    print("replication FAILED")
-
-        else:
-            print('Unknown Replication Status: ' + repstatus)
-            raise Exception('Unknown Replication Status')
+        # We also do not care what the status is (COMPLETED, FAILED or PENDING). If it
+        # has a FAILED status we could write code to send a notification, but that's
+        # outside our scope.
+        #
+        # print('Processing a ORIGINAL object: ' + ETag['S'] + ' status: ' + repstatus)
+        ddb_update_exp += ', start_datetime = if_not_exists(start_datetime, :g)'
+        ddb_exp_attrs[':g'] = { 'S': now }
 
+        # Pending until the replica event. If it came first the write that
+        # completes the pair removes this again.
+        ddb_update_exp += ', pending = :h'
+        ddb_exp_attrs[':h'] = { 'S': pending_shard(ETag['S']) }
 
+        if repstatus == 'FAILED':
+            # If replication failed this is the only time we will see this object.
+            # Update the status to FAILED
+            ddb_update_exp += ', replication_status = :b'
+            ddb_exp_attrs[':b'] = { 'S': 'FAILED' }
 
-# Create a record in the DDB table
+# Create or update the record in the DDB table
     try:
         response = client['ddb']['handle'].update_item(
             TableName = ddbtable,
             Key = { 'ETag': ETag },
             UpdateExpression = ddb_update_exp,
-            ExpressionAttributeValues = ddb_exp_attrs)
+            ExpressionAttributeValues = ddb_exp_attrs,
+            ReturnValues = 'ALL_NEW')
+    except Exception as e:
+        print(e)
+        print('Table ' + ddbtable + ' update failed')
+        check_missing_table(e, ddbtable)
+        raise e
+    ddbitem = response['Attributes']
+
+    # -----------------------------------------------------------------
+    # Did this event complete the pair?
+    #
+    if 'start_datetime' in ddbitem and 'end_datetime' in ddbitem:
+        if 'crr_rate' not in ddbitem:
+            complete_pair(msg, ddbitem)
+        else:
+            if 'pending' in ddbitem:
+                # A repeated source event of a completed pair
+                clear_pending(ETag)
+            if 'stats_logged' not in ddbitem:
+                # The lambda that completed it may have failed before
+                # writing its statistics
+                relog_pair(msg, ddbitem)
+    # ---------------------------------------------------------
+    # We did not yet get the replica event
+    #
+    elif repstatus == 'FAILED':
+        log_statistics(bucket,'FAILED',now,'0','1',300,msg['ETag']['S'])
+        print("replication FAILED")
+
+# =====================================================================
+# complete_pair
+# -------------
+# Both the source and replica events have been recorded: set the elapsed
+# time and transfer rate, remove the pending marker and log statistics.
+# The write only succeeds if crr_rate is not already set, so when both
+# events finish at the same time only one of them logs the statistics.
+#
+# The statistics are only in memory until the next flush, which then sets
+# stats_logged. Until then stats_due holds the time (visibility seconds
+# from now) after which another lambda may decide this one failed and log
+# the pair itself (see relog_pair).
+# =====================================================================
+def complete_pair(msg, ddbitem):
+    start = ddbitem['start_datetime']['S']
+    end = ddbitem['end_datetime']['S']
+    objsize = msg['objsize']
+
+    # One of the two is this event's time, which is already parsed
+    if msg['repstatus'] == 'REPLICA':
+        etimesecs = msg['now_secs'] - crr_time.parse_time(start)
+    else:
+        etimesecs = crr_time.parse_time(end) - msg['now_secs']
+    #print("Calculate elapsed time in seconds")
+    crr_rate = int(objsize) * 8 / (etimesecs + 1) # Add 1 to prevent /0 errors
+
+    try:
+        client['ddb']['handle'].update_item(
+            TableName = ddbtable,
+            Key = { 'ETag': msg['ETag'] },
+            UpdateExpression = 'set crr_rate = :r, elapsed = :t, stats_due = :u remove pending',
+            ConditionExpression = 'attribute_not_exists(crr_rate)',
+            ExpressionAttributeValues = {
+                ':r': { 'N': str(crr_rate) },
+                ':t': { 'N': str(etimesecs) },
+                ':u': { 'N': str(int(time.time()) + visibility) }
+            })
     except Exception as e:
+        if error_code(e) == 'ConditionalCheckFailedException':
+            # Someone else completed it
+            return
         print(e)
         print('Table ' + ddbtable + ' update failed')
+        check_missing_table(e, ddbtable)
         raise e
 
+    # Statistics are logged in the time bucket of the other event of the pair
+    if msg['repstatus'] == 'REPLICA':
+        log_pair(msg['ETag']['S'],ddbitem['s3Origin']['S'],ddbitem['s3Replica']['S'],start,objsize,str(etimesecs))
+    else:
+        log_pair(msg['ETag']['S'],ddbitem['s3Origin']['S'],ddbitem['s3Replica']['S'],end,objsize,str(etimesecs))
+
+# =====================================================================
+# relog_pair
+# ----------
+# A completed pair whose statistics were never written: the lambda that
+# completed it failed before its flush, and this is a redelivered message.
+# Once stats_due has passed the first lambda to move it on logs the pair
+# again, in the time bucket of the source event.
+# =====================================================================
+def relog_pair(msg, ddbitem):
+    now = int(time.time())
+    try:
+        client['ddb']['handle'].update_item(
+            TableName = ddbtable,
+            Key = { 'ETag': msg['ETag'] },
+            UpdateExpression = 'set stats_due = :u',
+            ConditionExpression = 'attribute_not_exists(stats_logged) and stats_due < :n',
+            ExpressionAttributeValues = {
+                ':u': { 'N': str(now + visibility) },
+                ':n': { 'N': str(now) }
+            })
+    except Exception as e:
+        if error_code(e) == 'ConditionalCheckFailedException':
+            # Still due from the lambda that completed it, or logged already
+            return
+        print(e)
+        print('Table ' + ddbtable + ' update failed')
+        check_missing_table(e, ddbtable)
+        raise e
+    print('Logging statistics again for ' + msg['ETag']['S'])
+    log_pair(msg['ETag']['S'],ddbitem['s3Origin']['S'],ddbitem['s3Replica']['S'],ddbitem['start_datetime']['S'],msg['objsize'],ddbitem['elapsed']['N'])
+
+# Log a pair's statistics and remember to mark it once they are written
+def log_pair(etag,Src,Dst,Tstamp,Size,ET):
+    with statlock:
+        logged.append(etag)
+    log_statistics(Src,Dst,Tstamp,Size,ET,300,etag)
+
+# The pending marker for an ETag
+def pending_shard(etag):
+    return str((zlib.crc32(etag) & 0xffffffff) % pending_shards)
+
+# The end_bucket part for an ETag
+def archive_part(etag):
+    return str((zlib.crc32(etag) & 0xffffffff) % archive_parts)
+
+def clear_pending(ETag):
+    try:
+        client['ddb']['handle'].update_item(
+            TableName = ddbtable,
+            Key = { 'ETag': ETag },
+            UpdateExpression = 'remove pending',
+            ConditionExpression = 'attribute_exists(pending)')
+    except Exception as e:
+        if error_code(e) == 'ConditionalCheckFailedException':
+            # Already removed (or the item was purged)
+            return
+        print(e)
+        print('Table ' + ddbtable + ' update failed')
+        check_missing_table(e, ddbtable)
+        raise e
+
+# =====================================================================
+# process_batch
+# -------------
+# Process a batch of SQS messages on the worker pool. Returns a list with,
+# for each message, the entry to pass to delete_message_batch or None if
+# the message should be left to time out back into the queue. A failure
+# only affects its own message so the rest of the batch can still be
+# deleted.
+# =====================================================================
+def process_batch(messages):
+    return map_pool(process_message, messages)
+
+# Run fn over items on the worker pool, if there is one
+def map_pool(fn, items):
+    if pool:
+        return pool.map(fn, items)
+    return map(fn, items)
+
+def process_message(message):
+    try:
+        rc = message_handler(json.loads(message['Body']))
+    except Exception as e:
+        print(e)
+        print('ERROR: message ' + message['MessageId'] + ' failed - leaving it on the queue')
+        return None
+    # If we did not get a 0 return code let the record time out back
+    # back into the queue
+    if rc:
+        return None
+    return { 'Id': message['MessageId'], 'ReceiptHandle':  message['ReceiptHandle'] }
+
+# =====================================================================
+# commit_messages
+# ---------------
+# Write the statistics collected so far and then delete the messages that
+# produced them. If the statistics cannot be written the messages are left
+# to time out back into the queue.
+# =====================================================================
+def commit_messages(cnum, sqs_delete):
+    # However it ends the messages are no longer ours to extend: deleted,
+    # or left to time out back into the queue
+    try:
+        try:
+            flush_statistics()
+        except Exception as e:
+            print(e)
+            print('ERROR[CNUM-' + str(cnum) + ']: statistics flush failed. Leaving ' + str(len(sqs_delete)) + ' messages on the queue')
+            return
+
+        # delete_message_batch takes at most 10 entries
+        for i in range(0, len(sqs_delete), 10):
+            entries = sqs_delete[i:i+10]
+            response=client['sqs']['handle'].delete_message_batch(
+                QueueUrl=queue_endpoint,
+                Entries=entries
+            )
+            if len(response['Successful']) < len(entries):
+                print('ERROR[CNUM-' + str(cnum) + ']: processed ' + str(len(entries)) + ' messages but only deleted ' + str(len(response['Successful'])) + ' messages')
+    finally:
+        untrack_messages(sqs_delete)
+
+# =====================================================================
+# autoscale
+# ---------
+# Spawn enough copies of this lambda to work through the visible messages
+# in one run, in a single step. Capacity per lambda comes from the rate
+# measured in earlier runs of this container (maxtask until then). Lambdas
+# that are already running are estimated from the messages in flight:
+# each one holds its current and prefetched batches plus whatever is
+# waiting for a statistics flush. maxspawn is the hard cap on children.
+# =====================================================================
+def autoscale(event, context, queue_sz, queue_inflight):
+    rate = msg_rate or maxtask / 300.0 # messages per second per lambda
+    runtime = max(context.get_remaining_time_in_millis() / 1000.0 - deadline_margin, 1)
+    target = int(math.ceil(queue_sz / (rate * runtime)))
+
+    held = 10 * (prefetch + 1) + rate * stat_flush # messages in flight per lambda
+    running = int(math.ceil(queue_inflight / held))
+
+    # This invocation is one of the lambdas draining the queue
+    spawn = min(target, maxspawn + 1) - running - 1
+    print('INFO [CNUM-0] Measured ' + str(round(rate, 1)) + ' messages/sec per lambda. Need ' + str(target) + ' lambdas, about ' + str(running) + ' already running')
+    if spawn <= 0:
+        return
+    if target > maxspawn + 1:
+        print('WARNING: maxspawn(' + str(maxspawn) + ') exceeded. Not spawning all the helpers needed.')
+
+    children = []
+    for i in range(spawn):
+        child = dict(event)
+        child['detail-type'] = 'Spawned Event'
+        child['child-number'] = i + 1
+        children.append((context.function_name, child))
+    results = map_pool(spawn_child, children)
+    print('Spawned ' + str(sum(results)) + ' of ' + str(spawn) + ' children because there are ' + str(queue_sz) + ' messages in the queue')
+
+# Returns 1 if the child was started
+def spawn_child(args):
+    function_name, child = args
+    try:
+        client['lbd']['handle'].invoke(
+            FunctionName=function_name,
+            InvocationType='Event',
+            Payload=json.dumps(child)
+        )
+    except Exception as e:
+        print(e)
+        print('ERROR[CNUM-0] Failed to spawn child ' + str(child['child-number']))
+        return 0
+    return 1
+
+# Fold the rate from a finished run into msg_rate. Short runs are too
+# noisy to use.
+def measure_rate(msg_ctr, busy):
+    global msg_rate
+    if msg_ctr < 50 or busy <= 0:
+        return
+    sample = msg_ctr / busy
+    if msg_rate:
+        msg_rate = 0.7 * msg_rate + 0.3 * sample
+    else:
+        msg_rate = sample
+
 # =====================================================================
 # queue_handler
 # -------------
@@ -435,115 +1134,325 @@ def message_handler(event):
 #   ]
 # }
 #
-# When I spawn a child process I will change "detail-type" to "Spawned Event"
-# and add "child-number", where 0 is the top-level
+# The scheduled invocation works out how many copies of itself are needed
+# and spawns them all at once (see autoscale). When I spawn a child process
+# I will change "detail-type" to "Spawned Event" and add "child-number",
+# where 0 is the top-level. Children do not spawn.
 # =====================================================================
+@crr_instrument.invocation('CRRMonitor')
 def queue_handler(event,context):
     cnum = 0
     if 'child-number' in event:
         cnum = int(event['child-number'])
 
-    message_floor = cnum * maxtask
-
-    # {
-    #   "Attributes": {"ApproximateNumberOfMessages": "1040"},
-    #   "ResponseMetadata": {
-    #       "RetryAttempts": 0,
-    #       "HTTPStatusCode": 200,
-    #       "RequestId": "51c43b7e-9b05-59c8-b68e-6a68f3f3b999",
-    #       "HTTPHeaders": {
-    #           "x-amzn-requestid": "51c43b7e-9b05-59c8-b68e-6a68f3f3b999",
-    #           "content-length": "360",
-    #           "server": "Server",
-    #           "connection": "keep-alive",
-    #           "date": "Thu, 09 Feb 2017 12:55:18 GMT",
-    #           "content-type": "text/xml"
-    #       }
-    #   }
-    # }
-    response = client['sqs']['handle'].get_queue_attributes(
-        QueueUrl=queue_endpoint,
-        AttributeNames=['ApproximateNumberOfMessages']
-        )
+    if cnum == 0:
+        # {
+        #   "Attributes": {"ApproximateNumberOfMessages": "1040",
+        #                  "ApproximateNumberOfMessagesNotVisible": "120"},
+        #   "ResponseMetadata": {
+        #       "RetryAttempts": 0,
+        #       "HTTPStatusCode": 200,
+        #       "RequestId": "51c43b7e-9b05-59c8-b68e-6a68f3f3b999",
+        #       "HTTPHeaders": {
+        #           "x-amzn-requestid": "51c43b7e-9b05-59c8-b68e-6a68f3f3b999",
+        #           "content-length": "360",
+        #           "server": "Server",
+        #           "connection": "keep-alive",
+        #           "date": "Thu, 09 Feb 2017 12:55:18 GMT",
+        #           "content-type": "text/xml"
+        #       }
+        #   }
+        # }
+        response = client['sqs']['handle'].get_queue_attributes(
+            QueueUrl=queue_endpoint,
+            AttributeNames=['ApproximateNumberOfMessages', 'ApproximateNumberOfMessagesNotVisible']
+            )
 
-    if response['ResponseMetadata']['HTTPStatusCode'] <> 200:
-        print('Bad status from ' + queue + ': ' + response['ResponseMetadata']['HTTPStatusCode'])
-        return
+        if response['ResponseMetadata']['HTTPStatusCode'] <> 200:
+            print('Bad status from ' + queue + ': ' + response['ResponseMetadata']['HTTPStatusCode'])
+            return
 
-    queue_sz=int(response['Attributes']['ApproximateNumberOfMessages'])
-    queue_backlog = queue_sz - message_floor
-
-    print('INFO [CNUM-' + str(cnum) + '] Queue is ' + str(queue_sz) + ' deep. Backlog is ' + str(queue_backlog))
-
-    # We subtracted the number of messages for which processes are already
-    # running. If the backlog is still too deep them first spawn another child,
-    # updating child-number + 1
-    if queue_backlog > maxtask:
-        # increment child-number (or initialize to 1) in the event dict
-        # spawn another lambda, passing the event and context dicts
-        if cnum < maxspawn:
-            event['child-number'] = cnum + 1
-            try:
-                client['lbd']['handle'].invoke(
-                    FunctionName=context.function_name,
-                    InvocationType='Event',
-                    Payload=json.dumps(event)
-                )
-                print('Spawning a child because there are ' + str(queue_sz) + ' messages in the queue. I am child ' + str(cnum) + ' with a max capacity of ' + str(maxtask) + '. Message floor is ' + str(message_floor))
-
-                print('Reproduction successful - child ' + str(cnum+1) + ' spawned')
-            except Exception as e:
-                print(e)
-                print('ERROR[CNUM-' + str(cnum) + '] Failed to reproduce')
-                raise e
-        else:
-            print('WARNING: maxspawn(' + str(maxspawn) + ') exceeded. Not spawning a helper.')
+        queue_sz=int(response['Attributes']['ApproximateNumberOfMessages'])
+        queue_inflight=int(response['Attributes']['ApproximateNumberOfMessagesNotVisible'])
+
+        print('INFO [CNUM-' + str(cnum) + '] Queue is ' + str(queue_sz) + ' deep. ' + str(queue_inflight) + ' messages in flight')
+
+        autoscale(event, context, queue_sz, queue_inflight)
 
     # -----------------------------------------------------------------
     # Now we get to work. Process messages from the queue until empty
     # or we time out. This is the secret sauce to our horizontal scale
-    print('INFO [CNUM-' + str(cnum) + '] Priming read from SQS...')
-    msg_ctr=0 # keep a count of messages processed
-    sqs_msgs=client['sqs']['handle'].receive_message(
-        QueueUrl=queue_endpoint,
-        AttributeNames=[ 'All' ],
-        MaxNumberOfMessages=10,
-        VisibilityTimeout=60
-    )
+    #
+    # Receiving, processing and deleting overlap: a receiver thread keeps
+    # up to prefetch batches waiting, the current batch is processed on
+    # the worker pool, and the previous batches are deleted in the
+    # background.
+    batches=Queue.Queue(prefetch)
+    stop=threading.Event() # set when it is time to stop reading
+    done=threading.Event() # set when this invocation is finished
+    receiver=threading.Thread(target=receive_messages, args=(cnum, batches, stop, context))
+    receiver.daemon=True
+    receiver.start()
+    extender=threading.Thread(target=extend_visibility, args=(cnum, done))
+    extender.daemon=True
+    extender.start()
+
+    committer=None
     sqs_delete=[]
-    while 'Messages' in sqs_msgs:
-        print('INFO [CNUM-' + str(cnum) + '] Processing ' + str(len(sqs_msgs['Messages'])) + ' messages')
-        for message in sqs_msgs['Messages']:
-            rc = message_handler(json.loads(message['Body']))
-            # If we did not get a 0 return code let the record time out back
-            # back into the queue
-            if not rc:
-                sqs_delete.append({ 'Id': message['MessageId'], 'ReceiptHandle':  message['ReceiptHandle'] })
-                msg_ctr+=1 # keep a count of messages processed
-
-        if len(sqs_delete) > 0:
-            # Delete the messages we just processed
-            response=client['sqs']['handle'].delete_message_batch(
+    msg_ctr=0 # keep a count of messages processed
+    busy=0 # seconds spent processing, to measure our rate
+    try:
+        last_flush=time.time()
+        messages=next_batch(batches, context)
+        while messages is not None:
+            # Leave enough time to write statistics and delete what has been
+            # processed. Hand back everything not started yet so another
+            # lambda can pick it up straight away.
+            if context.get_remaining_time_in_millis() < deadline_margin * 1000:
+                print('WARNING[CNUM-' + str(cnum) + ']: running out of time. Releasing unprocessed messages')
+                stop.set()
+                receiver.join(wait_time + 5)
+                release_messages(cnum, messages)
+                while True:
+                    try:
+                        messages=batches.get_nowait()
+                    except Queue.Empty:
+                        break
+                    if messages:
+                        release_messages(cnum, messages)
+                break
+
+            print('INFO [CNUM-' + str(cnum) + '] Processing ' + str(len(messages)) + ' messages')
+            batch_start=time.time()
+            results = process_batch(messages)
+            busy+=time.time() - batch_start
+            for entry in results:
+                if entry:
+                    sqs_delete.append(entry)
+                    msg_ctr+=1 # keep a count of messages processed
+            # Failed messages are left to time out back into the queue
+            untrack_messages([ m for m, entry in zip(messages, results) if not entry ])
+
+            # Statistics are written every stat_flush seconds rather than per
+            # batch. The processed messages are held until then.
+            if time.time() - last_flush >= stat_flush:
+                if committer:
+                    committer.join()
+                committer=threading.Thread(target=commit_messages, args=(cnum, sqs_delete))
+                committer.start()
+                sqs_delete=[] # reset the list
+                last_flush=time.time()
+
+            messages=next_batch(batches, context)
+
+        if committer:
+            committer.join()
+        commit_messages(cnum, sqs_delete)
+    finally:
+        # Stop the receiver and extender even if this invocation failed.
+        # Anything still tracked is left to time out back into the queue:
+        # a later invocation of this container must not keep extending it.
+        stop.set()
+        done.set()
+        with inflightlock:
+            inflight.clear()
+    measure_rate(msg_ctr, busy)
+
+    print('INFO [CNUM-' + str(cnum) + '] Completed - ' + str(msg_ctr) + ' messages processed. ' + dedup_summary() + '. ' + crr_rules.summary())
+
+# The next batch from the receiver: None when there are no more, or []
+# if the lambda reaches deadline_margin while waiting for one
+def next_batch(batches, context):
+    while True:
+        try:
+            return batches.get(True, 1)
+        except Queue.Empty:
+            if context.get_remaining_time_in_millis() < deadline_margin * 1000:
+                return []
+
+# =====================================================================
+# sqs_handler
+# -----------
+# Entry point when the lambda is fed by an SQS event source mapping
+# instead of the scheduled queue_handler (ConsumerMode in the template).
+# Lambda polls the queue, scales the number of copies of this function
+# itself, and deletes the messages we report as processed. Batch size and
+# batching window are set on the mapping. Here's what my event looks like:
+# {
+#   "Records": [
+#       {
+#           "messageId": "059f36b4-87a3-44ab-83d2-661975830a7d",
+#           "receiptHandle": "AQEBwJnKyrHigUMZj6rYigCgxlaS3SLy0a...",
+#           "body": "{\"Type\": \"Notification\", \"Message\": ...}",
+#           "attributes": { "ApproximateReceiveCount": "1", ... },
+#           "eventSource": "aws:sqs",
+#           "eventSourceARN": "arn:aws:sqs:us-east-2:SAMPLE12345:CRRMonitorQueue",
+#           "awsRegion": "us-east-2"
+#       }
+#   ]
+# }
+#
+# Returns the records that failed as batchItemFailures so only those are
+# retried. As in commit_messages, if the statistics cannot be written the
+# whole batch is retried.
+#
+# Messages are processed a slice (sqs_slice per worker) at a time. Once
+# the lambda has less than deadline_margin seconds left the rest are not
+# started: they are returned as failures too, so a large batch is not
+# retried whole after a timeout.
+# =====================================================================
+@crr_instrument.invocation('CRRMonitor')
+def sqs_handler(event, context):
+    messages = [ { 'MessageId': r['messageId'], 'ReceiptHandle': r['receiptHandle'], 'Body': r['body'] } for r in event.get('Records', []) ]
+    print('INFO [SQS] Processing ' + str(len(messages)) + ' messages')
+
+    results = []
+    step = sqs_slice * max(workers, 1)
+    for i in range(0, len(messages), step):
+        if context.get_remaining_time_in_millis() < deadline_margin * 1000:
+            print('WARNING[SQS]: running out of time. Returning ' + str(len(messages) - i) + ' messages not started')
+            break
+        results += process_batch(messages[i:i + step])
+    results += [ None ] * (len(messages) - len(results))
+    failed = [ m['MessageId'] for m, entry in zip(messages, results) if not entry ]
+    try:
+        flush_statistics()
+    except Exception as e:
+        print(e)
+        print('ERROR[SQS]: statistics flush failed. Leaving ' + str(len(messages)) + ' messages on the queue')
+        failed = [ m['MessageId'] for m in messages ]
+
+    print('INFO [SQS] Completed - ' + str(len(messages) - len(failed)) + ' messages processed, ' + str(len(failed)) + ' failed. ' + dedup_summary() + '. ' + crr_rules.summary())
+    return { 'batchItemFailures': [ { 'itemIdentifier': i } for i in failed ] }
+
+# =====================================================================
+# receive_messages
+# ----------------
+# Runs on its own thread for the life of a queue_handler invocation.
+# Long polls the queue and puts each batch of messages on batches,
+# blocking while prefetch batches are already waiting. Gives up after
+# max_empty receives in a row come back empty, and puts None on batches
+# to tell queue_handler there is no more work. It also stops when a poll
+# could run into the deadline_margin queue_handler keeps for its last
+# flush. If stop is set any batch it is holding is released back to the
+# queue.
+# =====================================================================
+def receive_messages(cnum, batches, stop, context):
+    empty=0
+    while empty < max_empty and not stop.is_set():
+        if context.get_remaining_time_in_millis() < (deadline_margin + wait_time) * 1000:
+            print('INFO [CNUM-' + str(cnum) + '] Close to the deadline. Stopping reads')
+            break
+        print('INFO [CNUM-' + str(cnum) + '] Reading from SQS...')
+        try:
+            sqs_msgs=client['sqs']['handle'].receive_message(
                 QueueUrl=queue_endpoint,
-                Entries=sqs_delete
+                AttributeNames=[ 'All' ],
+                MaxNumberOfMessages=10,
+                VisibilityTimeout=visibility,
+                WaitTimeSeconds=wait_time
             )
-            if len(response['Successful']) < len(sqs_delete):
-                print('ERROR[CNUM-' + str(cnum) + ']: processed ' + str(len(sqs_msgs)) + ' messages but only deleted ' + str(len(response['Successful'])) + ' messages')
+        except Exception as e:
+            print(e)
+            print('ERROR[CNUM-' + str(cnum) + ']: receive from ' + queue + ' failed')
+            sqs_msgs={}
 
-        sqs_delete=[] # reset the list
+        if 'Messages' in sqs_msgs:
+            empty=0
+            track_messages(sqs_msgs['Messages'])
+            if not put_batch(batches, sqs_msgs['Messages'], stop):
+                release_messages(cnum, sqs_msgs['Messages'])
+        else:
+            empty+=1
+    put_batch(batches, None, stop)
 
-        print('INFO [CNUM-' + str(cnum) + '] Reading from SQS...')
-        sqs_msgs=client['sqs']['handle'].receive_message(
-            QueueUrl=queue_endpoint,
-            AttributeNames=[ 'All' ],
-            MaxNumberOfMessages=10,
-            VisibilityTimeout=60
-        )
+# Put on the queue, giving up if stop is set while waiting for room
+def put_batch(batches, messages, stop):
+    while not stop.is_set():
+        try:
+            batches.put(messages, True, 1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+# =====================================================================
+# Visibility management
+# ---------------------
+# Every received message is tracked in inflight until it is deleted,
+# released, or left to time out. extend_visibility runs on its own thread
+# for the life of a queue_handler invocation and pushes out the
+# visibility timeout of tracked messages before it runs out, so slow
+# batches and messages waiting for a statistics flush are not delivered
+# to another lambda.
+# =====================================================================
+def track_messages(messages):
+    expires = time.time() + visibility
+    with inflightlock:
+        for m in messages:
+            inflight[m['ReceiptHandle']] = { 'Id': m['MessageId'], 'ReceiptHandle': m['ReceiptHandle'], 'expires': expires }
 
-    print('INFO [CNUM-' + str(cnum) + '] Completed - ' + str(msg_ctr) + ' messages processed')
+def untrack_messages(messages):
+    with inflightlock:
+        for m in messages:
+            inflight.pop(m['ReceiptHandle'], None)
+
+def extend_visibility(cnum, done):
+    while not done.wait(5):
+        now = time.time()
+        with inflightlock:
+            due = [ m for m in inflight.values() if m['expires'] - now < visibility / 2 ]
+        if due:
+            print('INFO [CNUM-' + str(cnum) + '] Extending visibility of ' + str(len(due)) + ' messages')
+            change_visibility(cnum, due, visibility)
+
+# Release messages we will not process so they can be read again at once
+def release_messages(cnum, messages):
+    untrack_messages(messages)
+    entries = [ { 'Id': m['MessageId'], 'ReceiptHandle': m['ReceiptHandle'] } for m in messages ]
+    print('INFO [CNUM-' + str(cnum) + '] Releasing ' + str(len(entries)) + ' messages')
+    change_visibility(cnum, entries, 0)
+
+def change_visibility(cnum, entries, timeout):
+    # change_message_visibility_batch takes at most 10 entries
+    for i in range(0, len(entries), 10):
+        chunk = entries[i:i+10]
+        try:
+            response = client['sqs']['handle'].change_message_visibility_batch(
+                QueueUrl=queue_endpoint,
+                Entries=[ { 'Id': m['Id'], 'ReceiptHandle': m['ReceiptHandle'], 'VisibilityTimeout': timeout } for m in chunk ]
+            )
+        except Exception as e:
+            print(e)
+            print('ERROR[CNUM-' + str(cnum) + ']: change_message_visibility_batch failed')
+            continue
+        if timeout > 0:
+            expires = time.time() + timeout
+            ok = set([ r['Id'] for r in response.get('Successful', []) ])
+            with inflightlock:
+                for m in chunk:
+                    if m['Id'] in ok and m['ReceiptHandle'] in inflight:
+                        inflight[m['ReceiptHandle']]['expires'] = expires
 
 ###### M A I N ######
+# Every worker, plus the receiver, extender and committer threads, can be
+# using a client at the same time
+crr_clients.configure(max_pool_connections=workers + 4)
 client = connect_clients(client)
+crr_rules.configure(ttl=rules_ttl)
+if agent_regions:
+    crr_clients.prewarm('s3', agent_regions.split(','))
+elif rules_ttl:
+    # Read the rules in the background so the container starts as quickly
+    # as before. The first event waits for them anyway.
+    prewarm_thread = threading.Thread(target=prewarm_regions)
+    prewarm_thread.daemon = True
+    prewarm_thread.start()
+# The pool lives as long as the container so threads are not created on
+# every invocation
+pool = None
+if workers > 1:
+    pool = ThreadPool(workers)
 try:
     queue_endpoint=client['sqs']['handle'].get_queue_url(
         QueueName=queue
@@ -1,12 +1,23 @@
 from __future__ import print_function
 
 import json
-import boto3
 import os
 import logging
-from datetime import datetime, timedelta
+import time
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
 from urllib2 import Request
 from urllib2 import urlopen
+from urllib import quote
+# Unable to import module? You need to zip CRRMonitorHousekeeping.py with
+# crr_time.py, crr_clients.py, crr_instrument.py, crr_metrics.py,
+# crr_sketch.py and crr_scan.py!!
+import crr_time
+import crr_clients
+import crr_instrument
+import crr_metrics
+import crr_sketch
+import crr_scan
 
 log = logging.getLogger()
 log.setLevel(logging.INFO)
@@ -36,9 +47,43 @@ kinesisfirestream = getparm('kinesisfirestream', ddbtable + 'DeliveryStream')
 stack_name = getparm('stack_name','Nil')
 send_anonymous_data = getparm('send_anonymous_data','No')
 
-timefmt = '%Y-%m-%dT%H:%M:%SZ'
 roundTo = getparm('roundto', 300) # 5 minute buckets for CW metrics
 purge_thresh = getparm('purge_thresh', 24) # threshold in hours
+table_ttl = getparm('table_ttl', 3600) # seconds to trust that a table exists
+# Metrics are published in put_metric_data requests of up to metric_batch
+# datums (the API allows 1000) and about metric_bytes (the API allows
+# 1 MB), publish_threads requests at a time. A distribution datum carries
+# at most metric_values values (the API allows 150). Published statistics
+# are then cleared, publish_threads items at a time (see clear_stats).
+metric_batch = getparm('metric_batch', 1000)
+metric_bytes = getparm('metric_bytes', 1000000)
+metric_values = getparm('metric_values', 150)
+publish_threads = getparm('publish_threads', 8)
+# Due statistics are read from stat_index, which is keyed by the statday
+# (day and part, see crr_time.statday) and time bucket of each statistic,
+# going back stat_lookback days to pick up statistics that earlier runs
+# missed or that were written late. stat_parts must match CRRMonitor's.
+# The index misses statistics written without a statday (before it
+# existed), so every stat_sweep seconds, and until the index is active,
+# the table is scanned instead.
+stat_index = getparm('stat_index', 'timebucket-index')
+stat_lookback = getparm('stat_lookback', 2)
+stat_parts = getparm('stat_parts', 10)
+stat_sweep = getparm('stat_sweep', 3600)
+# Completed transfers are archived to Firehose a 5 minute window at a time,
+# read from archive_index, which is keyed by the window their end_datetime
+# is in and a part (end_bucket, see CRRMonitor). archive_parts must match
+# CRRMonitor's. Until the index exists and is active the table is
+# scanned, in archive_segments parallel segments (see crr_scan). Records
+# are sent with put_record_batch, retrying the ones that fail up to
+# firehose_attempts times.
+archive_index = getparm('archive_index', 'end_bucket-index')
+archive_parts = getparm('archive_parts', 10)
+archive_segments = getparm('archive_segments', 4)
+firehose_attempts = getparm('firehose_attempts', 5)
+tables_verified = {} # time each DynamoDB table was last found to exist
+table_indexes = {} # names of the active global secondary indexes of each table
+last_sweep = [ 0 ] # time the Statistics table was last scanned
 client = {
     'cw': {
         'service': 'cloudwatch'
@@ -63,197 +108,59 @@ if stream_to_kinesis != 'No':
 def connect_clients(clients_to_connect):
     for c in clients_to_connect:
         try:
-            if 'region' in clients_to_connect[c]:
-                clients_to_connect[c]['handle']=boto3.client(clients_to_connect[c]['service'], region_name=clients_to_connect[c]['region'])
-            else:
-                clients_to_connect[c]['handle']=boto3.client(clients_to_connect[c]['service'])
+            clients_to_connect[c]['handle']=crr_clients.get_client(clients_to_connect[c]['service'], clients_to_connect[c].get('region'))
         except Exception as e:
             print(e)
             print('Error connecting to ' + clients_to_connect[c]['service'])
             raise e
     return clients_to_connect
 
-def lambda_handler(event, context):
-    # -----------------------------------------------------------------
-    # save items in S3 - save items
-    #
-    def save_item(item):
-        print('Save Item' + json.dumps(item))
-        try:
-            response = client['firehose']['handle'].put_record(
-                DeliveryStreamName=kinesisfirestream,
-                Record={
-                    'Data': json.dumps(item) + '\n'
-                }
-            )
-        except Exception as e:
-            print(e)
-            print('Error saving ' + item['ETag']['S'] + ' from ' + ddbtable)
-            raise e
-
-            # -----------------------------------------------------------------
-
-    # -----------------------------------------------------------------
-    # post_stats - post statistics to CloudWatch
-    #
-    def post_stats(item):
-        print('Posting statistics to CloudWatch for ' + item['source_bucket']['S'] + ' time bucket ' + item['timebucket']['S'])
-
-        ts=item['timebucket']['S']
-
-        # -------------------------------------------------------------
-        # Special Handling: Failed replicatons are reported in the
-        # same data format. The destination bucket will be FAILED.
-        # Pull these out separately to a different CW metric.
-        if item['dest_bucket']['S'] == 'FAILED':
-            try:
-                client['cw']['handle'].put_metric_data(
-                    Namespace='CRRMonitor',
-                    MetricData=[
-                        {
-                            'MetricName': 'FailedReplications',
-                            'Dimensions': [
-                                {
-                                    'Name': 'SourceBucket',
-                                    'Value': item['source_bucket']['S']
-                                }
-                            ],
-                            'Timestamp': ts,
-                            'Value': int(item['objects']['N'])
-                        },
-                    ]
-                )
-            except Exception as e:
-                print(e)
-                print('Error creating CloudWatch metric FailedReplications')
-                raise e
-        else:
-            try:
-                client['cw']['handle'].put_metric_data(
-                    Namespace='CRRMonitor',
-                    MetricData=[
-                        {
-                            'MetricName': 'ReplicationObjects',
-                            'Dimensions': [
-                                {
-                                    'Name': 'SourceBucket',
-                                    'Value': item['source_bucket']['S']
-                                },
-                                {
-                                    'Name': 'DestBucket',
-                                    'Value': item['dest_bucket']['S']
-                                }
-                            ],
-                            'Timestamp': ts,
-                            'Value': int(item['objects']['N'])
-                        },
-                    ]
-                )
-            except Exception as e:
-                print(e)
-                print('Error creating CloudWatch metric')
-                raise e
-            try:
-                client['cw']['handle'].put_metric_data(
-                    Namespace='CRRMonitor',
-                    MetricData=[
-                        {
-                            'MetricName': 'ReplicationSpeed',
-                            'Dimensions': [
-                                {
-                                    'Name': 'SourceBucket',
-                                    'Value': item['source_bucket']['S']
-                                },
-                                {
-                                    'Name': 'DestBucket',
-                                    'Value': item['dest_bucket']['S']
-                                }
-                            ],
-                            'Timestamp': ts,
-                            'Value': ((int(item['size']['N'])*8)/1024)/(int(item['elapsed']['N'])+1)
-                        },
-                    ]
-                )
-            except Exception as e:
-                print(e)
-                print('Error creating CloudWatch metric')
-                raise e
-
-        print ('Statistics posted to ' + ts)
-
-        try:
-            client['ddb']['handle'].delete_item(
-                TableName=stattable,
-                Key={
-                    'OriginReplicaBucket': {
-                        'S': item['source_bucket']['S'] + ':' + item['dest_bucket']['S'] + ':' + ts
-                    }
-                }
-            )
-            print('Purged statistics date for ' + ts)
-        except Exception as e:
-            print(e)
-            print('Error purging from ' + ts)
-            raise e
-
-    #======================== post_stats ==============================
-
-    #==================================================================
-    # firehose: retrieve all records completed in the last 5 minutes
-    # Stream them to firehose
-    def firehose(ts):
-        begts=ts - timedelta(minutes=5)
-        arch_beg = begts.strftime(timefmt)
-        arch_end = ts.strftime(timefmt)
-        # Set scan filter attrs
-        eav = {
-                ":archbeg": { "S": arch_beg },
-                ":archend": { "S": arch_end }
-            }
-
-        print('Reading from ' + ddbtable)
-        try:
-            response = client['ddb']['handle'].scan(
-                TableName=ddbtable,
-                ExpressionAttributeValues=eav,
-                FilterExpression="end_datetime >= :archbeg and end_datetime < :archend",
-                Limit=1000
-                )
-        except Exception as e:
-            print(e)
-            print('Table ' + ddbtable + ' scan failed')
-            raise e
-
-        print('Archiving items from ' + ddbtable + ' beg>=' + arch_beg + ' end=' + arch_end)
-
-        for i in response['Items']:
-            save_item(i)
-
-        while 'LastEvaluatedKey' in response:
-            response = client['ddb']['handle'].scan(
-                TableName=ddbtable,
-                FilterExpression="end_datetime >= :archbeg and end_datetime < :archend",
-                ExpressionAttributeValues=eav,
-                ExclusiveStartKey=response['LastEvaluatedKey'],
-                Limit=1000
-                )
-
-            for i in response['Items']:
-                print('Items LastEvaluated ' + i['ETag']['S'])
-                save_item(i)
-    #====================== firehose ==================================
+# =====================================================================
+# verify_table
+# ------------
+# Check that a DynamoDB table exists. describe_table is a slow, rate
+# limited control plane call so a successful check is trusted for
+# table_ttl seconds. Raises if the table does not exist.
+# =====================================================================
+def verify_table(table):
+    if tables_verified.get(table, 0) + table_ttl > time.time():
+        return
+    try:
+        response = client['ddb']['handle'].describe_table(
+            TableName = table
+        )
+    except Exception as e:
+        print(e)
+        print('Table ' + table + ' does not exist - need to create it')
+        raise e
+    table_indexes[table] = set([ i['IndexName'] for i in response['Table'].get('GlobalSecondaryIndexes', [])
+        if i.get('IndexStatus') == 'ACTIVE' ])
+    tables_verified[table] = time.time()
 
+# =====================================================================
+# check_missing_table
+# -------------------
+# Called with the exception from a table read or write. If the table was
+# not found forget that it was verified and check it again now.
+# =====================================================================
+def check_missing_table(e, table):
+    if not hasattr(e, 'response'):
+        return
+    if e.response.get('Error', {}).get('Code') == 'ResourceNotFoundException':
+        tables_verified.pop(table, None)
+        verify_table(table)
+
+@crr_instrument.invocation('CRRMonitorHousekeeping')
+def lambda_handler(event, context):
     # What time is it?
-    ts = datetime.utcnow()
+    ts = time.time()
 
     # CRRMonitor logs forward (rounds up). We want to read from the last bucket,
     # not the current on. So round down to the previous 5 min interval
-    secs = (ts.replace(tzinfo=None) - ts.min).seconds
-    rounding = (secs-roundTo/2) // roundTo * roundTo
-    ts = ts + timedelta(0,rounding-secs,-ts.microsecond)
+    ts = crr_time.round_down(ts, roundTo)
 
     # save the timestamp we created in a str
-    statbucket = datetime.strftime(ts, timefmt) # We'll get stats from this bucket
+    statbucket = crr_time.format_time(ts) # We'll get stats from this bucket
     print('Logging from ' + statbucket)
 
     # -----------------------------------------------------------------
@@ -262,67 +169,389 @@ def lambda_handler(event, context):
     # Get the name of the 5 minute stat bucket that we just stopped
     #  logging to, read the data, and delete the record.
     #
+    verify_table(stattable)
+
+    # CRRMonitor may split the statistics for a bucket pair and time
+    # bucket over several items (shards). Read them all and add them up
+    # before posting.
+    items = read_stats(ts, statbucket)
+    if len(items) == 0:
+        print('WARNING: No stats bucket found for ' + statbucket)
+
+    stats = merge_shards(items)
+
+    ## Trigger sol_helper to collect stats data
+    if send_anonymous_data == 'Yes':
+       sol_helper({ 'Items': [ totals for totals, summed in stats ] })
+
+    publish_stats(stats)
+
+    # Archive to firehose
+    if stream_to_kinesis == 'Yes':
+        archive(ts)
+
+# =====================================================================
+# read_stats
+# ----------
+# All the statistics items for time buckets up to statbucket. ts is the
+# time of statbucket.
+# =====================================================================
+def read_stats(ts, statbucket):
+    if stat_index not in table_indexes.get(stattable, ()):
+        print('Index ' + stat_index + ' of ' + stattable + ' is not active. Scanning')
+        return scan_stats(statbucket)
+    if last_sweep[0] + stat_sweep <= time.time():
+        print('Scanning ' + stattable + ' for statistics the index does not have')
+        items = scan_stats(statbucket)
+        last_sweep[0] = time.time()
+        return items
+    requests = []
+    for days in range(stat_lookback, -1, -1):
+        day = crr_time.day(crr_time.format_time(ts - days * 86400))
+        for part in range(stat_parts):
+            requests.append({
+                'TableName': stattable,
+                'IndexName': stat_index,
+                'KeyConditionExpression': 'statday = :y and timebucket <= :stats',
+                'ExpressionAttributeValues': {
+                    ':y': { 'S': day + '#' + str(part) },
+                    ':stats': { 'S': statbucket }
+                }
+            })
+    items = []
     try:
-        client['ddb']['handle'].describe_table(
-            TableName = stattable
-        )
+        crr_scan.query(client['ddb']['handle'], requests, items.append)
     except Exception as e:
-        print(e)
-        print('Table ' + stattable + ' does not exist - need to create it')
+        check_missing_table(e, stattable)
         raise e
+    return items
+
+def scan_stats(statbucket):
+    items = []
+    kwargs = {
+        'TableName': stattable,
+        'FilterExpression': 'timebucket <= :stats',
+        'ExpressionAttributeValues': { ':stats': { 'S': statbucket } },
+        'ConsistentRead': True
+    }
+    while True:
+        try:
+            response = client['ddb']['handle'].scan(**kwargs)
+        except Exception as e:
+            print(e)
+            print('Table ' + stattable + ' scan failed')
+            check_missing_table(e, stattable)
+            raise e
+        items += response['Items']
+        if 'LastEvaluatedKey' not in response:
+            return items
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
 
-    eav = {
-            ":stats": { "S": statbucket }
+# =====================================================================
+# merge_shards
+# ------------
+# Group statistics items by bucket pair and time bucket and add up their
+# counters and latency sketch bins. Returns [ (totals, the items summed) ].
+# =====================================================================
+def merge_shards(items):
+    stats = {}
+    order = []
+    for item in items:
+        pair = (item['source_bucket']['S'], item['dest_bucket']['S'], item['timebucket']['S'])
+        if pair not in stats:
+            order.append(pair)
+            stats[pair] = ({
+                'source_bucket': item['source_bucket'],
+                'dest_bucket': item['dest_bucket'],
+                'timebucket': item['timebucket'],
+                'objects': { 'N': '0' },
+                'size': { 'N': '0' },
+                'elapsed': { 'N': '0' }
+            }, [])
+        totals, summed = stats[pair]
+        for attr in item:
+            if attr in ['objects', 'size', 'elapsed'] or crr_sketch.is_bin(attr):
+                totals[attr] = { 'N': str(int(totals.get(attr, { 'N': '0' })['N']) + int(item[attr]['N'])) }
+        summed.append(item)
+    return [ stats[group] for group in order ]
+
+# =====================================================================
+# publish_stats
+# -------------
+# Post the CloudWatch metrics for every statistic in a few put_metric_data
+# requests, published in parallel, then clear the items of the statistics
+# whose metrics were all posted. A request is filled until it holds
+# metric_batch datums or would go over metric_bytes. The rest stay in the table to be posted
+# by the next run, and an exception is raised once the others are
+# cleared.
+# =====================================================================
+def publish_stats(stats):
+    # [ (index in stats, datum) ]
+    datums = []
+    for n, (totals, summed) in enumerate(stats):
+        datums += [ (n, d) for d in stat_datums(totals) ]
+    if not datums:
+        return
+    batches = []
+    batch = []
+    size = 0
+    for n, d in datums:
+        b = datum_bytes(d)
+        if batch and (len(batch) == metric_batch or size + b > metric_bytes):
+            batches.append(batch)
+            batch = []
+            size = 0
+        batch.append((n, d))
+        size += b
+    batches.append(batch)
+    pool = ThreadPool(min(publish_threads, len(batches)))
+    try:
+        results = pool.map(put_metrics, batches)
+    finally:
+        pool.close()
+    failed = set()
+    for result in results:
+        failed.update(result)
+    print('Posted ' + str(len(datums)) + ' metrics for ' + str(len(stats) - len(failed)) + ' of ' + str(len(stats)) + ' statistics in ' + str(len(batches)) + ' requests')
+
+    items = []
+    for n, (item, itemlist) in enumerate(stats):
+        if n not in failed:
+            items += itemlist
+    clear_stats(items)
+    print('Purged ' + str(len(items)) + ' statistics items')
+    if failed:
+        raise Exception('Metrics for ' + str(len(failed)) + ' statistics could not be posted')
+
+# The CloudWatch datums for one statistic: the totals for a bucket pair
+# and time bucket.
+def stat_datums(item):
+    # -------------------------------------------------------------
+    # Special Handling: Failed replicatons are reported in the
+    # same data format. The destination bucket will be FAILED.
+    # crr_metrics pulls these out separately to a different CW metric.
+    bins = dict([ (attr, int(value['N'])) for attr, value in item.items() if crr_sketch.is_bin(attr) ])
+    metrics = crr_metrics.replication_metrics(item['source_bucket']['S'], item['dest_bucket']['S'],
+        int(item['objects']['N']), int(item['size']['N']), int(item['elapsed']['N']), bins)
+    datums = []
+    for name, dims, value in metrics:
+        datum = {
+            'MetricName': name,
+            'Dimensions': [ { 'Name': d, 'Value': v } for d, v in dims ],
+            'Timestamp': item['timebucket']['S']
         }
+        if not crr_metrics.is_distribution(value):
+            datum['Value'] = value
+            datums.append(datum)
+            continue
+        # CloudWatch adds up datums for the same metric and time
+        for i in range(0, len(value), metric_values):
+            part = dict(datum)
+            part['Values'] = [ v for v, n in value[i:i + metric_values] ]
+            part['Counts'] = [ n for v, n in value[i:i + metric_values] ]
+            part['Unit'] = crr_metrics.units[name]
+            datums.append(part)
+    return datums
+
+# About how many bytes a datum adds to a put_metric_data request. The
+# request is form encoded, one MetricData.member.N.<path>=<value> parameter
+# for each field of each datum.
+def datum_bytes(datum):
+    prefix = len('&MetricData.member.1000.=')
+    size = 0
+    for name, value in datum.items():
+        if name == 'Dimensions':
+            for n, dim in enumerate(value):
+                for field in [ 'Name', 'Value' ]:
+                    size += prefix + len('Dimensions.member.' + str(n + 1) + '.' + field) + len(quote(dim[field], ''))
+        elif name in [ 'Values', 'Counts' ]:
+            for n, v in enumerate(value):
+                size += prefix + len(name + '.member.' + str(n + 1)) + len(repr(v))
+        else:
+            size += prefix + len(name) + len(quote(str(value), ''))
+    return size
 
+# Post a batch of [ (index in stats, datum) ]. Returns the indexes of the
+# statistics whose datums could not be posted. A batch that is too large
+# after all is split in two and sent again.
+def put_metrics(batch):
     try:
-        response = client['ddb']['handle'].scan(
-            TableName=stattable,
-            ExpressionAttributeValues=eav,
-            FilterExpression="timebucket <= :stats",
-            ConsistentRead=True
-            )
+        client['cw']['handle'].put_metric_data(
+            Namespace=crr_metrics.namespace,
+            MetricData=[ d for n, d in batch ]
+        )
     except Exception as e:
+        if too_large(e) and len(batch) > 1:
+            print('Request of ' + str(len(batch)) + ' CloudWatch metrics was too large. Splitting it')
+            half = len(batch) // 2
+            return put_metrics(batch[:half]) | put_metrics(batch[half:])
         print(e)
-        print('Table ' + ddbtable + ' scan failed')
-        raise e
+        print('Error creating ' + str(len(batch)) + ' CloudWatch metrics')
+        return set([ n for n, d in batch ])
+    return set()
 
-    if len(response['Items']) == 0:
-        print('WARNING: No stats bucket found for ' + statbucket)
+def too_large(e):
+    if not hasattr(e, 'response'):
+        return False
+    return error_code(e) == 'RequestEntityTooLarge' or \
+        e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 413
 
-    ## Trigger sol_helper to collect stats data
-    if send_anonymous_data == 'Yes':
-       sol_helper(response)
+# =====================================================================
+# clear_stats
+# -----------
+# Take posted statistics items out of the Statistics table. CRRMonitor
+# can still be adding to an item after it was read: the index is only
+# eventually consistent, and late completions are logged in old time
+# buckets. So an item is only deleted if it still holds what was read
+# (objects and size change with every write). Otherwise what was posted
+# is subtracted from it, and the rest is posted by a later run.
+# =====================================================================
+def clear_stats(items):
+    if not items:
+        return
+    pool = ThreadPool(min(publish_threads, len(items)))
+    try:
+        pool.map(clear_stat, items)
+    finally:
+        pool.close()
 
-    for i in response['Items']:
-        post_stats(i)
+def clear_stat(item):
+    key = { 'OriginReplicaBucket': item['OriginReplicaBucket'] }
+    try:
+        client['ddb']['handle'].delete_item(
+            TableName = stattable,
+            Key = key,
+            ConditionExpression = '#a = :a and #c = :c',
+            ExpressionAttributeNames = { '#a': 'objects', '#c': 'size' },
+            ExpressionAttributeValues = { ':a': item['objects'], ':c': item['size'] })
+        return
+    except Exception as e:
+        if error_code(e) != 'ConditionalCheckFailedException':
+            print(e)
+            print('Error purging statistics from ' + stattable)
+            raise e
+    print('Statistic ' + key['OriginReplicaBucket']['S'] + ' changed since it was read. Subtracting what was posted')
+    counters = [ attr for attr in sorted(item) if attr in [ 'objects', 'size', 'elapsed' ] or crr_sketch.is_bin(attr) ]
+    try:
+        client['ddb']['handle'].update_item(
+            TableName = stattable,
+            Key = key,
+            UpdateExpression = 'ADD ' + ', '.join([ '#k' + str(n) + ' :k' + str(n) for n in range(len(counters)) ]),
+            ConditionExpression = 'attribute_exists(OriginReplicaBucket)',
+            ExpressionAttributeNames = dict([ ('#k' + str(n), attr) for n, attr in enumerate(counters) ]),
+            ExpressionAttributeValues = dict([ (':k' + str(n), { 'N': str(-int(item[attr]['N'])) }) for n, attr in enumerate(counters) ]))
+    except Exception as e:
+        if error_code(e) == 'ConditionalCheckFailedException':
+            # Deleted already
+            return
+        print(e)
+        print('Error purging statistics from ' + stattable)
+        raise e
 
-    while 'LastEvaluatedKey' in response:
+def error_code(e):
+    if hasattr(e, 'response'):
+        return e.response.get('Error', {}).get('Code')
+    return None
+
+# =====================================================================
+# archive
+# -------
+# Send every transfer completed in the 5 minutes before ts to Firehose.
+# =====================================================================
+def archive(ts):
+    arch_beg = crr_time.format_time(ts - 300)
+    arch_end = crr_time.format_time(ts)
+    verify_table(ddbtable)
+    if archive_index in table_indexes.get(ddbtable, ()):
+        items = query_completed(arch_beg)
+    else:
+        print('Index ' + archive_index + ' of ' + ddbtable + ' is not active. Scanning')
+        items = scan_completed(arch_beg, arch_end)
+    print('Archiving ' + str(len(items)) + ' items from ' + ddbtable + ' beg>=' + arch_beg + ' end=' + arch_end)
+    put_records([ json.dumps(i) + '\n' for i in items ])
+
+# The items whose end_datetime is in the window starting at arch_beg, from
+# every part of the window. Items written before end_bucket had parts have
+# the window alone.
+def query_completed(arch_beg):
+    items = []
+    keys = [ arch_beg + '#' + str(part) for part in range(archive_parts) ] + [ arch_beg ]
+    try:
+        crr_scan.query(
+            client['ddb']['handle'],
+            [ {
+                'TableName': ddbtable,
+                'IndexName': archive_index,
+                'KeyConditionExpression': 'end_bucket = :w',
+                'ExpressionAttributeValues': { ':w': { 'S': key } }
+            } for key in keys ],
+            items.append)
+    except Exception as e:
+        check_missing_table(e, ddbtable)
+        raise e
+    return items
+
+def scan_completed(arch_beg, arch_end):
+    return crr_scan.scan_items(
+        client['ddb']['handle'],
+        {
+            'TableName': ddbtable,
+            'FilterExpression': 'end_datetime >= :archbeg and end_datetime < :archend',
+            'ExpressionAttributeValues': {
+                ':archbeg': { 'S': arch_beg },
+                ':archend': { 'S': arch_end }
+            },
+            'Limit': 1000
+        },
+        archive_segments)
+
+# =====================================================================
+# put_records
+# -----------
+# Send records to the delivery stream with put_record_batch, in batches of
+# at most 500 records and 4 MB (the API limits). Records that fail are sent
+# again, with backoff, up to firehose_attempts times in all, then the
+# exception is raised.
+# =====================================================================
+def put_records(records):
+    batch = []
+    size = 0
+    for record in records:
+        if batch and (len(batch) == 500 or size + len(record) > 4 * 1024 * 1024):
+            put_record_batch(batch)
+            batch = []
+            size = 0
+        batch.append(record)
+        size += len(record)
+    if batch:
+        put_record_batch(batch)
+
+def put_record_batch(records):
+    attempt = 0
+    while records:
         try:
-            response = client['ddb']['handle'].scan(
-                TableName=ddbtable,
-                FilterExpression="timebucket <= :stats",
-                ExpressionAttributeValues=eav,
-                ExclusiveStartKey=response['LastEvaluatedKey'],
-                ConsistentRead=True
-                )
+            response = client['firehose']['handle'].put_record_batch(
+                DeliveryStreamName=kinesisfirestream,
+                Records=[ { 'Data': r } for r in records ]
+            )
         except Exception as e:
             print(e)
-            print('Table ' + ddbtable + ' scan failed')
+            print('Error saving ' + str(len(records)) + ' items from ' + ddbtable)
             raise e
-
-        for i in response['Items']:
-            post_stats(i)
-
-    # Archive to firehose
-    if stream_to_kinesis == 'Yes':
-        firehose(ts)
+        if not response.get('FailedPutCount'):
+            return
+        # Responses are in the same order as the records
+        records = [ r for r, result in zip(records, response['RequestResponses']) if 'ErrorCode' in result ]
+        attempt += 1
+        if attempt >= firehose_attempts:
+            raise Exception(str(len(records)) + ' items from ' + ddbtable + ' could not be saved to ' + kinesisfirestream)
+        time.sleep(0.05 * 2 ** attempt)
 
 def sol_helper(response):
     print('sol_helper')
     print(response)
     try:
-        cf = boto3.client('cloudformation')
+        cf = crr_clients.get_client('cloudformation')
         bucket_dict = []
         count = 1
         for item in response['Items']:
@@ -374,4 +603,8 @@ def sol_helper(response):
 
 
 ######## M A I N ########
+# Every thread that reads, publishes or archives can be using a client at
+# the same time
+crr_clients.configure(max_pool_connections=max(publish_threads, (stat_lookback + 1) * stat_parts,
+    archive_parts + 1, archive_segments))
 client = connect_clients(client)
@@ -1,10 +1,10 @@
 from __future__ import print_function
 
-import boto3
-
 # Unable to import module? You need to zip CRRdeployagent.py with
-# cfn_resource.py!!
+# cfn_resource.py, crr_clients.py and crr_instrument.py!!
 import cfn_resource
+import crr_clients
+import crr_instrument
 
 handler = cfn_resource.Resource()
 
@@ -31,13 +31,9 @@ client = {
 def connect_clients(clients_to_connect):
     for c in clients_to_connect:
         try:
-            if 'region' in clients_to_connect[c]:
-                clients_to_connect[c]['handle'] = boto3.client(
-                    clients_to_connect[c]['service'],
-                    region_name=clients_to_connect[c]['region'])
-            else:
-                clients_to_connect[c]['handle'] = boto3.client(
-                    clients_to_connect[c]['service'])
+            clients_to_connect[c]['handle'] = crr_clients.get_client(
+                clients_to_connect[c]['service'],
+                clients_to_connect[c].get('region'))
         except Exception as e:
             print(e)
             print('Error connecting to ' + clients_to_connect[c]['service'])
@@ -278,6 +274,7 @@ def remove_old_alarms(buckets):
 # CREATE
 #
 @handler.create
+@crr_instrument.invocation('CRRMonitorTrailAlarm')
 def create_trail_alarm(event, context):
     """handler to create CustomTrailAlarm resource"""
     print("CREATE EVENT {}".format(event))
@@ -292,6 +289,7 @@ client = connect_clients(client)
 # UPDATE
 #
 @handler.update
+@crr_instrument.invocation('CRRMonitorTrailAlarm')
 def update_trail_alarm(event, context):
 
     # 1) put_event_selectors for new buckets, remove event selectors for buckets that are no longer being monitored
@@ -306,6 +304,7 @@ def update_trail_alarm(event, context):
 # DELETE
 #
 @handler.delete
+@crr_instrument.invocation('CRRMonitorTrailAlarm')
 def delete_trail_alarm(event, context):
     buckets_prop = event['ResourceProperties']['buckets']
     trail_name = event['ResourceProperties']['trail_name']
@@ -315,7 +314,7 @@ def delete_trail_alarm(event, context):
     # events
     print("DELETE EVENT {}".format(event))
     try:
-        cwe = boto3.client('cloudwatch')
+        cwe = crr_clients.get_client('cloudwatch')
 
     except Exception as e:
         print(e)
@@ -0,0 +1,111 @@
+from __future__ import print_function
+
+import threading
+import boto3
+from botocore.config import Config
+# Unable to import module? You need to zip crr_clients.py with
+# crr_instrument.py!!
+import crr_instrument
+
+# =====================================================================
+# crr_clients
+# -----------
+# One boto3 client per (service, region), shared by everything in the
+# lambda and kept for the life of the container. All clients get the same
+# tuned botocore configuration:
+#
+# max_pool_connections: size of the HTTP connection pool. Set this to at
+#   least the number of threads that use a client at the same time, or
+#   calls queue for a connection. Connections in the pool are kept alive
+#   and reused between calls.
+# connect_timeout/read_timeout: seconds. The read timeout must be longer
+#   than the longest SQS long poll (20 seconds).
+# max_attempts: retries use botocore's adaptive mode, which backs off and
+#   rate limits the client itself when a service starts throttling.
+#
+# Every client is registered with crr_instrument, which times its calls
+# when instrumentation is on.
+#
+# Call configure() before the first client is created.
+# =====================================================================
+settings = {
+    'max_pool_connections': 10,
+    'connect_timeout': 5,
+    'read_timeout': 30,
+    'max_attempts': 5
+}
+
+clients = {}
+# Creating clients is not thread safe (using them is)
+lock = threading.Lock()
+
+def configure(**kwargs):
+    settings.update(kwargs)
+
+def client_config():
+    options = {
+        'max_pool_connections': settings['max_pool_connections'],
+        'connect_timeout': settings['connect_timeout'],
+        'read_timeout': settings['read_timeout'],
+        'retries': { 'mode': 'adaptive', 'max_attempts': settings['max_attempts'] }
+    }
+    try:
+        return Config(tcp_keepalive=True, **options)
+    except TypeError:
+        # Older botocore has no tcp_keepalive. Pooled connections are
+        # still reused.
+        return Config(**options)
+
+# =====================================================================
+# get_client
+# ----------
+# Return the client for a service in a region, creating it the first
+# time. region None is the lambda's own region.
+# =====================================================================
+def get_client(service, region=None):
+    handle = clients.get((service, region))
+    if handle is None:
+        with lock:
+            handle = clients.get((service, region))
+            if handle is None:
+                try:
+                    if region:
+                        handle = boto3.client(service, region_name=region, config=client_config())
+                    else:
+                        handle = boto3.client(service, config=client_config())
+                except Exception as e:
+                    print(e)
+                    print('Error connecting to ' + service)
+                    raise e
+                crr_instrument.register(handle)
+                clients[(service, region)] = handle
+    return handle
+
+# =====================================================================
+# bucket_region
+# -------------
+# The region a bucket is in, from its location. Raises if the location
+# cannot be read.
+# =====================================================================
+def bucket_region(bucket):
+    location = get_client('s3').get_bucket_location(
+        Bucket=bucket
+    )['LocationConstraint']
+    # Buckets in us-east-1 have no location constraint, and some old
+    # buckets in eu-west-1 report EU
+    if not location:
+        return 'us-east-1'
+    if location == 'EU':
+        return 'eu-west-1'
+    return location
+
+# =====================================================================
+# prewarm
+# -------
+# Create the clients for a service in a list of regions now, so the first
+# call in each region does not pay for building the client.
+# =====================================================================
+def prewarm(service, regions):
+    for region in regions:
+        if region:
+            get_client(service, region)
@@ -1,12 +1,36 @@
 from __future__ import print_function
 
-import boto3
+import json
 # Unable to import module? You need to zip CRRdeployagent.py with
-# cfn_resource.py!!
+# cfn_resource.py, crr_clients.py and crr_instrument.py!!
 import cfn_resource
+import crr_clients
+import crr_instrument
 
 handler = cfn_resource.Resource()
 
+# The CRRAgent rules only match writes to the monitored buckets. Each
+# rule's EventPattern must fit in this many characters, so the buckets in
+# a region are split across as many rules (CRRAgent-1, CRRAgent-2, ...) as
+# needed.
+max_pattern = 2048
+rule_prefix = 'CRRAgent'
+
+# Only these fields of the CloudTrail record are sent on to CRRMonitor.
+# Placeholders are not quoted so EventBridge inserts them as JSON strings.
+# version is null for writes to buckets without versioning.
+agent_input = {
+    'InputPathsMap': {
+        'region': '$.region',
+        'bucket': '$.detail.requestParameters.bucketName',
+        'key': '$.detail.requestParameters.key',
+        'eventTime': '$.detail.eventTime',
+        'eventID': '$.detail.eventID',
+        'version': '$.detail.responseElements.x-amz-version-id'
+    },
+    'InputTemplate': '{"region": <region>, "bucket": <bucket>, "key": <key>, "eventTime": <eventTime>, "eventID": <eventID>, "version": <version>}'
+}
+
 
 ###########Get Buckets and Agent Region #################
 
@@ -19,7 +43,7 @@ def get_replica_buckets(client, list_buckets):
 
     :Returns:
 
-      replica_buckets: list of destination buckets
+      replica_buckets: list of destination buckets of every enabled rule
 
       source_buckets: list of names of the buckets with CRR enabled
     """
@@ -29,11 +53,16 @@ def get_replica_buckets(client, list_buckets):
         source_buckets = []
         for bucket in list_buckets:
             bucket_response = get_bucket_replication(bucket['Name'], client)
-            if 'ReplicationConfigurationError-' != bucket_response \
-                    and bucket_response['ReplicationConfiguration']['Rules'][0]['Status'] != 'Disabled':
-                source_buckets.append(bucket['Name'])
-                dest_bucket_arn = bucket_response['ReplicationConfiguration']['Rules'][0]['Destination']['Bucket']
-                replica_buckets.append(dest_bucket_arn.split(':',5)[5])
+            if 'ReplicationConfigurationError-' == bucket_response:
+                continue
+            for rule in bucket_response['ReplicationConfiguration']['Rules']:
+                if rule['Status'] == 'Disabled':
+                    continue
+                if bucket['Name'] not in source_buckets:
+                    source_buckets.append(bucket['Name'])
+                dest_bucket = rule['Destination']['Bucket'].split(':',5)[5]
+                if dest_bucket not in replica_buckets:
+                    replica_buckets.append(dest_bucket)
     except Exception as e:
         print(e)
         raise e
@@ -56,7 +85,7 @@ def get_bucket_replication(bucket_name,client):
     return response
 
 def get_source_buckets(buckets_prop):
-    client = boto3.client('s3')
+    client = crr_clients.get_client('s3')
     all_buckets = client.list_buckets()['Buckets']
     if buckets_prop == 'ALL':
         final_bucket_list = all_buckets
@@ -69,44 +98,86 @@ def get_source_buckets(buckets_prop):
                 final_bucket_list.append(bucket)
     return final_bucket_list
 
-#Gets the list of agent regions for Agent deployment
+#Gets the source and replica buckets in each region for Agent deployment
 
-def get_agent_regions(src_bucket_list):
-    print('AgentRegionList:')
+def get_agent_buckets(src_bucket_list):
+    print('AgentBucketList:')
     try:
-        client = boto3.client('s3')
+        client = crr_clients.get_client('s3')
         replica_buckets, source_buckets = get_replica_buckets(client, src_bucket_list)
-        agent_set = set([])
-        for bucket in replica_buckets:
-            response = client.get_bucket_location(
-                Bucket=bucket
-            )
-            region = response['LocationConstraint']
-            if region is None:
-                agent_set.add('us-east-1') ## Location constraint for all us-east bucket returns a null as in S3
-            else:
-                agent_set.add(region)
-        for bucket in source_buckets:
-            response = client.get_bucket_location(
-                Bucket=bucket
-            )
-            region = response['LocationConstraint']
-            if region is None:
-                agent_set.add('us-east-1') ## Location constraint for all us-east bucket returns a null as in S3
-            else:
-                agent_set.add(region)
-        agent_regions = list(agent_set)
-        print(agent_regions)
+        agent_buckets = {}
+        for bucket in set(replica_buckets + source_buckets):
+            region = crr_clients.bucket_region(bucket)
+            agent_buckets.setdefault(region, []).append(bucket)
+        print(agent_buckets)
     except Exception as e:
         print(e)
         raise e
+    return agent_buckets
+
+#Gets the list of agent regions for Agent deployment
+
+def get_agent_regions(src_bucket_list):
+    print('AgentRegionList:')
+    agent_regions = list(get_agent_buckets(src_bucket_list).keys())
+    print(agent_regions)
     return agent_regions
 
+# Event patterns matching object writes to the buckets, each no longer
+# than max_pattern
+
+def agent_patterns(buckets):
+    def pattern(names):
+        return json.dumps({
+            'detail-type': [ 'AWS API Call via CloudTrail' ],
+            'detail': {
+                'eventSource': [ 's3.amazonaws.com' ],
+                'eventName': [ 'PutObject', 'CopyObject', 'CompleteMultipartUpload' ],
+                'requestParameters': { 'bucketName': names }
+            }
+        })
+    patterns = []
+    names = []
+    for bucket in sorted(buckets):
+        if names and len(pattern(names + [ bucket ])) > max_pattern:
+            patterns.append(pattern(names))
+            names = []
+        names.append(bucket)
+    if names:
+        patterns.append(pattern(names))
+    return patterns
+
+# Remove the CRRAgent rules in a region, other than those named in keep.
+# This includes the single catch-all rule older versions installed.
+
+def delete_agent_rules(cwe, keep):
+    rules = []
+    kwargs = { 'NamePrefix': rule_prefix }
+    while True:
+        response = cwe.list_rules(**kwargs)
+        rules += [ r['Name'] for r in response['Rules'] ]
+        if not response.get('NextToken'):
+            break
+        kwargs['NextToken'] = response['NextToken']
+    for rule in rules:
+        if rule in keep:
+            continue
+        targets = [ t['Id'] for t in cwe.list_targets_by_rule(Rule=rule)['Targets'] ]
+        if targets:
+            cwe.remove_targets(Rule=rule, Ids=targets)
+        cwe.delete_rule(Name=rule)
+
+# Create the clients the agent uses in each region up front
+
+def prewarm_agent_clients(agent_regions):
+    for service in ['events', 'sns']:
+        crr_clients.prewarm(service, agent_regions)
+
 # =====================================================================
 # CREATE
 #
 @handler.create
-
+@crr_instrument.invocation('CRRDeployAgent')
 def create_agent(event, context):
 
     topic_name = event["ResourceProperties"]["Topic"] # SNS topic
@@ -120,14 +191,16 @@ def create_agent(event, context):
     ##Enable time to Live for DynamoDB table CRRMonitor
     time_to_live(table_name, monitor_region)
 
-    agent_regions = get_agent_regions(final_bucket_list)
+    agent_buckets = get_agent_buckets(final_bucket_list)
+    agent_regions = list(agent_buckets.keys())
+    prewarm_agent_clients(agent_regions)
     # Default value for returning resourceid
     physical_resource_id = {
         'PhysicalResourceId': 'CRRMonitorAgent-us-east-1'
     }
 
     for region in agent_regions:
-        physical_resource_id = agent_creator(region, topic_name, queue_arn)
+        physical_resource_id = agent_creator(region, topic_name, queue_arn, agent_buckets[region])
 
     return physical_resource_id
 
@@ -136,7 +209,7 @@ def time_to_live(table_name, region):
     # Create client connections
     #
     try:
-        client = boto3.client(service_name='dynamodb', region_name=region)
+        client = crr_clients.get_client('dynamodb', region)
 
         response = client.update_time_to_live(
             TableName=table_name,
@@ -151,9 +224,7 @@ def time_to_live(table_name, region):
         print('Error enabling itemttl')
         raise e
 
-def agent_creator(agt_region, topic_name, queue_arn):
-
-    boto3.setup_default_session(region_name=agt_region)
+def agent_creator(agt_region, topic_name, queue_arn, buckets):
 
     topic = topic_name + "-" + agt_region
     print("Deploy " + topic + " to " + agt_region)
@@ -162,28 +233,24 @@ def agent_creator(agt_region, topic_name, queue_arn):
     # Create client connections
     #
     try:
-        cwe = boto3.client('events')
-        sns = boto3.client('sns')
+        cwe = crr_clients.get_client('events', agt_region)
+        sns = crr_clients.get_client('sns', agt_region)
     except Exception as e:
         print(e)
         print('Error creating clients for ' + agt_region)
         raise e
 
     # -----------------------------------------------------------------
-    # Note: duplication is not a concern - we will replace the rule and
+    # Note: duplication is not a concern - we will replace the rules and
     # topic if they already exist
     #
-    # Create the CloudWatch Event rule in a disabled state.
     # Create an SNS topic
-    # Add a target to the rule to send to the new SNS topic
-    # Enable the rule
+    # Create the CloudWatch Event rules for the buckets in a disabled state.
+    # Add a target to each rule to send the event fields CRRMonitor needs
+    # to the new SNS topic
+    # Enable the rules
+    # Remove any rules left over from before
     try:
-        cwe.put_rule(
-            Description='Fires CRRMonitor for S3 events that indicate an object has been stored.',
-            Name='CRRAgent',
-            EventPattern="{ \"detail-type\": [ \"AWS API Call via CloudTrail\" ], \"detail\": { \"eventSource\": [ \"s3.amazonaws.com\"], \"eventName\": [ \"PutObject\", \"CopyObject\", \"CompleteMultipartUpload\" ] } }",
-            State='DISABLED'
-        )
         topicarn=sns.create_topic(Name=topic)['TopicArn']
         sns.set_topic_attributes(
             TopicArn=topicarn,
@@ -210,16 +277,28 @@ def agent_creator(agt_region, topic_name, queue_arn):
                 ',
 
         )
-        cwe.put_targets(
-            Rule='CRRAgent',
-            Targets=[
-                {
-                    'Id': 'CRRAgent-' + agt_region,
-                    'Arn': topicarn
-                }
-            ]
-        )
-        cwe.enable_rule( Name='CRRAgent' )
+        rules = []
+        for pattern in agent_patterns(buckets):
+            rule = rule_prefix + '-' + str(len(rules) + 1)
+            cwe.put_rule(
+                Description='Fires CRRMonitor for S3 events that indicate an object has been stored in a monitored bucket.',
+                Name=rule,
+                EventPattern=pattern,
+                State='DISABLED'
+            )
+            cwe.put_targets(
+                Rule=rule,
+                Targets=[
+                    {
+                        'Id': 'CRRAgent-' + agt_region,
+                        'Arn': topicarn,
+                        'InputTransformer': agent_input
+                    }
+                ]
+            )
+            cwe.enable_rule( Name=rule )
+            rules.append(rule)
+        delete_agent_rules(cwe, rules)
     except Exception as e:
         print(e)
         print('Error creating SNS topic and CW Event rule: ' + topic)
@@ -247,6 +326,7 @@ def agent_creator(agt_region, topic_name, queue_arn):
 # UPDATE
 #
 @handler.update
+@crr_instrument.invocation('CRRDeployAgent')
 def update_agent(event, context):
     topic_name = event["ResourceProperties"]["Topic"] # SNS topic
     queue_arn = event["ResourceProperties"]["CRRQueueArn"] # URL of the SQS Queue
@@ -256,14 +336,16 @@ def update_agent(event, context):
 
     final_bucket_list = get_source_buckets(buckets_prop)
 
-    agent_regions = get_agent_regions(final_bucket_list)
+    agent_buckets = get_agent_buckets(final_bucket_list)
+    agent_regions = list(agent_buckets.keys())
+    prewarm_agent_clients(agent_regions)
     # Default value for returning resourceid
     physical_resource_id = {
         'PhysicalResourceId': 'CRRMonitorAgent-us-east-1'
     }
 
     for region in agent_regions:
-        physical_resource_id = agent_creator(region, topic_name, queue_arn)
+        physical_resource_id = agent_creator(region, topic_name, queue_arn, agent_buckets[region])
 
     return physical_resource_id
 
@@ -272,6 +354,7 @@ def update_agent(event, context):
 # DELETE
 #
 @handler.delete
+@crr_instrument.invocation('CRRDeployAgent')
 def delete_agent(event, context):
     buckets_prop = event['ResourceProperties']['buckets']
     final_bucket_list = get_source_buckets(buckets_prop)
@@ -286,7 +369,6 @@ def delete_agent(event, context):
 
 def agent_deleter(agt_region, topic_name):
 
-    boto3.setup_default_session(region_name=agt_region)
     topic = topic_name + "-" + agt_region
     print("Delete " + topic + " in " + agt_region)
     # -----------------------------------------------------------------
@@ -294,9 +376,9 @@ def agent_deleter(agt_region, topic_name):
     #
     # events
     try:
-        cwe = boto3.client('events')
-        sns = boto3.client('sns')
-        sts = boto3.client('sts')
+        cwe = crr_clients.get_client('events', agt_region)
+        sns = crr_clients.get_client('sns', agt_region)
+        sts = crr_clients.get_client('sts', agt_region)
     except Exception as e:
         print(e)
         print('Error creating Events client for ' + agt_region)
@@ -308,21 +390,12 @@ def agent_deleter(agt_region, topic_name):
     myaccount = sts.get_caller_identity()['Account']
     topicarn = 'arn:aws:sns:' + agt_region + ':' + myaccount + ':' + topic
     # -----------------------------------------------------------------
-    # Remove the Targets
+    # Remove the Targets and delete the CW rules
     #
-    cwe.remove_targets(
-        Rule='CRRAgent',
-        Ids=[
-            'CRRAgent-' + agt_region,
-        ]
-    )
+    delete_agent_rules(cwe, [])
     # Delete the SNS topic
     sns.delete_topic(
         TopicArn=topicarn
     )
-    # Delete the CW rule
-    cwe.delete_rule(
-        Name='CRRAgent'
-    )
 
     return {}
@@ -0,0 +1,217 @@
+from __future__ import print_function
+
+import functools
+import json
+import math
+import os
+import threading
+import time
+
+# =====================================================================
+# crr_instrument
+# --------------
+# Times every AWS call a lambda makes, by service, operation and region,
+# using botocore's event hooks on the clients crr_clients creates:
+#   before-call      the call starts
+#   after-call       it finished (successfully or with an HTTP error),
+#                    after any retries
+#   after-call-error it failed without a response (connection errors).
+#                    botocore passes only the exception and the context,
+#                    so before-call keeps the operation name in the context
+#   needs-retry      after every attempt: throttled attempts are counted
+#
+# A hook never raises: an error in one is printed, and the call goes on
+# as if the hook were not there.
+#
+# Each handler is wrapped with @crr_instrument.invocation(name). When the
+# invocation ends it prints one JSON summary line with, for each
+# operation, the count, errors, retries, throttles, total/max time and a
+# latency histogram (milliseconds, in powers of two), and starts afresh.
+# Calls made while the container started are in the first summary.
+#
+# Off unless the lambda's environment has instrument = Yes. When it is
+# off no hooks are registered and invocation only checks the setting.
+# =====================================================================
+settings = {
+    'enabled': os.environ.get('instrument', 'No') == 'Yes'
+}
+
+throttle_codes = set([
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+    'TooManyRequestsException', 'ProvisionedThroughputExceededException', 'RequestLimitExceeded',
+    'SlowDown', 'RequestThrottled', 'PriorRequestNotComplete', 'EC2ThrottledException'
+])
+buckets = 16 # histogram buckets: <= 1ms, <= 2ms, ... <= 16s, and over
+
+calls = {} # (service, operation, region) -> totals
+lock = threading.Lock()
+
+def configure(**kwargs):
+    settings.update(kwargs)
+
+# =====================================================================
+# register
+# --------
+# Add the hooks to a new client. Called by crr_clients.
+# =====================================================================
+def register(client):
+    if not settings['enabled']:
+        return
+    try:
+        events = client.meta.events
+        service = client.meta.service_model.service_name
+        region = client.meta.region_name
+    except AttributeError:
+        # Not a botocore client
+        return
+
+    @quiet
+    def before_call(model=None, context=None, **kwargs):
+        if context is not None:
+            context['crr_instrument_start'] = time.time()
+            context['crr_instrument_operation'] = model.name
+
+    @quiet
+    def after_call(context=None, http_response=None, parsed=None, event_name='', **kwargs):
+        retries = ((parsed or {}).get('ResponseMetadata') or {}).get('RetryAttempts', 0)
+        error = http_response is not None and http_response.status_code >= 300
+        record(service, operation_name(context, event_name), region, context, error, retries)
+
+    @quiet
+    def after_call_error(context=None, event_name='', **kwargs):
+        record(service, operation_name(context, event_name), region, context, True, 0)
+
+    @quiet
+    def needs_retry(operation=None, response=None, **kwargs):
+        if response is None or operation is None:
+            return None
+        code = ((response[1] or {}).get('Error') or {}).get('Code')
+        if code in throttle_codes:
+            with lock:
+                totals(service, operation.name, region)['throttles'] += 1
+        # Never decide the retry: that is botocore's own handler
+        return None
+
+    # before-call stops at the first handler that returns a response, so
+    # ours goes first
+    events.register_first('before-call.*.*', before_call)
+    events.register('after-call.*.*', after_call)
+    events.register('after-call-error.*.*', after_call_error)
+    events.register('needs-retry.*.*', needs_retry)
+
+# Print, rather than raise, what goes wrong in a hook: botocore would
+# raise it in place of the call's own result or error
+def quiet(hook):
+    @functools.wraps(hook)
+    def wrapped(**kwargs):
+        try:
+            return hook(**kwargs)
+        except Exception as e:
+            print(e)
+            print('WARNING: crr_instrument could not record a call')
+            return None
+    return wrapped
+
+# The operation of a call: from before-call, or the last part of the
+# event name ('after-call-error.s3.HeadObject')
+def operation_name(context, event_name):
+    return (context or {}).get('crr_instrument_operation') or event_name.rsplit('.', 1)[-1]
+
+# Call with lock held
+def totals(service, operation, region):
+    key = (service, operation, region)
+    if key not in calls:
+        calls[key] = {
+            'count': 0,
+            'errors': 0,
+            'retries': 0,
+            'throttles': 0,
+            'total_ms': 0.0,
+            'max_ms': 0.0,
+            'histogram': [ 0 ] * (buckets + 1)
+        }
+    return calls[key]
+
+def record(service, operation, region, context, error, retries):
+    start = (context or {}).pop('crr_instrument_start', None)
+    (context or {}).pop('crr_instrument_operation', None)
+    if start is None:
+        return
+    ms = (time.time() - start) * 1000
+    if ms <= 1:
+        i = 0
+    else:
+        i = min(buckets, int(math.ceil(math.log(ms, 2))))
+    with lock:
+        t = totals(service, operation, region)
+        t['count'] += 1
+        t['errors'] += 1 if error else 0
+        t['retries'] += retries
+        t['total_ms'] += ms
+        t['max_ms'] = max(t['max_ms'], ms)
+        t['histogram'][i] += 1
+
+# The upper bound (ms) of the histogram bucket the q quantile is in
+def quantile(histogram, q):
+    total = sum(histogram)
+    rank = q * (total - 1)
+    seen = 0
+    for i, n in enumerate(histogram):
+        seen += n
+        if seen > rank:
+            return 2 ** i
+    return 2 ** buckets
+
+# =====================================================================
+# summary
+# -------
+# The summary for the calls recorded so far, as a dict, and clear them.
+# =====================================================================
+def summary(name, duration):
+    with lock:
+        recorded = calls.items()
+        calls.clear()
+    operations = []
+    for (service, operation, region), t in sorted(recorded):
+        operations.append({
+            'service': service,
+            'operation': operation,
+            'region': region,
+            'count': t['count'],
+            'errors': t['errors'],
+            'retries': t['retries'],
+            'throttles': t['throttles'],
+            'total_ms': round(t['total_ms'], 1),
+            'max_ms': round(t['max_ms'], 1),
+            'p50_ms': quantile(t['histogram'], 0.5) if t['count'] else None,
+            'p99_ms': quantile(t['histogram'], 0.99) if t['count'] else None,
+            # [ upper bound ms, count ] of the buckets that have calls
+            'histogram': [ [ 2 ** i, n ] for i, n in enumerate(t['histogram']) if n ]
+        })
+    return {
+        'crr_instrument': name,
+        'duration_ms': round(duration * 1000, 1),
+        'calls': sum([ o['count'] for o in operations ]),
+        'call_ms': round(sum([ o['total_ms'] for o in operations ]), 1),
+        'operations': operations
+    }
+
+# =====================================================================
+# invocation
+# ----------
+# Decorator for a lambda handler (event, context): prints the summary of
+# the calls made when the handler returns or raises.
+# =====================================================================
+def invocation(name):
+    def wrap(fn):
+        @functools.wraps(fn)
+        def handler(event, context):
+            if not settings['enabled']:
+                return fn(event, context)
+            start = time.time()
+            try:
+                return fn(event, context)
+            finally:
+                print(json.dumps(summary(name, time.time() - start), sort_keys=True))
+        return handler
+    return wrap
@@ -0,0 +1,108 @@
+from __future__ import print_function
+
+import json
+# Unable to import module? You need to zip crr_metrics.py with
+# crr_sketch.py!!
+import crr_sketch
+
+# =====================================================================
+# crr_metrics
+# -----------
+# The CloudWatch metrics published for a bucket pair and time bucket,
+# worked out from the totals in a statistic (objects, size, elapsed).
+# Housekeeping posts them with put_metric_data. CRRMonitor can instead
+# print them in CloudWatch Embedded Metric Format (EMF), which CloudWatch
+# Logs turns into the same metrics without the Statistics table.
+#
+# A statistic for dest bucket FAILED counts failed replications from the
+# source bucket.
+#
+# When the statistic has sketch bins (see crr_sketch) the replication
+# time (seconds) and throughput (bytes/second) of the objects are
+# published as distributions: the value of each bin with its count.
+# CloudWatch merges these across time buckets, shards, lambdas and the
+# two backends, so the p50/p90/p99 statistics of ReplicationLatency and
+# ReplicationThroughput cover every object. (Percentiles worked out here
+# could not be merged.)
+# =====================================================================
+namespace = 'CRRMonitor'
+distributions = [
+    ('ReplicationLatency', crr_sketch.latency, 'Seconds'),
+    ('ReplicationThroughput', crr_sketch.throughput, 'Bytes/Second')
+]
+units = dict([ (name, unit) for name, sketch, unit in distributions ])
+emf_values = 100 # the most values EMF takes for one metric in a document
+
+# =====================================================================
+# replication_metrics
+# -------------------
+# [ (metric name, [ (dimension, value) ], value) ]
+# bins is a dict of sketch bin counts, or None. The value of a
+# distribution is a list of (value, count).
+# =====================================================================
+def replication_metrics(Src, Dst, objects, size, elapsed, bins=None):
+    if Dst == 'FAILED':
+        return [ ('FailedReplications', [ ('SourceBucket', Src) ], objects) ]
+    dims = [ ('SourceBucket', Src), ('DestBucket', Dst) ]
+    metrics = [
+        ('ReplicationObjects', dims, objects),
+        # kbit/sec
+        ('ReplicationSpeed', dims, ((size * 8) / 1024) / (elapsed + 1))
+    ]
+    if bins:
+        for name, sketch, unit in distributions:
+            values = sketch.distribution(bins)
+            if values:
+                metrics.append((name, dims, values))
+    return metrics
+
+def is_distribution(value):
+    return isinstance(value, list)
+
+# =====================================================================
+# emf_documents
+# -------------
+# The metrics for one statistic as EMF log lines. timestamp is the time
+# bucket, in seconds since the epoch. EMF has no counts, so each value of
+# a distribution is repeated count times, emf_values to a document.
+# =====================================================================
+def emf_documents(Src, Dst, timestamp, objects, size, elapsed, bins=None):
+    metrics = replication_metrics(Src, Dst, objects, size, elapsed, bins)
+    dims = metrics[0][1]
+    # [ [ (name, value) ] ] for each document
+    documents = [ [] ]
+    for name, d, value in metrics:
+        if not is_distribution(value):
+            documents[0].append((name, value))
+            continue
+        values = []
+        for v, n in value:
+            values += [ v ] * n
+        for n, i in enumerate(range(0, len(values), emf_values)):
+            if n == len(documents):
+                documents.append([])
+            documents[n].append((name, values[i:i + emf_values]))
+    return [ emf_document(timestamp, dims, document) for document in documents ]
+
+def emf_document(timestamp, dims, metrics):
+    definitions = []
+    for name, value in metrics:
+        if name in units:
+            definitions.append({ 'Name': name, 'Unit': units[name] })
+        else:
+            definitions.append({ 'Name': name })
+    doc = {
+        '_aws': {
+            'Timestamp': int(timestamp) * 1000,
+            'CloudWatchMetrics': [ {
+                'Namespace': namespace,
+                'Dimensions': [ [ name for name, value in dims ] ],
+                'Metrics': definitions
+            } ]
+        }
+    }
+    for name, value in dims:
+        doc[name] = value
+    for name, value in metrics:
+        doc[name] = value
+    return json.dumps(doc)
@@ -0,0 +1,184 @@
+from __future__ import print_function
+
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+# Unable to import module? You need to zip crr_rules.py with
+# crr_clients.py and crr_instrument.py!!
+import crr_clients
+
+# =====================================================================
+# crr_rules
+# ---------
+# An index of the replication rules of every bucket in the account, so an
+# event for an object that no rule can replicate is dropped before we
+# spend a head_object on it.
+#
+# For each bucket the index holds the filters of every enabled rule that
+# replicates from it, plus those of every rule that replicates into it
+# (replicas are written under the same key). A filter is a prefix and the
+# tags the object must have. Events do not carry the object's tags, so
+# unless the caller has them only the prefix can rule an object out.
+#
+# The index also holds the regions of the replicated buckets, so the
+# caller can create its clients for them before the first event.
+#
+# The index is built once per container and rebuilt every ttl seconds.
+# Anything we are not sure about is let through: a bucket created since
+# the last build, a bucket whose rules could not be read, or no index at
+# all because it could not be built.
+# =====================================================================
+settings = {
+    'ttl': 600,
+    'threads': 16
+}
+
+index = None # { 'filters': { bucket: [ (prefix, tags) ] }, 'regions': [ region ], 'built': time }
+counts = { 'dropped': 0 }
+lock = threading.Lock() # held while the index is built
+countlock = threading.Lock()
+
+def configure(**kwargs):
+    settings.update(kwargs)
+
+# =====================================================================
+# may_replicate
+# -------------
+# False if no replication rule can apply to this object. tags, if known,
+# is a dict of the object's tags.
+# =====================================================================
+def may_replicate(bucket, key, tags=None):
+    idx = get_index()
+    if idx is None or bucket not in idx['filters']:
+        return True
+    for prefix, ruletags in idx['filters'][bucket]:
+        if key.startswith(prefix) and (tags is None or all(tags.get(k) == v for k, v in ruletags)):
+            return True
+    with countlock:
+        counts['dropped'] += 1
+    return False
+
+# The regions of the buckets that replicate or are replicated to
+def regions():
+    idx = get_index()
+    if idx is None:
+        return []
+    return idx.get('regions', [])
+
+def summary():
+    with countlock:
+        return 'Not replicated: ' + str(counts['dropped'])
+
+# =====================================================================
+# get_index
+# ---------
+# Return the index, building it if it is missing or older than ttl. Only
+# one thread rebuilds: the others carry on with the old index meanwhile.
+# =====================================================================
+def get_index():
+    global index
+    current = index
+    if current is not None and current['built'] + settings['ttl'] > time.time():
+        return current
+    # Wait for the first build, but not for a refresh
+    if not lock.acquire(current is None):
+        return current
+    try:
+        if index is current:
+            try:
+                index = build_index()
+            except Exception as e:
+                print(e)
+                print('WARNING: could not read replication rules. Not filtering events')
+                # Try again after another ttl
+                index = { 'filters': {}, 'regions': [], 'built': time.time() }
+    finally:
+        lock.release()
+    return index
+
+def build_index():
+    s3 = crr_clients.get_client('s3')
+    buckets = [ b['Name'] for b in s3.list_buckets()['Buckets'] ]
+    filters = {}
+    regions = set()
+    if buckets:
+        pool = ThreadPool(min(settings['threads'], len(buckets)))
+        try:
+            rules = pool.map(get_rules, buckets)
+            # Sources and destinations. Destinations in other accounts
+            # are left out.
+            replicated = set()
+            for bucket, bucket_rules in zip(buckets, rules):
+                for dest, rulefilter in bucket_rules or []:
+                    replicated.add(bucket)
+                    replicated.add(dest)
+            regions.update(pool.map(get_region, [ b for b in buckets if b in replicated ]))
+            regions.discard(None)
+        finally:
+            pool.close()
+        for bucket, bucket_rules in zip(buckets, rules):
+            if bucket_rules is None:
+                continue
+            filters.setdefault(bucket, [])
+            for dest, rulefilter in bucket_rules:
+                filters[bucket].append(rulefilter)
+                filters.setdefault(dest, []).append(rulefilter)
+        # Let everything through for buckets whose own rules are unknown,
+        # even if they are also a destination
+        for bucket, bucket_rules in zip(buckets, rules):
+            if bucket_rules is None:
+                filters.pop(bucket, None)
+    print('Replication rules: ' + str(len([ b for b in buckets if filters.get(b) ])) + ' of ' + str(len(buckets)) + ' buckets are replicated')
+    return { 'filters': filters, 'regions': sorted(regions), 'built': time.time() }
+
+# =====================================================================
+# get_rules
+# ---------
+# [ (destination bucket, (prefix, tags)) ] for every enabled rule of a
+# bucket. [] if it has no replication configuration, None if it could not
+# be read.
+# =====================================================================
+def get_rules(bucket):
+    try:
+        config = crr_clients.get_client('s3').get_bucket_replication(
+            Bucket=bucket
+        )['ReplicationConfiguration']
+    except Exception as e:
+        if getattr(e, 'response', {}).get('Error', {}).get('Code') == 'ReplicationConfigurationNotFoundError':
+            return []
+        print(e)
+        print('WARNING: could not read the replication rules of ' + bucket)
+        return None
+    rules = []
+    for rule in config.get('Rules', []):
+        if rule.get('Status') != 'Enabled':
+            continue
+        dest = rule['Destination']['Bucket'].split(':', 5)[5]
+        rules.append((dest, rule_filter(rule)))
+    return rules
+
+# The region of a bucket, None if it could not be read
+def get_region(bucket):
+    try:
+        return crr_clients.bucket_region(bucket)
+    except Exception as e:
+        print(e)
+        print('WARNING: could not read the location of ' + bucket)
+        return None
+
+# Rules written before filters were added to the API have a top level
+# Prefix. Newer ones have a Filter with a Prefix, a Tag, or an And of a
+# Prefix and Tags.
+def rule_filter(rule):
+    if 'Filter' in rule:
+        f = rule['Filter']
+        if 'And' in f:
+            prefix = f['And'].get('Prefix', '')
+            tags = f['And'].get('Tags', [])
+        else:
+            prefix = f.get('Prefix', '')
+            tags = [ f['Tag'] ] if 'Tag' in f else []
+    else:
+        prefix = rule.get('Prefix', '')
+        tags = []
+    return (prefix, tuple([ (t['Key'], t['Value']) for t in tags ]))
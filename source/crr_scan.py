@@ -0,0 +1,127 @@
+from __future__ import print_function
+
+import threading
+import Queue
+
+# =====================================================================
+# crr_scan
+# --------
+# Parallel scan of a DynamoDB table. The table is split into segments
+# (Segment/TotalSegments) and each segment is scanned, page by page, by
+# its own thread. The items are put on a bounded queue that a pool of
+# worker threads takes them from, so the head_object and update calls for
+# one page overlap the scan of the next. When the workers fall behind the
+# scanners wait for room on the queue rather than reading the table into
+# memory.
+#
+# With no workers the segment threads call process themselves, which is
+# what a caller that only collects the items wants.
+#
+# A list of queries (for example one per key of a sharded index) is read
+# the same way, a thread per query.
+#
+# If process or a scan raises, the scan stops: the other scanners stop at
+# their next page, items still queued are dropped, and the first exception
+# is raised once every thread has finished.
+# =====================================================================
+done = object() # tells a worker there are no more items
+
+# =====================================================================
+# scan
+# ----
+# Scan with the scan parameters in params (TableName, FilterExpression...)
+# and call process(item) for each item. Returns the number of items.
+# =====================================================================
+def scan(ddb, params, process, segments=1, workers=0, depth=1000):
+    requests = []
+    for segment in range(segments):
+        kwargs = dict(params)
+        if segments > 1:
+            kwargs['Segment'] = segment
+            kwargs['TotalSegments'] = segments
+        requests.append(kwargs)
+    return read(ddb.scan, 'scan', requests, process, workers, depth)
+
+# =====================================================================
+# query
+# -----
+# Run each of a list of queries (query parameters, as for scan) and call
+# process(item) for each item. Returns the number of items.
+# =====================================================================
+def query(ddb, requests, process, workers=0, depth=1000):
+    return read(ddb.query, 'query', requests, process, workers, depth)
+
+# Read the pages of each request in its own thread
+def read(operation, name, requests, process, workers, depth):
+    items = Queue.Queue(depth)
+    errors = []
+    counts = [ 0 ] * len(requests)
+
+    def fail(e, table):
+        if not errors:
+            print(e)
+            print('Table ' + table + ' ' + name + ' failed')
+        errors.append(e)
+
+    def read_pages(n):
+        kwargs = dict(requests[n])
+        try:
+            while not errors:
+                response = operation(**kwargs)
+                counts[n] += len(response['Items'])
+                for item in response['Items']:
+                    if workers:
+                        items.put(item)
+                    else:
+                        process(item)
+                if 'LastEvaluatedKey' not in response:
+                    return
+                kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        except Exception as e:
+            fail(e, kwargs['TableName'])
+
+    def work():
+        # Workers keep taking items after a failure, without processing
+        # them, so no reader is left waiting on a full queue
+        while True:
+            item = items.get()
+            if item is done:
+                return
+            if errors:
+                continue
+            try:
+                process(item)
+            except Exception as e:
+                fail(e, requests[0]['TableName'])
+
+    readers = start(read_pages, range(len(requests)))
+    pool = start(work, [ None ] * workers)
+    for t in readers:
+        t.join()
+    for t in pool:
+        items.put(done)
+    for t in pool:
+        t.join()
+    if errors:
+        raise errors[0]
+    return sum(counts)
+
+# Start a thread for each argument. None calls fn with no arguments.
+def start(fn, args):
+    threads = []
+    for arg in args:
+        t = threading.Thread(target=fn, args=() if arg is None else (arg,))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    return threads
+
+# =====================================================================
+# scan_items
+# ----------
+# Every item the scan returns, as a list (in no particular order).
+# =====================================================================
+def scan_items(ddb, params, segments=1):
+    items = []
+    scan(ddb, params, items.append, segments)
+    return items
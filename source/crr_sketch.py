@@ -0,0 +1,88 @@
+from __future__ import print_function
+
+import math
+
+# =====================================================================
+# crr_sketch
+# ----------
+# Quantile sketches of replication latency and throughput, in the style of
+# DDSketch. Values are counted in logarithmically sized bins: bin 0 holds
+# everything up to min, bin i (i > 0) holds (min * gamma^(i-1), min *
+# gamma^i], and the last bin also holds everything above the range. Any
+# quantile read back is within (gamma - 1) / (gamma + 1) of the true value
+# (about 17% for gamma 1.4) when it falls inside the range.
+#
+# A sketch is stored as a dict of bin counts keyed by attribute name
+# ('lat_07': 12). Sketches merge by adding counts, so in the Statistics
+# table each bin is a top level number attribute that CRRMonitor ADDs to,
+# and Housekeeping adds the bins of the shards together. The number of
+# bins is fixed, so so is the most a sketch can add to an item.
+# =====================================================================
+class Sketch(object):
+    def __init__(self, prefix, min, gamma, bins):
+        self.prefix = prefix
+        self.min = float(min)
+        self.gamma = gamma
+        self.bins = bins
+        self.loggamma = math.log(gamma)
+
+    # The attribute name of the bin a value falls in
+    def bin(self, value):
+        if value <= self.min:
+            i = 0
+        else:
+            i = min(self.bins - 1, int(math.ceil(math.log(value / self.min) / self.loggamma)))
+        return self.prefix + '%02d' % i
+
+    def is_bin(self, attr):
+        return attr.startswith(self.prefix)
+
+    # The value reported for a bin: the point with the same relative
+    # error to either end of it
+    def value(self, i):
+        if i == 0:
+            return self.min
+        return self.min * 2 * self.gamma ** i / (self.gamma + 1)
+
+    # =================================================================
+    # quantile
+    # --------
+    # The q quantile (0 <= q <= 1) of the values counted in counts, a
+    # dict of { attribute: count } that may also hold other attributes.
+    # None if nothing has been counted.
+    # =================================================================
+    def quantile(self, counts, q):
+        bins = sorted([ (int(attr[len(self.prefix):]), n) for attr, n in counts.items() if self.is_bin(attr) and n > 0 ])
+        total = sum([ n for i, n in bins ])
+        if not total:
+            return None
+        rank = q * (total - 1)
+        seen = 0
+        for i, n in bins:
+            seen += n
+            if seen > rank:
+                return self.value(i)
+        return self.value(bins[-1][0])
+
+    # The [ (value, count) ] of the bins that have counts, smallest first:
+    # the sketch as a distribution CloudWatch can take percentiles of
+    def distribution(self, counts):
+        bins = sorted([ (int(attr[len(self.prefix):]), n) for attr, n in counts.items() if self.is_bin(attr) and n > 0 ])
+        return [ (self.value(i), n) for i, n in bins ]
+
+# Seconds from source write to replica write: 1 second to 13 hours
+latency = Sketch('lat_', 1, 1.4, 32)
+# Bytes per second: 1 KB/s to 10 GB/s
+throughput = Sketch('bps_', 1024, 1.4, 48)
+
+sketches = [ latency, throughput ]
+
+# The bins for one replication, as a list of attribute names
+def replication_bins(size, elapsed):
+    return [ latency.bin(elapsed), throughput.bin(float(size) / max(elapsed, 1)) ]
+
+def is_bin(attr):
+    for s in sketches:
+        if s.is_bin(attr):
+            return True
+    return False
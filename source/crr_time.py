@@ -0,0 +1,100 @@
+from __future__ import print_function
+
+import time
+import zlib
+
+# =====================================================================
+# crr_time
+# --------
+# Timestamp handling shared by the CRR Monitor lambdas. Every timestamp
+# we deal with is a CloudTrail eventTime (or something we wrote from one)
+# in the fixed format below, so it is parsed with integer arithmetic into
+# seconds since the epoch rather than with datetime.strptime. Time buckets
+# are rounded the same way the lambdas always have: within the day, to
+# the nearest multiple of roundTo seconds.
+# =====================================================================
+timefmt = '%Y-%m-%dT%H:%M:%SZ'
+
+# Formatted strings for recently used times. Statistics land in a handful
+# of time buckets so nearly every lookup is a hit.
+_formatted = {}
+_max_formatted = 4096
+
+# =====================================================================
+# parse_time
+# ----------
+# '2017-02-09T13:56:03Z' -> seconds since the epoch
+# =====================================================================
+def parse_time(ts):
+    if len(ts) != 20 or ts[4] != '-' or ts[10] != 'T' or ts[19] != 'Z':
+        raise ValueError('time data ' + repr(ts) + ' does not match format ' + repr(timefmt))
+    days = _days_from_civil(int(ts[0:4]), int(ts[5:7]), int(ts[8:10]))
+    return days * 86400 + int(ts[11:13]) * 3600 + int(ts[14:16]) * 60 + int(ts[17:19])
+
+# Days since 1970-01-01 of a date in the proleptic Gregorian calendar
+def _days_from_civil(y, m, d):
+    if m <= 2:
+        y -= 1
+    era = (y if y >= 0 else y - 399) // 400
+    yoe = y - era * 400
+    doy = (153 * (m + (-3 if m > 2 else 9)) + 2) // 5 + d - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+# =====================================================================
+# format_time
+# -----------
+# seconds since the epoch -> '2017-02-09T13:56:03Z'
+# =====================================================================
+def format_time(secs):
+    secs = int(secs)
+    ts = _formatted.get(secs)
+    if ts is None:
+        ts = time.strftime(timefmt, time.gmtime(secs))
+        if len(_formatted) >= _max_formatted:
+            _formatted.clear()
+        _formatted[secs] = ts
+    return ts
+
+# =====================================================================
+# round_up / round_down
+# ---------------------
+# Round a time (seconds since the epoch) to a roundTo second time bucket.
+# CRRMonitor logs statistics forward, to the nearest bucket (round_up).
+# Housekeeping reads the bucket that was last logged to (round_down).
+# Fractions of a second are dropped.
+# =====================================================================
+def round_up(secs, roundTo):
+    secs = int(secs)
+    day = secs % 86400
+    return secs - day + (day + roundTo // 2) // roundTo * roundTo
+
+def round_down(secs, roundTo):
+    secs = int(secs)
+    day = secs % 86400
+    return secs - day + (day - roundTo // 2) // roundTo * roundTo
+
+# =====================================================================
+# timebucket
+# ----------
+# The statistics time bucket for a timestamp string.
+# =====================================================================
+def timebucket(ts, roundTo):
+    return format_time(round_up(parse_time(ts), roundTo))
+
+# The start of the size second window a time (seconds) falls in. Windows
+# are aligned to the epoch, so to the day for sizes that divide it.
+def window_start(secs, size):
+    secs = int(secs)
+    return secs - secs % size
+
+# The day of a timestamp string, '2017-02-09'
+def day(ts):
+    return ts[0:10]
+
+# The statday of a statistic, '2017-02-09#3': the day of its time bucket
+# and a part, 0 to parts - 1, picked by its key. Housekeeping reads the
+# statistics through an index on statday, and the parts spread the writes
+# of a day over that many index keys.
+def statday(timebucket, key, parts):
+    return day(timebucket) + '#' + str((zlib.crc32(key) & 0xffffffff) % parts)
@@ -0,0 +1,63 @@
+from __future__ import print_function
+
+import os
+import sys
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'source'))
+import boto3
+from botocore.config import Config
+import crr_instrument
+
+# =====================================================================
+# test_crr_instrument
+# -------------------
+# The hooks crr_instrument registers must record a call without changing
+# what it returns or raises. These use real botocore clients pointed at a
+# port nothing listens on, so every call fails without a response.
+#
+#   python2.7 tests/test_crr_instrument.py
+# =====================================================================
+# Made from a session of its own, as other tests replace boto3.client
+def unreachable(service):
+    client = boto3.session.Session().client(service, region_name='us-east-1', endpoint_url='http://127.0.0.1:1',
+        aws_access_key_id='test', aws_secret_access_key='test',
+        config=Config(retries={ 'max_attempts': 0 }, connect_timeout=1))
+    crr_instrument.register(client)
+    return client
+
+class TestHooks(unittest.TestCase):
+    def setUp(self):
+        crr_instrument.configure(enabled=True)
+        crr_instrument.summary('test', 0)
+
+    def tearDown(self):
+        crr_instrument.configure(enabled=False)
+
+    # after-call-error has no model: the operation comes from before-call
+    def test_connection_error(self):
+        s3 = unreachable('s3')
+        with self.assertRaises(Exception) as raised:
+            s3.head_object(Bucket='bucket', Key='key')
+        self.assertEqual(type(raised.exception).__name__, 'EndpointConnectionError')
+        operations = crr_instrument.summary('test', 0)['operations']
+        self.assertEqual([ (o['service'], o['operation'], o['count'], o['errors']) for o in operations ],
+            [ ('s3', 'HeadObject', 1, 1) ])
+
+    # A hook that fails does not replace the error of the call
+    def test_failing_hook(self):
+        record = crr_instrument.record
+        def fail(*args):
+            raise ValueError('hook failed')
+        crr_instrument.record = fail
+        try:
+            sqs = unreachable('sqs')
+            with self.assertRaises(Exception) as raised:
+                sqs.get_queue_url(QueueName='queue')
+        finally:
+            crr_instrument.record = record
+        self.assertEqual(type(raised.exception).__name__, 'EndpointConnectionError')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,305 @@
+from __future__ import print_function
+
+import calendar
+import json
+import os
+import random
+import sys
+import time
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'source'))
+sys.path.insert(0, os.path.join(here, '..', 'benchmarks'))
+import crr_metrics
+import crr_sketch
+import fakes
+
+# =====================================================================
+# test_crr_metrics
+# ----------------
+# The EMF documents CRRMonitor prints (metrics_backend emf or both) must
+# turn into the same CloudWatch metrics Housekeeping posts with
+# put_metric_data for the same totals. The metrics the lambdas posted
+# before crr_metrics existed are kept here as the reference. The latency
+# and throughput distributions must hold the same values both ways.
+#
+#   python2.7 tests/test_crr_metrics.py
+# =====================================================================
+timefmt = '%Y-%m-%dT%H:%M:%SZ'
+
+# CRRMonitorHousekeeping.post_stats: the MetricData it posted for a
+# statistics item, one put_metric_data call per datum
+def old_datums(item):
+    ts=item['timebucket']['S']
+    if item['dest_bucket']['S'] == 'FAILED':
+        return [ {
+            'MetricName': 'FailedReplications',
+            'Dimensions': [ { 'Name': 'SourceBucket', 'Value': item['source_bucket']['S'] } ],
+            'Timestamp': ts,
+            'Value': int(item['objects']['N'])
+        } ]
+    dims = [
+        { 'Name': 'SourceBucket', 'Value': item['source_bucket']['S'] },
+        { 'Name': 'DestBucket', 'Value': item['dest_bucket']['S'] }
+    ]
+    return [ {
+        'MetricName': 'ReplicationObjects',
+        'Dimensions': dims,
+        'Timestamp': ts,
+        'Value': int(item['objects']['N'])
+    }, {
+        'MetricName': 'ReplicationSpeed',
+        'Dimensions': dims,
+        'Timestamp': ts,
+        'Value': ((int(item['size']['N'])*8)/1024)/(int(item['elapsed']['N'])+1)
+    } ]
+
+def random_item(rnd):
+    Src = 'src-%d' % rnd.randrange(5)
+    Dst = rnd.choice([ 'dst-%d' % rnd.randrange(5), 'FAILED' ])
+    secs = rnd.randrange(1483228800, 1767225600) // 300 * 300
+    objects = rnd.randrange(0, 10000)
+    return {
+        'OriginReplicaBucket': { 'S': Src + ':' + Dst + ':' + time.strftime(timefmt, time.gmtime(secs)) },
+        'source_bucket': { 'S': Src },
+        'dest_bucket': { 'S': Dst },
+        'timebucket': { 'S': time.strftime(timefmt, time.gmtime(secs)) },
+        'objects': { 'N': str(objects) },
+        'size': { 'N': str(objects * rnd.randrange(0, 1 << 30)) },
+        'elapsed': { 'N': str(objects * rnd.randrange(0, 3600)) }
+    }
+
+# The EMF documents for an item, parsed
+def emf(item, bins=None):
+    return [ json.loads(doc) for doc in crr_metrics.emf_documents(item['source_bucket']['S'], item['dest_bucket']['S'],
+        calendar.timegm(time.strptime(item['timebucket']['S'], timefmt)),
+        int(item['objects']['N']), int(item['size']['N']), int(item['elapsed']['N']), bins) ]
+
+# The metrics CloudWatch extracts from EMF documents, as datums. The
+# values of a metric in every document are taken together.
+def emf_datums(docs):
+    datums = {}
+    for doc in docs:
+        for directive in doc['_aws']['CloudWatchMetrics']:
+            for dimset in directive['Dimensions']:
+                for metric in directive['Metrics']:
+                    value = doc[metric['Name']]
+                    datum = datums.setdefault(metric['Name'], {
+                        'Namespace': directive['Namespace'],
+                        'MetricName': metric['Name'],
+                        'Dimensions': [ { 'Name': name, 'Value': doc[name] } for name in dimset ],
+                        'Timestamp': doc['_aws']['Timestamp']
+                    })
+                    if 'Unit' in metric:
+                        datum['Unit'] = metric['Unit']
+                    if isinstance(value, list):
+                        datum['Values'] = datum.get('Values', []) + value
+                    else:
+                        datum['Value'] = value
+    return datums.values()
+
+# Values and Counts as a single list of values
+def expand(datum):
+    values = []
+    for v, n in zip(datum['Values'], datum.get('Counts', [ 1 ] * len(datum['Values']))):
+        values += [ v ] * n
+    return sorted(values)
+
+def by_name(datums):
+    return dict([ (d['MetricName'], d) for d in datums ])
+
+class TestEmf(unittest.TestCase):
+    def setUp(self):
+        self.rnd = random.Random(20170209)
+
+    def test_matches_old_metrics(self):
+        for n in range(2000):
+            item = random_item(self.rnd)
+            old = by_name(old_datums(item))
+            new = by_name(emf_datums(emf(item)))
+            self.assertEqual(sorted(new), sorted(old))
+            for name in old:
+                self.assertEqual(new[name]['Namespace'], 'CRRMonitor')
+                self.assertEqual(new[name]['Dimensions'], old[name]['Dimensions'])
+                self.assertEqual(new[name]['Value'], old[name]['Value'], (name, item))
+                # Milliseconds since the epoch
+                self.assertEqual(new[name]['Timestamp'],
+                    calendar.timegm(time.strptime(old[name]['Timestamp'], timefmt)) * 1000)
+
+    def test_failed(self):
+        item = random_item(self.rnd)
+        item['dest_bucket'] = { 'S': 'FAILED' }
+        docs = emf(item)
+        self.assertEqual(len(docs), 1)
+        self.assertEqual(docs[0]['_aws']['CloudWatchMetrics'][0]['Dimensions'], [ [ 'SourceBucket' ] ])
+        self.assertEqual([ d['MetricName'] for d in emf_datums(docs) ], [ 'FailedReplications' ])
+        self.assertNotIn('DestBucket', docs[0])
+
+    def test_replication_speed(self):
+        item = random_item(self.rnd)
+        item.update({ 'dest_bucket': { 'S': 'dst' }, 'size': { 'N': '1048576' }, 'elapsed': { 'N': '7' } })
+        self.assertEqual(by_name(emf_datums(emf(item)))['ReplicationSpeed']['Value'], 1048576 * 8 / 1024 / 8)
+
+# Latency and throughput are published as distributions, the same from
+# both backends, so CloudWatch can take percentiles over all of them
+class TestDistributions(unittest.TestCase):
+    def setUp(self):
+        self.rnd = random.Random(20170209)
+        self.item = random_item(self.rnd)
+        self.item['dest_bucket'] = { 'S': 'dst' }
+        self.bins = {}
+        for n in range(self.rnd.randrange(1, 1000)):
+            for attr in crr_sketch.replication_bins(self.rnd.randrange(1, 1 << 30), self.rnd.randrange(0, 20000)):
+                self.bins[attr] = self.bins.get(attr, 0) + 1
+        self.objects = sum([ n for attr, n in self.bins.items() if crr_sketch.latency.is_bin(attr) ])
+
+    def test_emf_matches_put_metric_data(self):
+        fakes.install(fakes.FakeAWS())
+        import CRRMonitorHousekeeping
+        item = dict(self.item)
+        for attr, n in self.bins.items():
+            item[attr] = { 'N': str(n) }
+        posted = by_name(CRRMonitorHousekeeping.stat_datums(item))
+        docs = emf(self.item, self.bins)
+        logged = by_name(emf_datums(docs))
+        self.assertEqual(sorted(logged), sorted(posted))
+        for name, sketch, unit in crr_metrics.distributions:
+            self.assertEqual(posted[name]['Unit'], unit)
+            self.assertEqual(logged[name]['Unit'], unit)
+            self.assertEqual(len(expand(posted[name])), self.objects)
+            self.assertEqual(expand(logged[name]), expand(posted[name]))
+            # No more than 150 distinct values in a datum
+            self.assertTrue(len(posted[name]['Values']) <= 150)
+        for doc in docs:
+            for name, sketch, unit in crr_metrics.distributions:
+                self.assertTrue(len(doc.get(name, [])) <= crr_metrics.emf_values)
+        # The totals are in one document only
+        self.assertEqual(len([ doc for doc in docs if 'ReplicationObjects' in doc ]), 1)
+
+    def test_percentiles_of_merged_distributions(self):
+        # Two flushes of the same pair: the percentiles of their combined
+        # values are those of the merged sketch
+        first = dict([ (attr, n // 2) for attr, n in self.bins.items() ])
+        second = dict([ (attr, n - n // 2) for attr, n in self.bins.items() ])
+        values = expand(by_name(emf_datums(emf(self.item, first)))['ReplicationLatency'])
+        values = sorted(values + expand(by_name(emf_datums(emf(self.item, second)))['ReplicationLatency']))
+        for q in [ 0.5, 0.9, 0.99 ]:
+            self.assertEqual(values[int(q * (len(values) - 1))], crr_sketch.latency.quantile(self.bins, q))
+
+class TestEmitMetrics(unittest.TestCase):
+    # CRRMonitor adds the shards of a statistic together into one document
+    def test_shards(self):
+        aws = fakes.install(fakes.FakeAWS())
+        aws.add_queue('CRRMonitorQueue')
+        import CRRMonitor
+        rnd = random.Random(20170209)
+        item = random_item(rnd)
+        Src, Dst, ts = item['source_bucket']['S'], item['dest_bucket']['S'], item['timebucket']['S']
+        shards = []
+        for n, share in enumerate([ 0.25, 0.75 ]):
+            shards.append((item['OriginReplicaBucket']['S'] + '#' + str(n), {
+                'source_bucket': Src,
+                'dest_bucket': Dst,
+                'timebucket': ts,
+                'objects': int(int(item['objects']['N']) * share),
+                'size': int(int(item['size']['N']) * share),
+                'elapsed': int(int(item['elapsed']['N']) * share),
+                'bins': {}
+            }))
+        for attr in [ 'objects', 'size', 'elapsed' ]:
+            item[attr] = { 'N': str(sum([ stat[attr] for key, stat in shards ])) }
+        lines = []
+        stdout = sys.stdout
+        sys.stdout = Capture(lines)
+        try:
+            CRRMonitor.emit_metrics(shards)
+        finally:
+            sys.stdout = stdout
+        docs = [ json.loads(line) for line in lines ]
+        self.assertEqual(len(docs), 1)
+        self.assertEqual(by_name(emf_datums(docs)), by_name(emf_datums(emf(item))))
+        self.assertEqual(sorted(by_name(emf_datums(docs))), sorted(by_name(old_datums(item))))
+
+class Capture(object):
+    def __init__(self, lines):
+        self.lines = lines
+        self.partial = ''
+    def write(self, s):
+        self.partial += s
+        while '\n' in self.partial:
+            line, self.partial = self.partial.split('\n', 1)
+            self.lines.append(line)
+    def flush(self):
+        pass
+
+class TestHousekeepingDatums(unittest.TestCase):
+    # What Housekeeping posts now for the same items
+    def test_matches_old_metrics(self):
+        fakes.install(fakes.FakeAWS())
+        import CRRMonitorHousekeeping
+        rnd = random.Random(20170209)
+        for n in range(2000):
+            item = random_item(rnd)
+            old = by_name(old_datums(item))
+            new = by_name(CRRMonitorHousekeeping.stat_datums(item))
+            self.assertEqual(new, old)
+
+class TestPublishStats(unittest.TestCase):
+    # put_metric_data takes at most 1000 datums and 1 MB in a request
+    def setUp(self):
+        import botocore.session
+        import botocore.serialize
+        self.aws = fakes.install(fakes.FakeAWS())
+        self.table = self.aws.add_table('CRRMonitorStatistics', 'OriginReplicaBucket')
+        import crr_clients
+        import CRRMonitorHousekeeping
+        self.hk = CRRMonitorHousekeeping
+        # Connect to this test's fakes, not those of an earlier test
+        crr_clients.clients.clear()
+        self.hk.connect_clients(self.hk.client)
+        self.operation = botocore.session.get_session().get_service_model('cloudwatch').operation_model('PutMetricData')
+        self.serializer = botocore.serialize.create_serializer('query')
+        rnd = random.Random(20170209)
+        self.stats = []
+        for n in range(250):
+            item = random_item(rnd)
+            item['dest_bucket'] = { 'S': 'replica-bucket-%03d' % n }
+            item['OriginReplicaBucket'] = { 'S': 'key-%03d' % n }
+            for m in range(200):
+                for attr in crr_sketch.replication_bins(rnd.randrange(1, 1 << 30), rnd.randrange(0, 20000)):
+                    item[attr] = { 'N': str(int(item.get(attr, { 'N': '0' })['N']) + 1) }
+            self.table.items[item['OriginReplicaBucket']['S']] = dict(item)
+            self.stats.append((item, [ item ]))
+        self.datums = sum([ len(self.hk.stat_datums(item)) for item, items in self.stats ])
+        self.posted = []
+
+    # The size of the request body botocore sends
+    def body_bytes(self, datums):
+        import urllib
+        request = self.serializer.serialize_to_request({ 'Namespace': crr_metrics.namespace, 'MetricData': datums }, self.operation)
+        return len(urllib.urlencode(request['body']))
+
+    def put(self, limit):
+        def put_metric_data(MetricData, Namespace):
+            if self.body_bytes(MetricData) > limit:
+                raise fakes.client_error('RequestEntityTooLarge', 'PutMetricData')
+            self.posted.append(len(MetricData))
+            return {}
+        self.aws.handlers[('cloudwatch', 'put_metric_data')] = put_metric_data
+
+    def test_requests_fit(self):
+        self.put(1024 * 1024)
+        self.hk.publish_stats(self.stats)
+        self.assertEqual(sum(self.posted), self.datums)
+        self.assertTrue(max(self.posted) <= 1000)
+        self.assertEqual(self.table.items, {})
+
+    def test_split_when_too_large(self):
+        self.put(100 * 1024)
+        self.hk.publish_stats(self.stats)
+        self.assertEqual(sum(self.posted), self.datums)
+        self.assertEqual(self.table.items, {})
+
+if __name__ == '__main__':
+    unittest.main()
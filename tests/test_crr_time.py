@@ -0,0 +1,84 @@
+from __future__ import print_function
+
+import os
+import random
+import sys
+import unittest
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'source'))
+import crr_time
+
+# =====================================================================
+# test_crr_time
+# -------------
+# crr_time must give exactly the time buckets the lambdas worked out with
+# datetime before it existed. The datetime code is kept here as the
+# reference and compared against crr_time on random times.
+#
+#   python2.7 tests/test_crr_time.py
+#
+# Set CRR_TIME_SAMPLES to try more (or fewer) random times.
+# =====================================================================
+timefmt = '%Y-%m-%dT%H:%M:%SZ'
+samples = int(os.environ.get('CRR_TIME_SAMPLES', 20000))
+sizes = [ 1, 7, 60, 300, 600, 900, 3600, 86400 ]
+first = 0 # 1970-01-01
+last = 4102444800 # 2100-01-01
+
+# CRRMonitor.log_statistics
+def old_timebucket(Tstamp, roundTo):
+    ts = datetime.strptime(Tstamp, timefmt)
+    secs = (ts.replace(tzinfo=None) - ts.min).seconds
+    rounding = (secs+roundTo/2) // roundTo * roundTo
+    ts = ts + timedelta(0,rounding-secs,-ts.microsecond)
+    return datetime.strftime(ts, timefmt)
+
+# CRRMonitorHousekeeping.lambda_handler, with ts = datetime.utcnow()
+def old_round_down(ts, roundTo):
+    secs = (ts.replace(tzinfo=None) - ts.min).seconds
+    rounding = (secs-roundTo/2) // roundTo * roundTo
+    ts = ts + timedelta(0,rounding-secs,-ts.microsecond)
+    return datetime.strftime(ts, timefmt)
+
+def random_secs(rnd):
+    # Mostly anywhere, some right at the edge of a day or a bucket
+    secs = rnd.randrange(first, last)
+    if rnd.random() < 0.2:
+        secs -= secs % 86400
+        secs += rnd.choice([ -1, 0, 1, 149, 150, 151, 299, 300, 301 ])
+    return max(secs, first)
+
+class TestCrrTime(unittest.TestCase):
+    def setUp(self):
+        self.rnd = random.Random(20170209)
+
+    def test_parse_format(self):
+        for n in range(samples):
+            secs = random_secs(self.rnd)
+            ts = datetime.strftime(datetime(1970, 1, 1) + timedelta(0, secs), timefmt)
+            self.assertEqual(crr_time.format_time(secs), ts)
+            self.assertEqual(crr_time.parse_time(ts), secs)
+
+    def test_parse_rejects_other_formats(self):
+        for ts in [ '2017-02-09 13:56:03Z', '2017-02-09T13:56:03', '2017-02-09T13:56:03.123Z', '' ]:
+            self.assertRaises(ValueError, crr_time.parse_time, ts)
+
+    def test_round_up(self):
+        for n in range(samples):
+            secs = random_secs(self.rnd)
+            roundTo = self.rnd.choice(sizes)
+            ts = crr_time.format_time(secs)
+            self.assertEqual(crr_time.timebucket(ts, roundTo), old_timebucket(ts, roundTo), (ts, roundTo))
+
+    def test_round_down(self):
+        for n in range(samples):
+            secs = random_secs(self.rnd)
+            micros = self.rnd.randrange(1000000)
+            roundTo = self.rnd.choice(sizes)
+            now = datetime(1970, 1, 1) + timedelta(0, secs, micros)
+            self.assertEqual(crr_time.format_time(crr_time.round_down(secs + micros / 1e6, roundTo)),
+                old_round_down(now, roundTo), (now, roundTo))
+
+if __name__ == '__main__':
+    unittest.main()